@@ -1,24 +1,87 @@
 import pygame
 import random
 import sys
+import os
+import json
 import math
+import time
+import heapq
+import hashlib
+import argparse
+from collections import OrderedDict
+from functools import lru_cache
 from enum import Enum
+from types import MappingProxyType
 import numpy as np
 from pygame import gfxdraw
 
-# Инициализация Pygame
-pygame.init()
-pygame.mixer.init()
-
 # Константы
 SCREEN_WIDTH = 1280
 SCREEN_HEIGHT = 960
 CELL_SIZE = 20
-FPS = 60
+FPS = 144  # Ограничение кадров в секунду по умолчанию (--max-fps); между ходами позиции интерполируются
+TICK_RATE = 60  # Ходов симуляции в секунду при скорости 1x
+MAX_FRAME_TIME = 0.25  # Дольше этого кадр не догоняется: остаток просто отбрасывается
+MAX_TICKS_PER_FRAME = 8  # Сколько ходов на каждую единицу скорости можно сделать за кадр
+MAX_SPEED_BUDGET = 0.8 / TICK_RATE  # Скорость "макс": сколько времени кадра отдаем на ходы
+SIM_SPEEDS = {pygame.K_1: 1, pygame.K_2: 2, pygame.K_3: 4, pygame.K_4: None}  # Клавиша -> множитель скорости (None - максимум)
 UI_HEIGHT = 120
 MINIMAP_SIZE = 150
+TERRAIN_TILE_CELLS = 32  # Сторона тайла кэша местности (в клетках)
+TERRAIN_TILE_CACHE = 64  # Сколько тайлов местности держим в памяти
+GRID_LINE_COLOR = (100, 100, 100)
+SPRITE_CACHE_SIZE = 512  # Сколько спрайтов юнитов и зданий держим в памяти
+GLYPH_CACHE_SIZE = 512  # Сколько отрисованных строк текста держим в памяти
+FOG_DIM = 50  # На сколько затемняются исследованные, но невидимые сейчас клетки
 MAP_WIDTH = 100
 MAP_HEIGHT = 75
+# Классы местности (индексы в таблицах ниже)
+TERRAIN_WATER = 0
+TERRAIN_SWAMP = 1
+TERRAIN_FOREST = 2  # Равнина с лесом: здесь растет дерево
+TERRAIN_PLAIN = 3
+TERRAIN_MOUNTAIN = 4
+TERRAIN_SPEED = np.array([0.3, 0.6, 1.0, 1.0, 0.7], dtype=np.float32)
+# Цвета клеток; у леса и равнины два цвета в шахматном порядке
+TERRAIN_COLORS = [
+    ((50, 50, 150), (50, 50, 150)),
+    ((70, 90, 70), (70, 90, 70)),
+    ((30, 80, 30), (40, 90, 40)),
+    ((30, 80, 30), (40, 90, 40)),
+    ((100, 100, 100), (100, 100, 100))
+]
+
+SPATIAL_CELL_SIZE = 2  # Размер ячейки пространственного индекса юнитов (в клетках карты)
+BUILDING_CELL_SIZE = 5  # Ячейка индекса зданий: не меньше диаметра самого большого здания
+UNIT_RADIUS = 0.7  # Юниты не подходят друг к другу ближе этого расстояния
+NEAREST_SCAN_LIMIT = 768  # До стольких слотов хранилища ближайшего юнита ищем перебором массивов
+BUILDING_SPACING = 2  # Минимальный зазор между зданиями (в клетках)
+
+# Состояния клеток сетки занятости зданиями
+CELL_FREE = 0
+CELL_RESERVED = 1  # Здание строится: место занято, но проходимо
+CELL_BUILDING = 2  # Готовое здание: клетка непроходима
+
+# Поиск пути
+PATH_SEARCH_LIMIT = 8000  # Максимум раскрываемых клеток за один поиск A*
+FREE_CELL_SEARCH_RADIUS = 8  # Насколько далеко искать свободную клетку рядом с занятой целью
+REPATH_DELAY = 8  # Сколько ходов юнит ждет в пробке, прежде чем искать новый путь
+SQRT2 = math.sqrt(2)
+NEIGHBORS_8 = [(1, 0, 1.0), (-1, 0, 1.0), (0, 1, 1.0), (0, -1, 1.0),
+               (1, 1, SQRT2), (1, -1, SQRT2), (-1, 1, SQRT2), (-1, -1, SQRT2)]
+FLOW_FIELD_MIN_GROUP = 4  # С какого размера группы приказ выполняется через поле потока
+FLOW_FIELD_CACHE_SIZE = 16  # Сколько полей потока держим в кэше
+FLOW_ARRIVAL_RADIUS = 3  # На этом расстоянии от цели юнит переходит на обычный путь
+ENTITY_STORE_CAPACITY = 256  # Начальное число слотов в хранилище юнитов (растет удвоением)
+COMBAT_MATRIX_LIMIT = 1 << 20  # Больше пар атакующий-цель пакетный бой считает по квадратам карты
+COMBAT_CHUNK_CELLS = 16  # Сторона квадрата карты в пакетном бою (в клетках)
+PARTICLE_POOL_SIZE = 2048  # Сколько частиц живет одновременно; новые вытесняют самые старые
+BUILDING_VISION_RANGE = 6
+BASE_VISION_RANGE = 10
+VISION_CHANGES_LIMIT = 512  # Сколько прямоугольников изменений видимости копим до сброса на всю карту
+PATH_CACHE_SIZE = 2048  # Сколько путей держим в LRU-кэше
+PATH_CACHE_MARGIN = 2  # Насколько шире здания сбрасываем кэш путей при его постройке или сносе
+MOVE_GROUND = 'ground'  # Класс передвижения: пока все юниты ходят по одним правилам
 
 # Цвета
 BLACK = (0, 0, 0)
@@ -42,23 +105,47 @@ STONE = (160, 160, 160)
 WOOD = (101, 67, 33)
 
 # Звуки
-try:
-    SELECT_SOUND = pygame.mixer.Sound('select.wav')
-    BUILD_SOUND = pygame.mixer.Sound('build.wav')
-    ATTACK_SOUND = pygame.mixer.Sound('attack.wav')
-    DEATH_SOUND = pygame.mixer.Sound('death.wav')
-    VICTORY_SOUND = pygame.mixer.Sound('victory.wav')
-    DEFEAT_SOUND = pygame.mixer.Sound('defeat.wav')
-    RESOURCE_SOUND = pygame.mixer.Sound('resource.wav')
-except:
-    # Заглушки если звуки не найдены
-    SELECT_SOUND = pygame.mixer.Sound(buffer=bytearray(100))
-    BUILD_SOUND = pygame.mixer.Sound(buffer=bytearray(100))
-    ATTACK_SOUND = pygame.mixer.Sound(buffer=bytearray(100))
-    DEATH_SOUND = pygame.mixer.Sound(buffer=bytearray(100))
-    VICTORY_SOUND = pygame.mixer.Sound(buffer=bytearray(100))
-    DEFEAT_SOUND = pygame.mixer.Sound(buffer=bytearray(100))
-    RESOURCE_SOUND = pygame.mixer.Sound(buffer=bytearray(100))
+class SilentSound:
+    """Звук-заглушка: ничего не воспроизводит"""
+    def play(self):
+        pass
+
+# До инициализации микшера (и в headless-режиме) все звуки - заглушки
+SELECT_SOUND = SilentSound()
+BUILD_SOUND = SilentSound()
+ATTACK_SOUND = SilentSound()
+DEATH_SOUND = SilentSound()
+VICTORY_SOUND = SilentSound()
+DEFEAT_SOUND = SilentSound()
+RESOURCE_SOUND = SilentSound()
+
+def init_audio():
+    global SELECT_SOUND, BUILD_SOUND, ATTACK_SOUND, DEATH_SOUND
+    global VICTORY_SOUND, DEFEAT_SOUND, RESOURCE_SOUND
+    
+    try:
+        pygame.mixer.init()
+    except pygame.error:
+        # Нет звукового устройства - остаемся на заглушках
+        return
+    
+    try:
+        SELECT_SOUND = pygame.mixer.Sound('select.wav')
+        BUILD_SOUND = pygame.mixer.Sound('build.wav')
+        ATTACK_SOUND = pygame.mixer.Sound('attack.wav')
+        DEATH_SOUND = pygame.mixer.Sound('death.wav')
+        VICTORY_SOUND = pygame.mixer.Sound('victory.wav')
+        DEFEAT_SOUND = pygame.mixer.Sound('defeat.wav')
+        RESOURCE_SOUND = pygame.mixer.Sound('resource.wav')
+    except:
+        # Заглушки если звуки не найдены
+        SELECT_SOUND = pygame.mixer.Sound(buffer=bytearray(100))
+        BUILD_SOUND = pygame.mixer.Sound(buffer=bytearray(100))
+        ATTACK_SOUND = pygame.mixer.Sound(buffer=bytearray(100))
+        DEATH_SOUND = pygame.mixer.Sound(buffer=bytearray(100))
+        VICTORY_SOUND = pygame.mixer.Sound(buffer=bytearray(100))
+        DEFEAT_SOUND = pygame.mixer.Sound(buffer=bytearray(100))
+        RESOURCE_SOUND = pygame.mixer.Sound(buffer=bytearray(100))
 
 # Типы юнитов
 class UnitType(Enum):
@@ -86,6 +173,20 @@ class BuildingType(Enum):
     LUMBER_MILL = 10
     FARM = 11
 
+# Стороны в числовых массивах хранилища юнитов
+SIDE_PLAYER = 0
+SIDE_ENEMY = 1
+SIDES = ('player', 'enemy')
+
+# Множители урона юнитам (сторона атакующего, тип атакующего, тип цели);
+# у врага бонуса разведчика нет. Бой читает их из DAMAGE_BONUS_TABLE
+DAMAGE_BONUSES = {
+    ('player', UnitType.WARRIOR, UnitType.CAVALRY): 1.5,
+    ('player', UnitType.SCOUT, UnitType.ARCHER): 1.3,
+    ('enemy', UnitType.WARRIOR, UnitType.CAVALRY): 1.5,
+}
+TARGET_BUILDING = len(UnitType) + 1  # Номер "типа цели" для зданий в таблице бонусов
+
 # Типы ресурсов
 class ResourceType(Enum):
     GOLD = 1
@@ -93,16 +194,811 @@ class ResourceType(Enum):
     WOOD = 3
     FOOD = 4
 
-class Game:
+# Характеристики юнитов и зданий лежат в stats.json рядом с игрой
+STATS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stats.json')
+
+# Схема записей: поле -> (вид значения, обязательное ли).
+# number - неотрицательное число, positive - строго положительное, count - целое больше нуля
+UNIT_STATS_SCHEMA = {
+    'health': ('positive', True),
+    'damage': ('number', True),
+    'speed': ('number', True),
+    'range': ('number', True),
+    'cost': ('resources', True),
+    'color': ('color', True),
+    'build_time': ('positive', True),
+    'heal_amount': ('number', False),
+    'bonus_vs_buildings': ('number', False),
+    'vision_range': ('number', False),
+    'gather_rate': ('resources', False),
+    'build_range': ('number', False),
+    'carry_capacity': ('number', False),
+}
+BUILDING_STATS_SCHEMA = {
+    'health': ('positive', True),
+    'cost': ('resources', True),
+    'size': ('count', True),
+    'color': ('color', True),
+    'build_time': ('positive', True),
+    'produces': ('unit_type', False),
+    'damage': ('number', False),
+    'range': ('number', False),
+    'income': ('resources', False),
+}
+
+def parse_stat(value, kind, where):
+    if kind == 'number':
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+            raise ValueError(f"{where}: ожидалось неотрицательное число, а не {value!r}")
+        return value
+    if kind == 'positive':
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or value <= 0:
+            raise ValueError(f"{where}: ожидалось положительное число, а не {value!r}")
+        return value
+    if kind == 'count':
+        if isinstance(value, bool) or not isinstance(value, int) or value <= 0:
+            raise ValueError(f"{where}: ожидалось целое число больше нуля, а не {value!r}")
+        return value
+    if kind == 'resources':
+        if not isinstance(value, dict):
+            raise ValueError(f"{where}: ожидался словарь ресурсов, а не {value!r}")
+        for resource, amount in value.items():
+            if resource.upper() not in ResourceType.__members__:
+                raise ValueError(f"{where}: неизвестный ресурс {resource!r}")
+            parse_stat(amount, 'number', f"{where}.{resource}")
+        return MappingProxyType(dict(value))
+    if kind == 'color':
+        if (not isinstance(value, list) or len(value) != 3 or
+                not all(isinstance(c, int) and not isinstance(c, bool) and 0 <= c <= 255 for c in value)):
+            raise ValueError(f"{where}: ожидался цвет [r, g, b], а не {value!r}")
+        return tuple(value)
+    if kind == 'unit_type':
+        if value not in UnitType.__members__:
+            raise ValueError(f"{where}: неизвестный тип юнита {value!r}")
+        return UnitType[value]
+    raise ValueError(f"{where}: неизвестный вид поля {kind!r}")
+
+def load_stat_table(section, enum, schema, where):
+    """Кортеж неизменяемых записей, индексированный значением enum"""
+    if not isinstance(section, dict):
+        raise ValueError(f"{where}: раздел отсутствует или не является объектом")
+    unknown = sorted(set(section) - set(enum.__members__))
+    missing = [name for name in enum.__members__ if name not in section]
+    if unknown or missing:
+        raise ValueError(f"{where}: лишние типы {unknown}, нет типов {missing}")
+    
+    table = [None] * (max(member.value for member in enum) + 1)
+    for member in enum:
+        record = section[member.name]
+        path = f"{where}.{member.name}"
+        if not isinstance(record, dict):
+            raise ValueError(f"{path}: запись должна быть объектом")
+        for key in record:
+            if key not in schema:
+                raise ValueError(f"{path}: неизвестное поле {key!r}")
+        for key, (kind, required) in schema.items():
+            if required and key not in record:
+                raise ValueError(f"{path}: нет обязательного поля {key!r}")
+        table[member.value] = MappingProxyType({
+            key: parse_stat(value, schema[key][0], f"{path}.{key}") for key, value in record.items()
+        })
+    return tuple(table)
+
+def load_stats(path=STATS_FILE):
+    """Загружает и проверяет характеристики.
+
+    Возвращает таблицы юнитов и зданий (индекс - значение UnitType/BuildingType)
+    и время загрузки в секундах.
+    """
+    start = time.perf_counter()
+    with open(path, encoding='utf-8') as f:
+        data = json.load(f)
+    if not isinstance(data, dict):
+        raise ValueError(f"{path}: ожидался объект с разделами units и buildings")
+    units = load_stat_table(data.get('units'), UnitType, UNIT_STATS_SCHEMA, 'units')
+    buildings = load_stat_table(data.get('buildings'), BuildingType, BUILDING_STATS_SCHEMA, 'buildings')
+    return units, buildings, time.perf_counter() - start
+
+UNIT_STATS, BUILDING_STATS, STATS_LOAD_TIME = load_stats()
+
+# Таблица множителей урона [сторона, тип атакующего, тип цели] для обоих движков боя.
+# Столбец TARGET_BUILDING - урон по зданиям (bonus_vs_buildings из stats.json)
+DAMAGE_BONUS_TABLE = np.ones((len(SIDES), len(UnitType) + 1, TARGET_BUILDING + 1))
+for (side, attacker, target), bonus in DAMAGE_BONUSES.items():
+    DAMAGE_BONUS_TABLE[SIDES.index(side), attacker.value, target.value] = bonus
+for unit_type in UnitType:
+    DAMAGE_BONUS_TABLE[:, unit_type.value, TARGET_BUILDING] = UNIT_STATS[unit_type.value].get('bonus_vs_buildings', 1.0)
+
+def damage_bonus(side, attacker_type, target):
+    """Множитель урона атакующего стороны side (SIDE_PLAYER/SIDE_ENEMY) по юниту или зданию"""
+    column = target.kind.type.value if isinstance(target, Unit) else TARGET_BUILDING
+    return DAMAGE_BONUS_TABLE.item(side, attacker_type.value, column)
+
+def cost_label(name, stats):
+    """Подпись кнопки с ценой из таблицы характеристик, например: Воин (25g,10w)"""
+    cost = ",".join(f"{amount:g}{resource[0]}" for resource, amount in stats['cost'].items())
+    return f"{name} ({cost})"
+
+# Символы типов на карте
+UNIT_SYMBOLS = {
+    UnitType.WARRIOR: "W",
+    UnitType.ARCHER: "A",
+    UnitType.CAVALRY: "C",
+    UnitType.HEALER: "H",
+    UnitType.SIEGE: "S",
+    UnitType.SCOUT: "R",
+    UnitType.WORKER: "Wk",
+    UnitType.MINER: "M",
+    UnitType.LUMBERJACK: "L",
+}
+
+BUILDING_SYMBOLS = {
+    BuildingType.BARRACKS: "B",
+    BuildingType.ARCHERY: "A",
+    BuildingType.STABLE: "S",
+    BuildingType.TEMPLE: "H",
+    BuildingType.SIEGE_WORKSHOP: "W",
+    BuildingType.TOWER: "T",
+    BuildingType.WALL: "|",
+    BuildingType.TOWN_HALL: "TH",
+    BuildingType.MINE: "M",
+    BuildingType.LUMBER_MILL: "L",
+    BuildingType.FARM: "F",
+}
+
+def vision_key(kind, entity):
+    """Ключ источника зрения: хэндлы уникальны только внутри своего реестра"""
+    return (kind, entity['side'], entity['handle'])
+
+def is_ready(entity):
+    return entity['build_progress'] >= entity['build_time']
+
+def is_targetable_building(building):
+    # База - цель даже недостроенной
+    return building['is_base'] or building['build_progress'] >= building['build_time']
+
+@lru_cache(maxsize=None)
+def disk_mask(radius):
+    """Булева маска круга радиуса radius размером (2r+1) x (2r+1)"""
+    d = np.arange(-radius, radius + 1)
+    mask = d[:, None]**2 + d[None, :]**2 <= radius * radius
+    mask.flags.writeable = False
+    return mask
+
+class SpatialHash:
+    """Равномерная сетка для быстрых запросов "кто рядом с точкой".
+
+    Сущности раскладываются по ячейкам по своим координатам и
+    перекладываются только при переходе в другую ячейку. Ключ сущности -
+    ее хэндл в EntityRegistry, поэтому в одном индексе должны быть
+    сущности одного реестра. Последние
+    координаты хранятся тут же, чтобы поиск ближайшего не читал их
+    из каждой сущности.
+    """
+    def __init__(self, cell_size=SPATIAL_CELL_SIZE):
+        self.cell_size = cell_size
+        self.cells = {}
+        self.entity_cells = {}
+        self.positions = {}
+    
+    def cell_of(self, x, y):
+        return (int(x // self.cell_size), int(y // self.cell_size))
+    
+    def insert(self, entity):
+        key = entity['handle']
+        if key in self.entity_cells:
+            return
+        x, y = entity['x'], entity['y']
+        cell = self.cell_of(x, y)
+        self.cells.setdefault(cell, {})[key] = entity
+        self.entity_cells[key] = cell
+        self.positions[key] = (x, y)
+    
+    def remove(self, entity):
+        key = entity['handle']
+        cell = self.entity_cells.pop(key, None)
+        if cell is None:
+            return
+        del self.positions[key]
+        bucket = self.cells[cell]
+        del bucket[key]
+        if not bucket:
+            del self.cells[cell]
+    
+    def move(self, key, x, y):
+        """Переносит сущность с хэндлом key в новую точку (x, y)"""
+        old_cell = self.entity_cells.get(key)
+        if old_cell is None:
+            return
+        self.positions[key] = (x, y)
+        new_cell = self.cell_of(x, y)
+        if new_cell == old_cell:
+            return
+        bucket = self.cells[old_cell]
+        entity = bucket.pop(key)
+        if not bucket:
+            del self.cells[old_cell]
+        self.cells.setdefault(new_cell, {})[key] = entity
+        self.entity_cells[key] = new_cell
+    
+    def nearby(self, x, y, radius):
+        """Кандидаты в квадрате радиуса radius - точную проверку делает вызывающий"""
+        size = self.cell_size
+        cx0 = int((x - radius) // size)
+        cx1 = int((x + radius) // size)
+        cy0 = int((y - radius) // size)
+        cy1 = int((y + radius) // size)
+        cells = self.cells
+        found = []
+        for cx in range(cx0, cx1 + 1):
+            for cy in range(cy0, cy1 + 1):
+                bucket = cells.get((cx, cy))
+                if bucket:
+                    found.extend(bucket.values())
+        return found
+    
+    def buckets_in_rect(self, x0, y0, x1, y1):
+        """Непустые ячейки (словари хэндл -> сущность), задевающие прямоугольник;
+        точную проверку координат делает вызывающий"""
+        size = self.cell_size
+        cx0, cy0 = int(x0 // size), int(y0 // size)
+        cx1, cy1 = int(x1 // size), int(y1 // size)
+        cells = self.cells
+        # Если прямоугольник больше, чем занятых ячеек, дешевле пройти по занятым
+        if (cx1 - cx0 + 1) * (cy1 - cy0 + 1) > len(cells):
+            return [bucket for (cx, cy), bucket in cells.items()
+                    if cx0 <= cx <= cx1 and cy0 <= cy <= cy1]
+        get = cells.get
+        return [bucket for cx in range(cx0, cx1 + 1) for cy in range(cy0, cy1 + 1)
+                if (bucket := get((cx, cy)))]
+    
+    def in_rect(self, x0, y0, x1, y1):
+        """Сущности с x0 <= x < x1 и y0 <= y < y1 (например, попавшие в камеру)"""
+        positions = self.positions
+        found = []
+        for bucket in self.buckets_in_rect(x0, y0, x1, y1):
+            for key, entity in bucket.items():
+                x, y = positions[key]
+                if x0 <= x < x1 and y0 <= y < y1:
+                    found.append(entity)
+        return found
+    
+    def nearest(self, x, y, max_range=math.inf, accept=None):
+        """Ближайшая сущность не дальше max_range и квадрат расстояния до нее.
+
+        Ячейки обходятся кольцами от ячейки точки наружу; поиск останавливается,
+        как только следующее кольцо заведомо дальше найденной цели или max_range.
+        accept отсеивает неподходящие сущности (например, недостроенные).
+        """
+        cells = self.cells
+        positions = self.positions
+        size = self.cell_size
+        limit = max_range * max_range
+        best = None
+        best_d2 = math.inf
+        cx, cy = self.cell_of(x, y)
+        ring = 0
+        while True:
+            # Колец больше, чем занятых ячеек - дешевле досмотреть все ячейки разом
+            if (2 * ring + 1)**2 > len(cells):
+                buckets = cells.values()
+            elif ring == 0:
+                buckets = [cells.get((cx, cy))]
+            else:
+                ring_cells = [(cx + dx, cy - ring) for dx in range(-ring, ring + 1)]
+                ring_cells += [(cx + dx, cy + ring) for dx in range(-ring, ring + 1)]
+                ring_cells += [(cx - ring, cy + dy) for dy in range(1 - ring, ring)]
+                ring_cells += [(cx + ring, cy + dy) for dy in range(1 - ring, ring)]
+                buckets = [cells.get(cell) for cell in ring_cells]
+            
+            for bucket in buckets:
+                if not bucket:
+                    continue
+                for key, entity in bucket.items():
+                    ex, ey = positions[key]
+                    d2 = (ex - x)**2 + (ey - y)**2
+                    if d2 <= limit and d2 < best_d2 and (accept is None or accept(entity)):
+                        best = entity
+                        best_d2 = d2
+            
+            if (2 * ring + 1)**2 > len(cells):
+                break
+            # Любая точка следующего кольца не ближе ring * size
+            reach = ring * size
+            if reach * reach > limit or reach * reach >= best_d2:
+                break
+            ring += 1
+        return best, best_d2
+    
+    def __len__(self):
+        return len(self.entity_cells)
+
+class PathCache:
+    """LRU-кэш путей по ключу (клетка старта, клетка цели, класс передвижения).
+
+    Вместе с путем хранится охватывающий прямоугольник его клеток, чтобы при
+    изменении зданий сбрасывать только пути, проходящие рядом.
+    """
+    def __init__(self, capacity=PATH_CACHE_SIZE):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+    
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+    
+    def put(self, key, cells, bounds):
+        self.entries[key] = (cells, bounds)
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+    
+    def invalidate_region(self, x0, y0, x1, y1):
+        """Сбрасывает пути, чей прямоугольник пересекает [x0, x1) x [y0, y1)"""
+        stale = [key for key, (_, (bx0, by0, bx1, by1)) in self.entries.items()
+                 if bx0 < x1 and x0 <= bx1 and by0 < y1 and y0 <= by1]
+        for key in stale:
+            del self.entries[key]
+        self.invalidations += len(stale)
+    
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self.entries),
+            'capacity': self.capacity,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations
+        }
+
+class FlowField:
+    """Поле потока к одной цели: интеграл стоимости пути (Дейкстра от цели)
+    и направление на лучшую соседнюю клетку для каждой клетки карты.
+
+    Одно поле делят все юниты, идущие к этой цели.
+    """
+    def __init__(self, costs, width, height, seeds):
+        stride = height + 2
+        neighbors = [(dx * stride + dy, step, dx * stride, dy) for dx, dy, step in NEIGHBORS_8]
+        
+        # Дейкстра от всех стартовых клеток сразу (по плоской сетке с рамкой, как в A*)
+        dist = [math.inf] * len(costs)
+        heap = []
+        for seed in seeds:
+            dist[seed] = 0.0
+            heap.append((0.0, seed))
+        heapq.heapify(heap)
+        while heap:
+            d, current = heapq.heappop(heap)
+            if d > dist[current]:
+                continue
+            current_cost = costs[current]
+            for offset, step, side_x, side_y in neighbors:
+                neighbor = current + offset
+                cost = costs[neighbor]
+                if cost is None:
+                    continue
+                if side_y and side_x and (costs[current + side_x] is None or costs[current + side_y] is None):
+                    continue
+                nd = d + step * (current_cost + cost) * 0.5
+                if nd < dist[neighbor]:
+                    dist[neighbor] = nd
+                    heapq.heappush(heap, (nd, neighbor))
+        
+        # Направления считаем векторно: для каждой клетки - сосед с минимальным интегралом
+        field = np.array(dist).reshape(width + 2, height + 2)
+        passable = np.array([c is not None for c in costs]).reshape(width + 2, height + 2)
+        inner = field[1:-1, 1:-1]
+        candidates = np.full((len(NEIGHBORS_8), width, height), np.inf)
+        for i, (dx, dy, _) in enumerate(NEIGHBORS_8):
+            shifted = field[1+dx:width+1+dx, 1+dy:height+1+dy]
+            if dx and dy:
+                corner_free = (passable[1+dx:width+1+dx, 1:-1] &
+                               passable[1:-1, 1+dy:height+1+dy])
+                shifted = np.where(corner_free, shifted, np.inf)
+            candidates[i] = shifted
+        best = candidates.argmin(axis=0)
+        improves = candidates.min(axis=0) < inner
+        
+        offsets = np.array([(dx, dy) for dx, dy, _ in NEIGHBORS_8])
+        self.dir_x = np.where(improves, offsets[best, 0], 0).tolist()
+        self.dir_y = np.where(improves, offsets[best, 1], 0).tolist()
+        self.distance = inner.tolist()
+    
+    def direction_at(self, x, y):
+        return self.dir_x[x][y], self.dir_y[x][y]
+
+class EntityRegistry:
+    """Сущности одного вида с устойчивыми хэндлами и удалением за O(1).
+
+    Хэндл - целое число: номер слота в младших битах и поколение слота в
+    старших. При удалении поколение слота растет, поэтому старый хэндл
+    перестает находить сущность, даже когда слот уже занят новой. Сами
+    сущности лежат плотным списком: удаление ставит на место удаленной
+    последнюю, а обход и len работают как у обычного списка.
+    """
+    SLOT_BITS = 24
+    SLOT_MASK = (1 << SLOT_BITS) - 1
+    
     def __init__(self):
-        self.grid_width = MAP_WIDTH
-        self.grid_height = MAP_HEIGHT
-        self.player_units = []
-        self.enemy_units = []
-        self.player_buildings = []
-        self.enemy_buildings = []
-        self.resources = []
-        self.selected_units = []
+        self.items = []  # Живые сущности подряд
+        self.handles = []  # Хэндлы в том же порядке, что items
+        self.positions = []  # Слот -> позиция сущности в items
+        self.generations = []  # Слот -> текущее поколение
+        self.free = []
+    
+    def append(self, entity):
+        """Регистрирует сущность, записывает ей entity['handle'] и возвращает хэндл"""
+        handle = entity.get('handle')
+        if handle is not None and self.get(handle) is entity:
+            raise ValueError(f"Сущность уже зарегистрирована под хэндлом {handle}")
+        
+        if self.free:
+            slot = self.free.pop()
+        else:
+            slot = len(self.generations)
+            self.generations.append(0)
+            self.positions.append(0)
+        
+        handle = (self.generations[slot] << self.SLOT_BITS) | slot
+        self.positions[slot] = len(self.items)
+        self.items.append(entity)
+        self.handles.append(handle)
+        entity['handle'] = handle
+        return handle
+    
+    def get(self, handle):
+        """Сущность по хэндлу или None, если ее уже удалили"""
+        if handle is None:
+            return None
+        slot = handle & self.SLOT_MASK
+        if slot < len(self.generations) and self.generations[slot] == handle >> self.SLOT_BITS:
+            return self.items[self.positions[slot]]
+        return None
+    
+    def remove(self, handle):
+        if self.get(handle) is None:
+            return False
+        slot = handle & self.SLOT_MASK
+        position = self.positions[slot]
+        last = self.items.pop()
+        last_handle = self.handles.pop()
+        if position < len(self.items):
+            self.items[position] = last
+            self.handles[position] = last_handle
+            self.positions[last_handle & self.SLOT_MASK] = position
+        self.generations[slot] += 1
+        self.free.append(slot)
+        return True
+    
+    def __contains__(self, handle):
+        return self.get(handle) is not None
+    
+    def __iter__(self):
+        return iter(self.items)
+    
+    def __len__(self):
+        return len(self.items)
+    
+    def __getitem__(self, index):
+        return self.items[index]
+    
+    def __add__(self, other):
+        return self.items + list(other)
+
+class ParticlePool:
+    """Частицы эффектов в кольцевом буфере из numpy-массивов.
+
+    Новые частицы пишутся по кругу поверх самых старых, так что их число не
+    превышает capacity, а движение и угасание считаются сразу для всех.
+    Частицы чисто декоративные и берут случайные числа из своего генератора.
+    """
+    def __init__(self, capacity=PARTICLE_POOL_SIZE, seed=None):
+        self.capacity = capacity
+        self.head = 0  # Куда запишется следующая частица
+        self.active = 0  # Сколько частиц было живо после последнего хода
+        self.x = np.zeros(capacity)
+        self.y = np.zeros(capacity)
+        self.dx = np.zeros(capacity)
+        self.dy = np.zeros(capacity)
+        self.life = np.zeros(capacity, dtype=np.int32)
+        self.size = np.zeros(capacity, dtype=np.int32)
+        self.color = np.zeros((capacity, 3), dtype=np.uint8)
+        self.rng = np.random.default_rng(seed)
+    
+    def add(self, x, y, count, color):
+        count = min(count, self.capacity)
+        index = (self.head + np.arange(count)) % self.capacity
+        self.head = (self.head + count) % self.capacity
+        
+        angle = self.rng.uniform(0, 2 * math.pi, count)
+        speed = self.rng.uniform(0.1, 0.5, count)
+        self.x[index] = x
+        self.y[index] = y
+        self.dx[index] = np.cos(angle) * speed
+        self.dy[index] = np.sin(angle) * speed
+        self.life[index] = self.rng.integers(10, 31, count)
+        self.size[index] = self.rng.integers(1, 4, count)
+        self.color[index] = color[:3]
+        self.active += count
+    
+    def update(self):
+        if not self.active:
+            return
+        alive = self.live()
+        self.x[alive] += self.dx[alive]
+        self.y[alive] += self.dy[alive]
+        self.life[alive] -= 1
+        self.active = int(np.count_nonzero(self.life[alive] > 0))
+    
+    def live(self):
+        """Номера живых частиц"""
+        return np.flatnonzero(self.life > 0)
+    
+    def __len__(self):
+        return int(np.count_nonzero(self.life > 0))
+
+class EntityStore:
+    """Хранилище юнитов в виде структуры массивов.
+
+    Каждое числовое поле - отдельный numpy-массив, юнит - номер слота в них,
+    поэтому системы игры могут обрабатывать сразу всех юнитов срезами [:size].
+    Слоты погибших юнитов попадают в список свободных и переиспользуются.
+    """
+    FIELDS = {
+        'x': np.float64,
+        'y': np.float64,
+        'prev_x': np.float64,  # Позиция до последнего хода - для сглаживания отрисовки
+        'prev_y': np.float64,
+        'health': np.float64,
+        'max_health': np.float64,
+        'damage': np.float64,
+        'speed': np.float64,
+        'range': np.float64,
+        'bonus_vs_buildings': np.float64,
+        'cooldown': np.int32,
+        'build_progress': np.int32,
+        'build_time': np.int32,
+        'attacking': bool,
+        'gathering': bool,
+    }
+    
+    def __init__(self, capacity=ENTITY_STORE_CAPACITY):
+        self.capacity = capacity
+        self.size = 0  # Слоты [size:] ни разу не выдавались
+        self.free = []
+        self.records = [None] * capacity
+        self.columns = {name: np.zeros(capacity, dtype=dtype) for name, dtype in self.FIELDS.items()}
+        # store.x, store.health и т.д. - массивы полей обычными атрибутами, без поиска в columns
+        self.__dict__.update(self.columns)
+        self.alive = np.zeros(capacity, dtype=bool)
+        self.side = np.zeros(capacity, dtype=np.int8)
+        self.type = np.zeros(capacity, dtype=np.int8)
+    
+    def grow(self):
+        self.capacity *= 2
+        for name, column in self.columns.items():
+            self.columns[name] = np.resize(column, self.capacity)
+        self.__dict__.update(self.columns)
+        self.alive = np.concatenate([self.alive, np.zeros(self.capacity - len(self.alive), dtype=bool)])
+        self.side = np.resize(self.side, self.capacity)
+        self.type = np.resize(self.type, self.capacity)
+        self.records.extend([None] * (self.capacity - len(self.records)))
+    
+    def allocate(self, record, fields):
+        if self.free:
+            slot = self.free.pop()
+        else:
+            if self.size == self.capacity:
+                self.grow()
+            slot = self.size
+            self.size += 1
+        
+        for name, column in self.columns.items():
+            column[slot] = fields.get(name, 0)
+        self.alive[slot] = True
+        self.side[slot] = SIDES.index(fields['side'])
+        self.type[slot] = fields['type'].value
+        self.records[slot] = record
+        return slot
+    
+    def release(self, slot):
+        """Освобождает слот и возвращает последние значения его полей"""
+        values = {name: column.item(slot) for name, column in self.columns.items()}
+        self.alive[slot] = False
+        self.records[slot] = None
+        self.free.append(slot)
+        return values
+    
+    def slots(self, mask):
+        """Номера слотов по булевой маске над срезом [:size]"""
+        return np.flatnonzero(mask).tolist()
+    
+    def __len__(self):
+        return self.size - len(self.free)
+
+class UnitKind:
+    """Общие неизменяемые характеристики юнитов одного типа и одной стороны"""
+    __slots__ = ('type', 'side', 'color', 'cost', 'heal_amount', 'vision_range',
+                 'gather_rate', 'build_range', 'carry_capacity')
+    
+    def __init__(self, unit_type, side, stats):
+        self.type = unit_type
+        self.side = side
+        self.color = stats['color'] if side == 'player' else YELLOW
+        self.cost = stats['cost']
+        self.heal_amount = stats.get('heal_amount', 0)
+        self.vision_range = stats.get('vision_range', 5)
+        self.gather_rate = stats.get('gather_rate', {})
+        self.build_range = stats.get('build_range', 0)
+        self.carry_capacity = stats.get('carry_capacity', 20)
+
+class Unit:
+    """Юнит: числовые поля живут в EntityStore, характеристики типа - в общем UnitKind.
+
+    У самого юнита в __slots__ только его изменяемое состояние. Доступ по
+    ключам как к словарю оставлен для совместимости: unit['x'] читает массив
+    хранилища, unit['color'] - описание типа. После гибели юнит отвязывается
+    от слота и хранит последние значения у себя, чтобы старые ссылки не
+    указали на нового юнита.
+    """
+    __slots__ = ('store', 'columns', 'slot', 'kind', 'remains', 'handle',
+                 'target_x', 'target_y', 'gather_target', 'carrying', 'path', 'flow_goal', 'stuck')
+    STATE = frozenset(('handle', 'target_x', 'target_y', 'gather_target', 'carrying', 'path', 'flow_goal', 'stuck'))
+    
+    def __init__(self, store, kind, fields):
+        self.store = store
+        self.columns = store.columns
+        self.kind = kind
+        self.remains = None
+        self.handle = None
+        self.target_x = None
+        self.target_y = None
+        self.gather_target = None  # Хэндл ресурса в Game.resources
+        self.carrying = {'gold': 0, 'stone': 0, 'wood': 0, 'food': 0}
+        self.path = []
+        self.flow_goal = None
+        self.stuck = 0
+        self.slot = store.allocate(self, fields)
+    
+    def __getitem__(self, key):
+        if key in self.columns:
+            if self.slot is not None:
+                return self.columns[key].item(self.slot)
+            return self.remains[key]
+        if key in Unit.STATE:
+            return getattr(self, key)
+        if key == 'building':
+            return self['build_progress'] < self['build_time']
+        try:
+            return getattr(self.kind, key)
+        except AttributeError:
+            raise KeyError(key) from None
+    
+    def __setitem__(self, key, value):
+        if key in self.columns:
+            if self.slot is not None:
+                self.columns[key][self.slot] = value
+            else:
+                self.remains[key] = value
+        elif key in Unit.STATE:
+            setattr(self, key, value)
+        else:
+            # Характеристики типа общие для всех юнитов и не меняются
+            raise KeyError(key)
+    
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+    
+    def release(self):
+        if self.slot is not None:
+            self.remains = self.store.release(self.slot)
+            self.slot = None
+
+class BuildingKind:
+    """Общие неизменяемые характеристики зданий одного типа"""
+    __slots__ = ('type', 'color', 'cost', 'size', 'build_time', 'produces', 'damage', 'range', 'income')
+    
+    def __init__(self, building_type, stats):
+        self.type = building_type
+        self.color = stats['color']
+        self.cost = stats['cost']
+        self.size = stats['size']
+        self.build_time = stats['build_time']
+        self.produces = stats.get('produces')
+        self.damage = stats.get('damage', 0)
+        self.range = stats.get('range', 0)
+        self.income = stats.get('income', {})
+
+class Building:
+    """Здание: в __slots__ только его состояние, характеристики типа - в общем BuildingKind.
+
+    Как и Unit, поддерживает доступ по ключам: building['health'],
+    building['size'], building.get('produces').
+    """
+    __slots__ = ('kind', 'handle', 'side', 'x', 'y', 'health', 'max_health', 'build_progress', 'cooldown', 'is_base')
+    STATE = frozenset(__slots__) - {'kind'}
+    
+    def __init__(self, kind, side, x, y, health):
+        self.kind = kind
+        self.handle = None
+        self.side = side
+        self.x = x
+        self.y = y
+        self.health = health
+        self.max_health = health
+        self.build_progress = 0
+        self.cooldown = 0
+        self.is_base = False
+    
+    def __getitem__(self, key):
+        if key in Building.STATE:
+            return getattr(self, key)
+        try:
+            return getattr(self.kind, key)
+        except AttributeError:
+            raise KeyError(key) from None
+    
+    def __setitem__(self, key, value):
+        if key not in Building.STATE:
+            raise KeyError(key)
+        setattr(self, key, value)
+    
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+class Game:
+    def __init__(self, headless=False, width=MAP_WIDTH, height=MAP_HEIGHT, seed=None, batch_combat=False,
+                 rng_seed=None):
+        # В headless-режиме игра не трогает звук и может обновляться без ограничения FPS
+        self.headless = headless
+        # Вся случайность симуляции идет из своего генератора: с тем же зерном и теми же
+        # командами игра повторяется ход в ход (без зерна карты берется зерно случайное)
+        if rng_seed is None:
+            rng_seed = seed if seed is not None else random.randrange(2**32)
+        self.rng_seed = rng_seed
+        self.random = random.Random(rng_seed)
+        # Приказы игрока ставятся в очередь и выполняются в начале хода, а выполненные
+        # попадают в журнал с номером хода - по нему игру можно воспроизвести
+        self.pending_commands = []
+        self.command_log = []
+        # Пакетный бой: все атаки хода считаются массивами и наносятся одновременно
+        self.batch_combat = batch_combat
+        self.seed = seed
+        self.grid_width = width
+        self.grid_height = height
+        # Юниты, здания и ресурсы - в реестрах с хэндлами и удалением за O(1)
+        self.player_units = EntityRegistry()
+        self.enemy_units = EntityRegistry()
+        self.unit_store = EntityStore()
+        self.unit_kinds = {}  # (сторона, тип) -> UnitKind
+        self.building_kinds = {}  # тип -> BuildingKind
+        self.player_buildings = EntityRegistry()
+        self.enemy_buildings = EntityRegistry()
+        self.resources = EntityRegistry()
+        # Пространственные индексы юнитов и зданий по сторонам
+        self.unit_index = {'player': SpatialHash(), 'enemy': SpatialHash()}
+        self.building_index = {'player': SpatialHash(BUILDING_CELL_SIZE),
+                               'enemy': SpatialHash(BUILDING_CELL_SIZE)}
+        self.selection = []  # Хэндлы выделенных юнитов игрока
         self.selected_building = None
         self.player_resources = {
             'gold': 200,
@@ -126,8 +1022,27 @@ class Game:
         self.show_minimap = True
         self.fog_of_war = True
         self.vision_map = np.zeros((self.grid_width, self.grid_height), dtype=bool)
-        self.terrain = self.generate_terrain()
-        self.particles = []
+        # Исследованные области
+        self.explored = np.zeros((self.grid_width, self.grid_height), dtype=bool)
+        # Сколько источников зрения видит каждую клетку; vision_map = observer_count > 0
+        self.observer_count = np.zeros((self.grid_width, self.grid_height), dtype=np.int32)
+        # Ключ источника (см. vision_key или 'base') -> (клетка x, клетка y, радиус)
+        self.vision_sources = {}
+        self.vision_dirty = False
+        self.vision_version = 0  # Растет при каждом изменении vision_map
+        # Прямоугольники клеток (x0, y0, x1, y1), где менялась видимость; их забирает отрисовка
+        self.vision_changes = []
+        # Сетка занятости клеток зданиями (CELL_FREE / CELL_RESERVED / CELL_BUILDING)
+        self.building_grid = np.zeros((self.grid_width, self.grid_height), dtype=np.uint8)
+        self.path_costs = None  # Стоимость прохода клеток для A*, строится лениво
+        self.flow_fields = OrderedDict()  # Клетка цели -> FlowField
+        self.path_cache = PathCache()
+        self.terrain = self.generate_terrain(seed)
+        # Классы местности и множители скорости считаем один раз
+        self.terrain_class = self.classify_terrain(self.terrain)
+        self.terrain_speed = TERRAIN_SPEED[self.terrain_class]
+        self.terrain_speed_rows = self.terrain_speed.tolist()
+        self.particles = ParticlePool(seed=rng_seed)
         self.generate_resources()
         
         # Создаем начальные базы
@@ -150,44 +1065,51 @@ class Game:
             self.create_unit('enemy', UnitType.WARRIOR)
         for _ in range(2):
             self.create_unit('enemy', UnitType.WORKER)
-            
-        # Создаем начальные здания
-        self.player_buildings.append(self.player_base)
-        self.enemy_buildings.append(self.enemy_base)
         
-        # Исследованные области
-        self.explored = np.zeros((self.grid_width, self.grid_height), dtype=bool)
+        # База видит далеко даже во время постройки
+        self.add_vision_source('base', self.player_base['x'], self.player_base['y'], BASE_VISION_RANGE)
+        self.update_vision()
+        
+    def generate_terrain(self, seed=None):
+        # Без зерна получается классическая карта; зерно сдвигает фазы октав
+        rng = np.random.default_rng(seed) if seed is not None else None
         
-    def generate_terrain(self):
+        # Генерация шума Перлина для рельефа сразу по всей сетке
+        nx, ny = np.meshgrid(np.arange(self.grid_width) / self.grid_width,
+                             np.arange(self.grid_height) / self.grid_height,
+                             indexing='ij')
         terrain = np.zeros((self.grid_width, self.grid_height))
+        scale = 1.0
+        weight = 1.0
         
-        # Генерация шума Перлина для рельефа
-        for x in range(self.grid_width):
-            for y in range(self.grid_height):
-                value = 0
-                scale = 1.0
-                weight = 1.0
-                
-                for _ in range(4):
-                    nx = x / self.grid_width * scale
-                    ny = y / self.grid_height * scale
-                    value += weight * noise(nx, ny)
-                    scale *= 2.0
-                    weight *= 0.5
-                
-                terrain[x, y] = value
+        for _ in range(4):
+            offset_x, offset_y = rng.uniform(0, 2 * math.pi, 2) if rng is not None else (0.0, 0.0)
+            terrain += weight * noise(nx * scale + offset_x, ny * scale + offset_y)
+            scale *= 2.0
+            weight *= 0.5
         
         # Нормализация
         terrain = (terrain - terrain.min()) / (terrain.max() - terrain.min())
         return terrain
     
+    def classify_terrain(self, terrain):
+        classes = np.full(terrain.shape, TERRAIN_PLAIN, dtype=np.uint8)
+        classes[terrain < 0.7] = TERRAIN_FOREST
+        classes[terrain < 0.4] = TERRAIN_SWAMP
+        classes[terrain < 0.3] = TERRAIN_WATER
+        classes[terrain > 0.8] = TERRAIN_MOUNTAIN
+        return classes
+    
     def generate_resources(self):
+        # На больших картах ресурсов пропорционально больше
+        density = max(1.0, (self.grid_width * self.grid_height) / (MAP_WIDTH * MAP_HEIGHT))
+        
         # Генерация золота
-        for _ in range(15):
-            x = random.randint(0, self.grid_width-1)
-            y = random.randint(0, self.grid_height-1)
-            if self.get_terrain_at(x, y) > 0.4:  # Не в воде
-                amount = random.randint(500, 1500)
+        for _ in range(int(15 * density)):
+            x = self.random.randint(0, self.grid_width-1)
+            y = self.random.randint(0, self.grid_height-1)
+            if self.terrain_class[x, y] >= TERRAIN_FOREST:  # Не в воде
+                amount = self.random.randint(500, 1500)
                 self.resources.append({
                     'x': x,
                     'y': y,
@@ -197,11 +1119,11 @@ class Game:
                 })
         
         # Генерация камня
-        for _ in range(20):
-            x = random.randint(0, self.grid_width-1)
-            y = random.randint(0, self.grid_height-1)
-            if self.get_terrain_at(x, y) > 0.8:  # В горах
-                amount = random.randint(300, 1000)
+        for _ in range(int(20 * density)):
+            x = self.random.randint(0, self.grid_width-1)
+            y = self.random.randint(0, self.grid_height-1)
+            if self.terrain_class[x, y] == TERRAIN_MOUNTAIN:  # В горах
+                amount = self.random.randint(300, 1000)
                 self.resources.append({
                     'x': x,
                     'y': y,
@@ -211,11 +1133,11 @@ class Game:
                 })
         
         # Генерация дерева
-        for _ in range(30):
-            x = random.randint(0, self.grid_width-1)
-            y = random.randint(0, self.grid_height-1)
-            if 0.4 < self.get_terrain_at(x, y) < 0.7:  # В лесу
-                amount = random.randint(200, 800)
+        for _ in range(int(30 * density)):
+            x = self.random.randint(0, self.grid_width-1)
+            y = self.random.randint(0, self.grid_height-1)
+            if self.terrain_class[x, y] == TERRAIN_FOREST:  # В лесу
+                amount = self.random.randint(200, 800)
                 self.resources.append({
                     'x': x,
                     'y': y,
@@ -224,125 +1146,28 @@ class Game:
                     'color': WOOD
                 })
     
-    def get_terrain_at(self, x, y):
-        if 0 <= x < self.grid_width and 0 <= y < self.grid_height:
-            return self.terrain[int(x), int(y)]
-        return 0
-    
     def get_terrain_multiplier(self, x, y):
-        terrain = self.get_terrain_at(x, y)
-        if terrain < 0.3:  # Вода
-            return 0.3
-        elif terrain < 0.4:  # Болото
-            return 0.6
-        elif terrain > 0.8:  # Горы
-            return 0.7
-        return 1.0  # Равнина
+        if 0 <= x < self.grid_width and 0 <= y < self.grid_height:
+            return self.terrain_speed_rows[int(x)][int(y)]
+        return TERRAIN_SPEED[TERRAIN_WATER]  # За краем карты - как вода
     
     def get_unit_stats(self, unit_type):
-        stats = {
-            UnitType.WARRIOR: {
-                'health': 25, 'damage': 4, 'speed': 0.6, 'range': 1, 
-                'cost': {'gold': 25, 'wood': 10}, 'color': GREEN, 'build_time': 30
-            },
-            UnitType.ARCHER: {
-                'health': 20, 'damage': 3, 'speed': 0.6, 'range': 6, 
-                'cost': {'gold': 30, 'wood': 15}, 'color': BLUE, 'build_time': 40
-            },
-            UnitType.CAVALRY: {
-                'health': 35, 'damage': 6, 'speed': 1.2, 'range': 1, 
-                'cost': {'gold': 45, 'wood': 20}, 'color': PURPLE, 'build_time': 50
-            },
-            UnitType.HEALER: {
-                'health': 22, 'damage': 0, 'speed': 0.6, 'range': 5, 
-                'cost': {'gold': 35, 'wood': 15}, 'color': ORANGE, 'build_time': 45, 
-                'heal_amount': 3
-            },
-            UnitType.SIEGE: {
-                'health': 40, 'damage': 10, 'speed': 0.4, 'range': 8, 
-                'cost': {'gold': 60, 'wood': 30, 'stone': 20}, 'color': BROWN, 
-                'build_time': 70, 'bonus_vs_buildings': 2.0
-            },
-            UnitType.SCOUT: {
-                'health': 15, 'damage': 2, 'speed': 1.5, 'range': 4, 
-                'cost': {'gold': 20, 'wood': 5}, 'color': YELLOW, 'build_time': 25, 
-                'vision_range': 8
-            },
-            UnitType.WORKER: {
-                'health': 15, 'damage': 1, 'speed': 0.8, 'range': 1, 
-                'cost': {'gold': 20, 'food': 10}, 'color': CYAN, 'build_time': 25,
-                'gather_rate': {'gold': 1, 'stone': 0.5, 'wood': 1, 'food': 1},
-                'build_range': 2,
-                'carry_capacity': 20
-            },
-            UnitType.MINER: {
-                'health': 18, 'damage': 1, 'speed': 0.6, 'range': 1, 
-                'cost': {'gold': 25, 'food': 10}, 'color': SILVER, 'build_time': 30,
-                'gather_rate': {'gold': 2, 'stone': 1, 'wood': 0.2, 'food': 0.2},
-                'build_range': 2,
-                'carry_capacity': 30
-            },
-            UnitType.LUMBERJACK: {
-                'health': 18, 'damage': 1, 'speed': 0.6, 'range': 1, 
-                'cost': {'gold': 25, 'food': 10}, 'color': WOOD, 'build_time': 30,
-                'gather_rate': {'gold': 0.2, 'stone': 0.2, 'wood': 2, 'food': 0.5},
-                'build_range': 2,
-                'carry_capacity': 30
-            }
-        }
-        return stats.get(unit_type)
+        return UNIT_STATS[unit_type.value]
     
     def get_building_stats(self, building_type):
-        stats = {
-            BuildingType.BARRACKS: {
-                'health': 200, 'cost': {'gold': 100, 'wood': 50}, 'size': 3, 
-                'color': DARK_GREEN, 'build_time': 100, 'produces': UnitType.WARRIOR
-            },
-            BuildingType.ARCHERY: {
-                'health': 180, 'cost': {'gold': 120, 'wood': 80}, 'size': 3, 
-                'color': DARK_BLUE, 'build_time': 120, 'produces': UnitType.ARCHER
-            },
-            BuildingType.STABLE: {
-                'health': 220, 'cost': {'gold': 150, 'wood': 100}, 'size': 3, 
-                'color': PURPLE, 'build_time': 140, 'produces': UnitType.CAVALRY
-            },
-            BuildingType.TEMPLE: {
-                'health': 180, 'cost': {'gold': 130, 'wood': 60}, 'size': 3, 
-                'color': ORANGE, 'build_time': 130, 'produces': UnitType.HEALER
-            },
-            BuildingType.SIEGE_WORKSHOP: {
-                'health': 200, 'cost': {'gold': 160, 'wood': 100, 'stone': 50}, 'size': 4, 
-                'color': BROWN, 'build_time': 150, 'produces': UnitType.SIEGE
-            },
-            BuildingType.WALL: {
-                'health': 250, 'cost': {'gold': 50, 'stone': 30}, 'size': 1, 
-                'color': GRAY, 'build_time': 60
-            },
-            BuildingType.TOWER: {
-                'health': 180, 'cost': {'gold': 80, 'stone': 50}, 'size': 2, 
-                'color': DARK_RED, 'build_time': 90, 'damage': 5, 'range': 7
-            },
-            BuildingType.TOWN_HALL: {
-                'health': 500, 'cost': {'gold': 200, 'wood': 150, 'stone': 100}, 'size': 4, 
-                'color': CYAN, 'build_time': 200, 'produces': UnitType.WORKER,
-                'income': {'gold': 5, 'food': 3}
-            },
-            BuildingType.MINE: {
-                'health': 150, 'cost': {'gold': 100, 'wood': 50, 'stone': 30}, 'size': 3, 
-                'color': SILVER, 'build_time': 120, 'produces': UnitType.MINER,
-                'income': {'gold': 2, 'stone': 1}
-            },
-            BuildingType.LUMBER_MILL: {
-                'health': 150, 'cost': {'gold': 100, 'wood': 80}, 'size': 3, 
-                'color': WOOD, 'build_time': 120, 'produces': UnitType.LUMBERJACK,
-                'income': {'wood': 3}
-            },
-            BuildingType.FARM: {
-                'health': 120, 'cost': {'gold': 80, 'wood': 40}, 'size': 3, 
-                'color': GREEN, 'build_time': 90, 'income': {'food': 5}
-            }
-        }
-        return stats.get(building_type)
+        return BUILDING_STATS[building_type.value]
+    
+    def unit_kind(self, side, unit_type):
+        kind = self.unit_kinds.get((side, unit_type))
+        if kind is None:
+            kind = self.unit_kinds[(side, unit_type)] = UnitKind(unit_type, side, self.get_unit_stats(unit_type))
+        return kind
+    
+    def building_kind(self, building_type):
+        kind = self.building_kinds.get(building_type)
+        if kind is None:
+            kind = self.building_kinds[building_type] = BuildingKind(building_type, self.get_building_stats(building_type))
+        return kind
     
     def can_afford(self, side, cost_dict):
         resources = self.player_resources if side == 'player' else self.enemy_resources
@@ -366,8 +1191,8 @@ class Game:
                 # Ищем свободное место вокруг базы
                 base = self.player_base
                 for attempt in range(10):
-                    angle = random.uniform(0, 2 * math.pi)
-                    distance = random.uniform(2, 4)
+                    angle = self.random.uniform(0, 2 * math.pi)
+                    distance = self.random.uniform(2, 4)
                     x = base['x'] + math.cos(angle) * distance
                     y = base['y'] + math.sin(angle) * distance
                     
@@ -376,39 +1201,31 @@ class Game:
                         not self.is_position_blocked(x, y)):
                         break
             
-            unit = {
+            unit = Unit(self.unit_store, self.unit_kind(side, unit_type), {
                 'x': x, 
                 'y': y,
+                'prev_x': x,
+                'prev_y': y,
                 'health': stats['health'],
                 'max_health': stats['health'],
                 'damage': stats['damage'],
                 'speed': stats['speed'] * self.game_speed,
                 'range': stats['range'],
                 'type': unit_type,
-                'color': stats['color'],
-                'target_x': None,
-                'target_y': None,
-                'attacking': False,
                 'cooldown': 0,
                 'build_progress': 0,
                 'build_time': stats.get('build_time', 0),
                 'side': side,
-                'heal_amount': stats.get('heal_amount', 0),
                 'bonus_vs_buildings': stats.get('bonus_vs_buildings', 1.0),
-                'vision_range': stats.get('vision_range', 5),
-                'building': True if stats.get('build_time', 0) > 0 else False,
-                'gathering': False,
-                'gather_target': None,
-                'gather_rate': stats.get('gather_rate', {}),
-                'carrying': {'gold': 0, 'stone': 0, 'wood': 0, 'food': 0},
-                'build_range': stats.get('build_range', 0),
-                'carry_capacity': stats.get('carry_capacity', 20),
-                'path': []
-            }
+                'attacking': False,
+                'gathering': False
+            })
             
             self.player_units.append(unit)
+            self.unit_index['player'].insert(unit)
             if unit['build_time'] <= 0:
-                BUILD_SOUND.play()
+                self.add_vision_source(vision_key('unit', unit), unit['x'], unit['y'], unit['vision_range'])
+                self.play_sound(BUILD_SOUND)
             self.spend_resources('player', stats['cost'])
             return unit
             
@@ -416,8 +1233,8 @@ class Game:
             if x is None or y is None:
                 base = self.enemy_base
                 for attempt in range(10):
-                    angle = random.uniform(0, 2 * math.pi)
-                    distance = random.uniform(2, 4)
+                    angle = self.random.uniform(0, 2 * math.pi)
+                    distance = self.random.uniform(2, 4)
                     x = base['x'] + math.cos(angle) * distance
                     y = base['y'] + math.sin(angle) * distance
                     
@@ -425,131 +1242,202 @@ class Game:
                         not self.is_position_blocked(x, y)):
                         break
             
-            unit = {
+            unit = Unit(self.unit_store, self.unit_kind(side, unit_type), {
                 'x': x, 
-                'y': y, 
+                'y': y,
+                'prev_x': x,
+                'prev_y': y,
                 'health': stats['health'],
                 'max_health': stats['health'],
                 'damage': stats['damage'],
                 'speed': stats['speed'] * self.game_speed,
                 'range': stats['range'],
                 'type': unit_type,
-                'color': YELLOW,
-                'target_x': None,
-                'target_y': None,
-                'attacking': False,
                 'cooldown': 0,
                 'build_progress': 0,
                 'build_time': stats.get('build_time', 0),
                 'side': side,
-                'heal_amount': stats.get('heal_amount', 0),
                 'bonus_vs_buildings': stats.get('bonus_vs_buildings', 1.0),
-                'vision_range': stats.get('vision_range', 5),
-                'building': True if stats.get('build_time', 0) > 0 else False,
-                'gathering': False,
-                'gather_target': None,
-                'gather_rate': stats.get('gather_rate', {}),
-                'carrying': {'gold': 0, 'stone': 0, 'wood': 0, 'food': 0},
-                'build_range': stats.get('build_range', 0),
-                'carry_capacity': stats.get('carry_capacity', 20),
-                'path': []
-            }
+                'attacking': False,
+                'gathering': False
+            })
             
             self.enemy_units.append(unit)
+            self.unit_index['enemy'].insert(unit)
             self.spend_resources('enemy', stats['cost'])
             return unit
             
         return False
     
     def is_position_blocked(self, x, y, ignore_unit=None):
-        # Проверяем здания
-        for building in self.player_buildings + self.enemy_buildings:
-            if building['build_progress'] >= building['build_time']:
-                dist = self.get_distance(x, y, building['x'], building['y'])
-                if dist < building['size'] / 2 + 0.5:
-                    return True
-        
-        # Проверяем юнитов
-        for unit in self.player_units + self.enemy_units:
-            if unit != ignore_unit and unit['build_progress'] >= unit['build_time']:
-                dist = self.get_distance(x, y, unit['x'], unit['y'])
-                if dist < 0.7:
-                    return True
-        
         # Проверяем границы карты
         if x < 0 or x >= self.grid_width or y < 0 or y >= self.grid_height:
             return True
+        
+        # Проверяем здания по сетке занятости
+        if self.building_grid[int(x), int(y)] == CELL_BUILDING:
+            return True
+        
+        # Проверяем юнитов (координаты и стройку читаем прямо из массивов хранилища)
+        store = self.unit_store
+        xs, ys = store.x, store.y
+        progress, build_time = store.build_progress, store.build_time
+        for index in self.unit_index.values():
+            for unit in index.nearby(x, y, UNIT_RADIUS):
+                slot = unit.slot
+                if (x - xs.item(slot))**2 + (y - ys.item(slot))**2 < UNIT_RADIUS * UNIT_RADIUS:
+                    if unit is not ignore_unit and progress.item(slot) >= build_time.item(slot):
+                        return True
             
         return False
     
+    def building_footprint(self, x, y, size):
+        """Прямоугольник клеток (x0, y0, x1, y1), занятых зданием; x1 и y1 не включаются"""
+        x0 = int(math.floor(x - size / 2 + 0.5))
+        y0 = int(math.floor(y - size / 2 + 0.5))
+        return x0, y0, x0 + size, y0 + size
+    
+    def can_place_building(self, size, x, y):
+        if (x - size/2 < 0 or x + size/2 >= self.grid_width or
+            y - size/2 < 0 or y + size/2 >= self.grid_height):
+            return False
+        
+        # Место вместе с зазором вокруг должно быть свободно
+        x0, y0, x1, y1 = self.building_footprint(x, y, size)
+        area = self.building_grid[max(0, x0 - BUILDING_SPACING):x1 + BUILDING_SPACING,
+                                  max(0, y0 - BUILDING_SPACING):y1 + BUILDING_SPACING]
+        return not area.any()
+    
+    def set_building_cells(self, building, state):
+        x0, y0, x1, y1 = self.building_footprint(building['x'], building['y'], building['size'])
+        x0 = max(0, x0)
+        y0 = max(0, y0)
+        x1 = min(self.grid_width, x1)
+        y1 = min(self.grid_height, y1)
+        area = self.building_grid[x0:x1, y0:y1]
+        # Проходимость меняется, только когда здание становится сплошным или исчезает
+        passability_changed = (state == CELL_BUILDING) != (area == CELL_BUILDING).any()
+        area[...] = state
+        
+        if passability_changed:
+            self.update_path_costs(x0, y0, x1, y1)
+            self.flow_fields.clear()
+            self.path_cache.invalidate_region(x0 - PATH_CACHE_MARGIN, y0 - PATH_CACHE_MARGIN,
+                                              x1 + PATH_CACHE_MARGIN, y1 + PATH_CACHE_MARGIN)
+    
+    def distance_to_building(self, x, y, building):
+        x0, y0, x1, y1 = self.building_footprint(building['x'], building['y'], building['size'])
+        dx = max(x0 - x, 0, x - x1)
+        dy = max(y0 - y, 0, y - y1)
+        return math.sqrt(dx*dx + dy*dy)
+    
     def create_building(self, side, building_type, x, y):
         stats = self.get_building_stats(building_type)
         if not stats or not self.can_afford(side, stats['cost']):
             return False
             
         # Проверяем, что место свободно
-        for building in self.player_buildings + self.enemy_buildings:
-            if self.get_distance(x, y, building['x'], building['y']) < max(stats['size'], building['size']) + 2:
-                return False
-        
-        if (x - stats['size']/2 < 0 or x + stats['size']/2 >= self.grid_width or
-            y - stats['size']/2 < 0 or y + stats['size']/2 >= self.grid_height):
+        if not self.can_place_building(stats['size'], x, y):
             return False
             
-        building = {
-            'x': x,
-            'y': y,
-            'health': stats['health'],
-            'max_health': stats['health'],
-            'size': stats['size'],
-            'type': building_type,
-            'color': stats['color'],
-            'build_progress': 0,
-            'build_time': stats['build_time'],
-            'side': side,
-            'produces': stats.get('produces'),
-            'cooldown': 0,
-            'damage': stats.get('damage', 0),
-            'range': stats.get('range', 0),
-            'income': stats.get('income', {})
-        }
+        building = Building(self.building_kind(building_type), side, x, y, stats['health'])
         
         if side == 'player':
             self.player_buildings.append(building)
         else:
             self.enemy_buildings.append(building)
+        self.building_index[side].insert(building)
+        self.set_building_cells(building, CELL_RESERVED)
             
         self.spend_resources(side, stats['cost'])
         return building
     
+    def destroy_building(self, building):
+        side = building['side']
+        buildings = self.player_buildings if side == 'player' else self.enemy_buildings
+        buildings.remove(building['handle'])
+        self.building_index[side].remove(building)
+        self.set_building_cells(building, CELL_FREE)
+        self.remove_vision_source(vision_key('building', building))
+        
+        if self.selected_building is building:
+            self.selected_building = None
+        
+        self.add_particles(building['x'], building['y'], 15, RED)
+        self.play_sound(DEATH_SOUND)
+    
+    def remove_destroyed_buildings(self):
+        # Разрушение баз обрабатывается как конец игры
+        for building in self.player_buildings + self.enemy_buildings:
+            if building['health'] <= 0 and not building.get('is_base'):
+                self.destroy_building(building)
+    
     def update_vision(self):
-        self.vision_map.fill(False)
+        # Карту видимости пересчитываем только если какой-то источник сменил клетку
+        if self.vision_dirty:
+            np.greater(self.observer_count, 0, out=self.vision_map)
+            self.vision_dirty = False
+            self.vision_version += 1
+    
+    def add_vision_source(self, key, x, y, radius):
+        cx = int(x)
+        cy = int(y)
+        self.vision_sources[key] = (cx, cy, radius)
+        self.stamp_vision(cx, cy, radius, 1)
+    
+    def remove_vision_source(self, key):
+        source = self.vision_sources.pop(key, None)
+        if source is not None:
+            self.stamp_vision(*source, -1)
+    
+    def move_vision_source(self, unit, x, y):
+        # Источники зрения есть только у юнитов игрока
+        if unit.kind.side != 'player':
+            return
+        key = vision_key('unit', unit)
+        source = self.vision_sources.get(key)
+        if source is None:
+            return
+        cx = int(x)
+        cy = int(y)
+        if (cx, cy) != source[:2]:
+            self.stamp_vision(*source, -1)
+            self.vision_sources[key] = (cx, cy, source[2])
+            self.stamp_vision(cx, cy, source[2], 1)
+    
+    def stamp_vision(self, cx, cy, radius, delta):
+        # Штампуем заранее посчитанную маску круга, обрезая ее по краям карты
+        x0 = max(0, cx - radius)
+        y0 = max(0, cy - radius)
+        x1 = min(self.grid_width, cx + radius + 1)
+        y1 = min(self.grid_height, cy + radius + 1)
+        if x0 >= x1 or y0 >= y1:
+            return
         
-        for building in self.player_buildings:
-            if building['build_progress'] >= building['build_time']:
-                vision_range = 6
-                self.update_vision_at(building['x'], building['y'], vision_range)
+        mask = disk_mask(radius)[x0 - (cx - radius):x1 - (cx - radius),
+                                 y0 - (cy - radius):y1 - (cy - radius)]
+        if delta > 0:
+            self.observer_count[x0:x1, y0:y1] += mask
+            self.explored[x0:x1, y0:y1] |= mask
+        else:
+            self.observer_count[x0:x1, y0:y1] -= mask
+        self.vision_dirty = True
         
-        for unit in self.player_units:
-            if unit['build_progress'] >= unit['build_time']:
-                self.update_vision_at(unit['x'], unit['y'], unit['vision_range'])
-        
-        base_vision = 10
-        self.update_vision_at(self.player_base['x'], self.player_base['y'], base_vision)
-
-    def update_vision_at(self, x, y, radius):
-        for dx in range(-radius, radius+1):
-            for dy in range(-radius, radius+1):
-                nx = int(max(0, min(self.grid_width-1, x + dx)))
-                ny = int(max(0, min(self.grid_height-1, y + dy)))
-                distance = math.sqrt(dx*dx + dy*dy)
-                if distance <= radius:
-                    self.vision_map[nx, ny] = True
-                    self.explored[nx, ny] = True
+        if len(self.vision_changes) >= VISION_CHANGES_LIMIT:
+            # Изменения давно не забирали (например, без окна) - хватит одного прямоугольника на всю карту
+            self.vision_changes = [(0, 0, self.grid_width, self.grid_height)]
+        self.vision_changes.append((x0, y0, x1, y1))
     
     def update(self):
         if self.game_over:
             return
+        
+        self.apply_commands()
+        
+        # Запоминаем позиции до хода, чтобы отрисовка могла сгладить движение
+        store = self.unit_store
+        store.prev_x[:store.size] = store.x[:store.size]
+        store.prev_y[:store.size] = store.y[:store.size]
             
         if self.fog_of_war:
             self.update_vision()
@@ -560,6 +1448,7 @@ class Game:
         self.fight()
         self.heal_units()
         self.update_buildings()
+        self.remove_destroyed_buildings()
         self.update_particles()
         
         # Пассивный доход от зданий
@@ -583,149 +1472,452 @@ class Game:
         # Проверка победы/поражения
         if self.player_base['health'] <= 0:
             self.game_over = "Поражение! Ваша база уничтожена."
-            DEFEAT_SOUND.play()
+            self.play_sound(DEFEAT_SOUND)
         elif self.enemy_base['health'] <= 0:
             self.game_over = "Победа! База врага уничтожена."
-            VICTORY_SOUND.play()
+            self.play_sound(VICTORY_SOUND)
+    
+    def queue_command(self, name, *args):
+        """Ставит приказ игрока в очередь; аргументы должны сохраняться в JSON"""
+        self.pending_commands.append((name, list(args)))
+    
+    def apply_commands(self):
+        commands = self.pending_commands
+        self.pending_commands = []
+        for name, args in commands:
+            self.command_log.append([self.turn, name, args])
+            self.apply_command(name, args)
+    
+    def apply_command(self, name, args):
+        if name == 'select':
+            start, end, camera = args
+            self.select_units(tuple(start), tuple(end), tuple(camera))
+        elif name == 'select_all':
+            self.selected_units = [u for u in self.player_units if u['build_progress'] >= u['build_time']]
+            self.selected_building = None
+            self.play_sound(SELECT_SOUND)
+        elif name == 'deselect':
+            self.selected_units = []
+            self.selected_building = None
+        elif name == 'order':
+            self.command_units(tuple(args[0]))
+        elif name == 'build':
+            self.build(BuildingType[args[0]], args[1], args[2])
+        elif name == 'train':
+            self.create_unit('player', UnitType[args[0]])
+        elif name == 'toggle_fog':
+            self.fog_of_war = not self.fog_of_war
+        else:
+            raise ValueError(f"Неизвестный приказ {name!r}")
+    
+    def state_digest(self):
+        """Контрольная сумма состояния симуляции для сравнения прогонов"""
+        selected_building = self.selected_building['handle'] if self.selected_building else None
+        digest = hashlib.sha1(repr((self.turn, self.game_over, self.fog_of_war,
+                                    sorted(self.player_resources.items()),
+                                    sorted(self.enemy_resources.items()),
+                                    list(self.selection), selected_building)).encode())
+        for unit in self.player_units + self.enemy_units:
+            # Скрытое состояние тоже считается: расхождение в нем проявится не сразу
+            digest.update(repr((unit['handle'], unit['type'].name, unit['x'], unit['y'],
+                                unit['health'], unit['cooldown'], unit['build_progress'],
+                                unit['attacking'], unit['gathering'], unit['gather_target'],
+                                sorted(unit['carrying'].items()), unit['target_x'], unit['target_y'],
+                                unit['flow_goal'], list(unit['path']))).encode())
+        for building in self.player_buildings + self.enemy_buildings:
+            digest.update(repr((building['handle'], building['type'].name, building['health'],
+                                building['build_progress'], building['cooldown'])).encode())
+        for resource in self.resources:
+            digest.update(repr((resource['handle'], resource['amount'])).encode())
+        return digest.hexdigest()[:16]
     
     def update_construction(self):
-        for unit in self.player_units[:] + self.enemy_units[:]:
-            if unit.get('building', False):
-                unit['build_progress'] += 1
-                if unit['build_progress'] >= unit['build_time']:
-                    unit['building'] = False
-                    if unit['side'] == 'player':
-                        BUILD_SOUND.play()
+        store = self.unit_store
+        n = store.size
+        progress = store.build_progress[:n]
+        building = store.alive[:n] & (progress < store.build_time[:n])
+        progress[building] += 1
+        
+        finished = building & (progress >= store.build_time[:n]) & (store.side[:n] == SIDE_PLAYER)
+        for slot in store.slots(finished):
+            unit = store.records[slot]
+            self.add_vision_source(vision_key('unit', unit), unit['x'], unit['y'], unit['vision_range'])
+            self.play_sound(BUILD_SOUND)
         
         for building in self.player_buildings + self.enemy_buildings:
             if building['build_progress'] < building['build_time']:
                 building['build_progress'] += 1
+                if building['build_progress'] >= building['build_time']:
+                    self.set_building_cells(building, CELL_BUILDING)
+                    if building['side'] == 'player':
+                        self.add_vision_source(vision_key('building', building), building['x'], building['y'],
+                                               BUILDING_VISION_RANGE)
     
     def gather_resources(self):
-        for unit in [u for u in self.player_units + self.enemy_units if u.get('gather_rate')]:
-            if unit['build_progress'] < unit['build_time']:
+        store = self.unit_store
+        progress, build_time, gathering, cooldown = store.build_progress, store.build_time, store.gathering, store.cooldown
+        for unit in [u for u in self.player_units + self.enemy_units if u.kind.gather_rate]:
+            # Числовые поля - из массивов хранилища, состояние и характеристики - атрибутами
+            slot = unit.slot
+            kind = unit.kind
+            if progress.item(slot) < build_time.item(slot):
                 continue
+            x = store.x.item(slot)
+            y = store.y.item(slot)
                 
-            if unit['gathering'] and unit['gather_target']:
-                resource = unit['gather_target']
-                
+            if gathering.item(slot) and unit.gather_target is not None:
                 # Проверяем, существует ли еще ресурс
-                if resource not in self.resources:
-                    unit['gathering'] = False
-                    unit['gather_target'] = None
+                resource = self.resources.get(unit.gather_target)
+                if resource is None:
+                    gathering[slot] = False
+                    unit.gather_target = None
                     continue
                     
-                distance = self.get_distance(unit['x'], unit['y'], resource['x'], resource['y'])
+                distance = self.get_distance(x, y, resource['x'], resource['y'])
                 
                 if distance > 1.5:  # Подходим к ресурсу
                     # Если нет пути или цель изменилась - пересчитываем путь
-                    if (not unit['path'] or 
-                        unit['target_x'] != resource['x'] or 
-                        unit['target_y'] != resource['y']):
-                        unit['target_x'] = resource['x']
-                        unit['target_y'] = resource['y']
-                        unit['attacking'] = False
-                        unit['path'] = self.find_path(unit['x'], unit['y'], resource['x'], resource['y'], unit)
+                    if ((not unit.path and unit.flow_goal is None) or 
+                        unit.target_x != resource['x'] or 
+                        unit.target_y != resource['y']):
+                        unit.target_x = resource['x']
+                        unit.target_y = resource['y']
+                        store.attacking[slot] = False
+                        unit.flow_goal = None
+                        unit.path = self.find_path(x, y, resource['x'], resource['y'], unit)
                 else:
                     # Собираем ресурс
-                    if unit['cooldown'] <= 0:
-                        gather_rate = unit['gather_rate']
+                    if cooldown.item(slot) <= 0:
                         gathered = False
                         
-                        for res_type, rate in gather_rate.items():
+                        for res_type, rate in kind.gather_rate.items():
                             if resource['type'].name.lower() == res_type and resource['amount'] > 0:
-                                can_carry = unit['carry_capacity'] - sum(unit['carrying'].values())
+                                can_carry = kind.carry_capacity - sum(unit.carrying.values())
                                 gather_amount = min(rate, resource['amount'], can_carry)
                                 
                                 if gather_amount > 0:
-                                    unit['carrying'][res_type] += gather_amount
+                                    unit.carrying[res_type] += gather_amount
                                     resource['amount'] -= gather_amount
                                     gathered = True
                                     
                                     self.add_particles(resource['x'], resource['y'], 2, resource['color'])
                                     
                                     if resource['amount'] <= 0:
-                                        if resource in self.resources:
-                                            self.resources.remove(resource)
-                                        unit['gather_target'] = None
-                                        unit['gathering'] = False
+                                        self.resources.remove(resource['handle'])
+                                        unit.gather_target = None
+                                        gathering[slot] = False
                                         break
                         
                         if gathered:
-                            unit['cooldown'] = 20
-                            RESOURCE_SOUND.play()
+                            cooldown[slot] = 20
+                            self.play_sound(RESOURCE_SOUND)
                     else:
-                        unit['cooldown'] -= 1
+                        cooldown[slot] -= 1
             else:
                 # Возвращаем ресурсы на базу, если есть что нести
-                if sum(unit['carrying'].values()) > 0:
-                    base = self.player_base if unit['side'] == 'player' else self.enemy_base
-                    distance = self.get_distance(unit['x'], unit['y'], base['x'], base['y'])
+                if sum(unit.carrying.values()) > 0:
+                    base = self.player_base if kind.side == 'player' else self.enemy_base
+                    distance = self.distance_to_building(x, y, base)
                     
-                    if distance > 2:  # Идем к базе
-                        if (not unit['path'] or 
-                            unit['target_x'] != base['x'] or 
-                            unit['target_y'] != base['y']):
-                            unit['target_x'] = base['x']
-                            unit['target_y'] = base['y']
-                            unit['attacking'] = False
-                            unit['path'] = self.find_path(unit['x'], unit['y'], base['x'], base['y'], unit)
+                    if distance > 1:  # Идем к базе
+                        if ((not unit.path and unit.flow_goal is None) or 
+                            unit.target_x != base['x'] or 
+                            unit.target_y != base['y']):
+                            unit.target_x = base['x']
+                            unit.target_y = base['y']
+                            store.attacking[slot] = False
+                            unit.flow_goal = None
+                            unit.path = self.find_path(x, y, base['x'], base['y'], unit)
                     else:
                         # Сдаем ресурсы
-                        resources = self.player_resources if unit['side'] == 'player' else self.enemy_resources
-                        for res_type, amount in unit['carrying'].items():
+                        resources = self.player_resources if kind.side == 'player' else self.enemy_resources
+                        for res_type, amount in unit.carrying.items():
                             resources[res_type] += amount
                         
-                        unit['carrying'] = {'gold': 0, 'stone': 0, 'wood': 0, 'food': 0}
-                        RESOURCE_SOUND.play()
+                        unit.carrying = {'gold': 0, 'stone': 0, 'wood': 0, 'food': 0}
+                        self.play_sound(RESOURCE_SOUND)
                         
                         # После сдачи ресурсов пытаемся вернуться к сбору, если была цель
-                        if unit['gather_target'] and unit['gather_target'] in self.resources:
-                            unit['path'] = self.find_path(unit['x'], unit['y'], 
-                                                        unit['gather_target']['x'], 
-                                                        unit['gather_target']['y'], unit)
+                        resource = self.resources.get(unit.gather_target)
+                        if resource is not None:
+                            unit.flow_goal = None
+                            unit.path = self.find_path(x, y, resource['x'], resource['y'], unit)
     
     def find_path(self, start_x, start_y, target_x, target_y, unit):
-        """Упрощенный алгоритм поиска пути"""
-        path = []
-        
-        # Простой алгоритм - двигаемся по прямой, обходя препятствия
-        dx = target_x - start_x
-        dy = target_y - start_y
-        distance = math.sqrt(dx*dx + dy*dy)
-        
-        if distance < 1:
+        """Поиск пути A* по сетке местности с учетом зданий и типа местности"""
+        if self.get_distance(start_x, start_y, target_x, target_y) < 1:
             return []
         
-        # Нормализуем направление
-        dx /= distance
-        dy /= distance
+        costs = self.get_path_costs()
+        start = (int(max(0, min(self.grid_width-1, start_x))),
+                 int(max(0, min(self.grid_height-1, start_y))))
+        goal = (int(max(0, min(self.grid_width-1, target_x))),
+                int(max(0, min(self.grid_height-1, target_y))))
         
-        # Пытаемся двигаться по прямой
-        steps = int(distance * 2)
-        last_valid = (start_x, start_y)
+        # Если цель внутри здания - идем к ближайшей свободной клетке рядом с ним
+        reachable_goal = goal
+        if costs[self.path_index(*goal)] is None:
+            reachable_goal = self.find_free_cell_near(goal[0], goal[1], start_x, start_y)
+            if reachable_goal is None:
+                return [(target_x, target_y)]
         
-        for i in range(1, steps + 1):
-            x = start_x + dx * i * 0.5
-            y = start_y + dy * i * 0.5
-            
-            if not self.is_position_blocked(x, y, unit):
-                last_valid = (x, y)
+        if reachable_goal == start:
+            return []
+        
+        key = (start, reachable_goal, MOVE_GROUND)
+        waypoints = self.path_cache.get(key)
+        if waypoints is None:
+            cells, complete = self.astar(start, reachable_goal)
+            waypoints = self.smooth_path(cells)[1:]
+            if complete:
+                xs = [cx for cx, _ in cells]
+                ys = [cy for _, cy in cells]
+                bounds = (min(xs), min(ys), max(xs), max(ys))
             else:
-                # Если встретили препятствие, пытаемся обойти
-                for angle in [math.pi/4, -math.pi/4, math.pi/2, -math.pi/2]:
-                    nx = last_valid[0] + math.cos(angle) * 0.5
-                    ny = last_valid[1] + math.sin(angle) * 0.5
-                    
-                    if not self.is_position_blocked(nx, ny, unit):
-                        path.append((nx, ny))
-                        last_valid = (nx, ny)
-                        break
+                # Частичный путь (или его отсутствие) зависит от всей исследованной области,
+                # поэтому он сбрасывается при любом изменении зданий на карте
+                bounds = (0, 0, self.grid_width - 1, self.grid_height - 1)
+            self.path_cache.put(key, waypoints, bounds)
+        
+        path = [(cx + 0.5, cy + 0.5) for cx, cy in waypoints]
+        if path and waypoints[-1] == reachable_goal and reachable_goal == goal:
+            path[-1] = (target_x, target_y)
+        return path
+    
+    def path_index(self, x, y):
+        # Сетка стоимостей окружена рамкой непроходимых клеток, чтобы не проверять границы
+        return (x + 1) * (self.grid_height + 2) + y + 1
+    
+    def get_path_costs(self):
+        """Плоский список стоимостей клеток (см. path_index), None - непроходимо"""
+        if self.path_costs is None:
+            costs = np.full((self.grid_width + 2, self.grid_height + 2), np.nan)
+            costs[1:-1, 1:-1] = np.where(self.building_grid == CELL_BUILDING, np.nan,
+                                         1.0 / self.terrain_speed)
+            self.path_costs = [None if c != c else c for c in costs.ravel().tolist()]
+        return self.path_costs
+    
+    def update_path_costs(self, x0, y0, x1, y1):
+        if self.path_costs is None:
+            return
+        stride = self.grid_height + 2
+        for x in range(x0, x1):
+            for y in range(y0, y1):
+                if self.building_grid[x, y] == CELL_BUILDING:
+                    self.path_costs[(x + 1) * stride + y + 1] = None
+                else:
+                    self.path_costs[(x + 1) * stride + y + 1] = 1.0 / self.terrain_speed_rows[x][y]
+    
+    def astar(self, start, goal):
+        """A* по 8 соседям; возвращает (клетки от start, дошел ли путь до goal).
+
+        Если цель недостижима или бюджет поиска исчерпан, путь ведет к раскрытой
+        клетке, ближайшей к цели по эвристике.
+        """
+        costs = self.get_path_costs()
+        stride = self.grid_height + 2
+        gx, gy = goal
+        start_index = self.path_index(*start)
+        goal_index = self.path_index(gx, gy)
+        diagonal_extra = SQRT2 - 2
+        
+        # Смещения соседей в плоском индексе и индексы двух ортогональных клеток для диагоналей
+        neighbors = [(dx * stride + dy, step, dx * stride, dy) for dx, dy, step in NEIGHBORS_8]
+        
+        g_score = {start_index: 0.0}
+        came_from = {}
+        closed = set()
+        counter = 0
+        dx = abs(start[0] - gx)
+        dy = abs(start[1] - gy)
+        best_h = dx + dy + diagonal_extra * min(dx, dy)
+        best_index = start_index
+        open_heap = [(best_h, counter, start_index)]
+        complete = False
+        
+        while open_heap and len(closed) < PATH_SEARCH_LIMIT:
+            current = heapq.heappop(open_heap)[2]
+            if current == goal_index:
+                best_index = current
+                complete = True
+                break
+            if current in closed:
+                continue
+            closed.add(current)
+            
+            dx = abs(current // stride - 1 - gx)
+            dy = abs(current % stride - 1 - gy)
+            h = dx + dy + diagonal_extra * (dx if dx < dy else dy)
+            if h < best_h:
+                best_h = h
+                best_index = current
+            
+            current_cost = costs[current]
+            if current_cost is None:
+                # Юнит стоит внутри здания - выпускаем его наружу
+                current_cost = 1.0
+            base_g = g_score[current]
+            
+            for offset, step, side_x, side_y in neighbors:
+                neighbor = current + offset
+                cost = costs[neighbor]
+                if cost is None or neighbor in closed:
+                    continue
+                # Не срезаем углы зданий по диагонали
+                if side_y and side_x and (costs[current + side_x] is None or costs[current + side_y] is None):
+                    continue
+                
+                tentative = base_g + step * (current_cost + cost) * 0.5
+                if tentative < g_score.get(neighbor, math.inf):
+                    g_score[neighbor] = tentative
+                    came_from[neighbor] = current
+                    dx = abs(neighbor // stride - 1 - gx)
+                    dy = abs(neighbor % stride - 1 - gy)
+                    counter += 1
+                    heapq.heappush(open_heap, (tentative + dx + dy + diagonal_extra * (dx if dx < dy else dy),
+                                               counter, neighbor))
+        
+        current = best_index
+        cells = []
+        while current != start_index:
+            cells.append((current // stride - 1, current % stride - 1))
+            current = came_from[current]
+        cells.append(start)
+        cells.reverse()
+        return cells, complete
+    
+    def smooth_path(self, cells):
+        """Выбрасывает промежуточные клетки, между которыми можно пройти по прямой"""
+        if len(cells) <= 2:
+            return cells
+        
+        smoothed = [cells[0]]
+        anchor = cells[0]
+        for i in range(2, len(cells)):
+            if not self.has_line_of_sight(anchor, cells[i]):
+                anchor = cells[i - 1]
+                smoothed.append(anchor)
+        smoothed.append(cells[-1])
+        return smoothed
+    
+    def has_line_of_sight(self, a, b):
+        """Прямая между центрами клеток не задевает здания и не заходит на более медленную местность"""
+        costs = self.get_path_costs()
+        ax, ay = a
+        bx, by = b
+        cost_a = costs[self.path_index(ax, ay)]
+        cost_b = costs[self.path_index(bx, by)]
+        if cost_a is None or cost_b is None:
+            return False
+        max_cost = max(cost_a, cost_b)
         
-        if last_valid != (target_x, target_y):
-            path.append((target_x, target_y))
+        steps = int(max(abs(bx - ax), abs(by - ay)) * 2)
+        for i in range(1, steps):
+            t = i / steps
+            cost = costs[self.path_index(int(ax + 0.5 + (bx - ax) * t), int(ay + 0.5 + (by - ay) * t))]
+            if cost is None or cost > max_cost:
+                return False
+        return True
+    
+    def find_free_cell_near(self, x, y, from_x, from_y):
+        """Ближайшая к (from_x, from_y) свободная клетка на первом кольце вокруг (x, y), где такие есть"""
+        costs = self.get_path_costs()
+        for radius in range(1, FREE_CELL_SEARCH_RADIUS + 1):
+            best = None
+            best_dist = math.inf
+            for nx in range(x - radius, x + radius + 1):
+                for ny in range(y - radius, y + radius + 1):
+                    if max(abs(nx - x), abs(ny - y)) != radius:
+                        continue
+                    if not (0 <= nx < self.grid_width and 0 <= ny < self.grid_height):
+                        continue
+                    if costs[self.path_index(nx, ny)] is None:
+                        continue
+                    dist = (nx + 0.5 - from_x)**2 + (ny + 0.5 - from_y)**2
+                    if dist < best_dist:
+                        best = (nx, ny)
+                        best_dist = dist
+            if best:
+                return best
+        return None
+    
+    def get_flow_field(self, goal):
+        """Поле потока к клетке goal (из кэша или заново)"""
+        field = self.flow_fields.get(goal)
+        if field is not None:
+            self.flow_fields.move_to_end(goal)
+            return field
+        
+        costs = self.get_path_costs()
+        gx, gy = goal
+        if costs[self.path_index(gx, gy)] is not None:
+            seeds = [self.path_index(gx, gy)]
+        else:
+            # Цель занята зданием - течем к любой свободной клетке ближайшего кольца вокруг него
+            seeds = []
+            for radius in range(1, FREE_CELL_SEARCH_RADIUS + 1):
+                for nx in range(gx - radius, gx + radius + 1):
+                    for ny in range(gy - radius, gy + radius + 1):
+                        if (max(abs(nx - gx), abs(ny - gy)) == radius and
+                            0 <= nx < self.grid_width and 0 <= ny < self.grid_height and
+                            costs[self.path_index(nx, ny)] is not None):
+                            seeds.append(self.path_index(nx, ny))
+                if seeds:
+                    break
+        
+        field = FlowField(costs, self.grid_width, self.grid_height, seeds)
+        self.flow_fields[goal] = field
+        if len(self.flow_fields) > FLOW_FIELD_CACHE_SIZE:
+            self.flow_fields.popitem(last=False)
+        return field
+    
+    def order_group(self, units, goal_x, goal_y):
+        """Отправляет юнитов к общей точке: группе - одно поле потока, одиночкам - A*.
+
+        Конечные цели юнитов (target_x, target_y) уже выставлены и могут отличаться
+        от общей точки, например при построении в круг.
+        """
+        if len(units) >= FLOW_FIELD_MIN_GROUP:
+            goal = (int(max(0, min(self.grid_width-1, goal_x))),
+                    int(max(0, min(self.grid_height-1, goal_y))))
+            self.get_flow_field(goal)
+            for unit in units:
+                unit['path'] = []
+                unit['flow_goal'] = goal
+        else:
+            for unit in units:
+                unit['flow_goal'] = None
+                unit['path'] = self.find_path(unit['x'], unit['y'], unit['target_x'], unit['target_y'], unit)
+    
+    def follow_flow_field(self, unit, x, y, speed):
+        """Шаг по полю потока из (x, y); возвращает False, если юнит пришел и поле больше не нужно"""
+        # Юнит может появиться у самого края за пределами сетки
+        cx = int(max(0, min(self.grid_width-1, x)))
+        cy = int(max(0, min(self.grid_height-1, y)))
+        goal_x, goal_y = unit.flow_goal
+        if abs(cx - goal_x) <= FLOW_ARRIVAL_RADIUS and abs(cy - goal_y) <= FLOW_ARRIVAL_RADIUS:
+            return False
         
-        return path
+        dir_x, dir_y = self.get_flow_field(unit.flow_goal).direction_at(cx, cy)
+        if not dir_x and not dir_y:
+            # У цели или в недостижимой клетке - дальше обычный поиск пути
+            return False
+        
+        # Держим курс на центр следующей клетки, чтобы не цеплять углы
+        dx = cx + dir_x + 0.5 - x
+        dy = cy + dir_y + 0.5 - y
+        distance = math.sqrt(dx*dx + dy*dy)
+        speed *= self.get_terrain_multiplier(x, y)
+        dx = dx / distance * speed
+        dy = dy / distance * speed
+        
+        new_x = x + dx
+        new_y = y + dy
+        if not self.is_position_blocked(new_x, new_y, unit):
+            self.move_unit_to(unit, new_x, new_y)
+        else:
+            self.sidestep(unit, x, y, dx, dy)
+        return True
     
     def update_buildings(self):
         for building in self.player_buildings + self.enemy_buildings:
@@ -740,8 +1932,8 @@ class Game:
                 if self.can_afford(side, stats['cost']):
                     # Ищем свободное место вокруг здания
                     for attempt in range(10):
-                        angle = random.uniform(0, 2 * math.pi)
-                        distance = random.uniform(2, building['size'] + 2)
+                        angle = self.random.uniform(0, 2 * math.pi)
+                        distance = self.random.uniform(2, building['size'] + 2)
                         x = building['x'] + math.cos(angle) * distance
                         y = building['y'] + math.sin(angle) * distance
                         
@@ -749,12 +1941,7 @@ class Game:
                             not self.is_position_blocked(x, y)):
                             break
                     
-                    if side == 'player':
-                        self.create_unit('player', unit_type, x, y)
-                    else:
-                        unit = self.create_unit('enemy', unit_type, x, y)
-                        if unit and not unit.get('building', False):
-                            self.enemy_units.append(unit)
+                    self.create_unit(side, unit_type, x, y)
                     
                     building['cooldown'] = 100
                 else:
@@ -766,44 +1953,24 @@ class Game:
             if building['build_progress'] >= building['build_time'] and building.get('damage', 0) > 0:
                 if building['cooldown'] <= 0:
                     if building['side'] == 'player':
-                        target = self.find_nearest_enemy(building['x'], building['y'])
+                        target = self.find_nearest_enemy(building['x'], building['y'], building['range'])
                     else:
-                        target = self.find_nearest_player(building['x'], building['y'])
+                        target = self.find_nearest_player(building['x'], building['y'], building['range'])
                     
-                    if target and self.get_distance(building['x'], building['y'], target['x'], target['y']) <= building['range']:
-                        if isinstance(target, dict):
-                            target['health'] -= building['damage']
-                        else:
-                            target['health'] -= building['damage'] * 0.5
+                    if target:
+                        target['health'] -= building['damage']
                         
                         self.add_particles(target['x'], target['y'], 5, RED)
-                        ATTACK_SOUND.play()
+                        self.play_sound(ATTACK_SOUND)
                         building['cooldown'] = 30
                 else:
                     building['cooldown'] -= 1
     
     def update_particles(self):
-        for particle in self.particles[:]:
-            particle['x'] += particle['dx']
-            particle['y'] += particle['dy']
-            particle['life'] -= 1
-            
-            if particle['life'] <= 0:
-                self.particles.remove(particle)
+        self.particles.update()
     
     def add_particles(self, x, y, count, color):
-        for _ in range(count):
-            angle = random.uniform(0, 2 * math.pi)
-            speed = random.uniform(0.1, 0.5)
-            self.particles.append({
-                'x': x,
-                'y': y,
-                'dx': math.cos(angle) * speed,
-                'dy': math.sin(angle) * speed,
-                'life': random.randint(10, 30),
-                'color': color,
-                'size': random.randint(1, 3)
-            })
+        self.particles.add(x, y, count, color)
     
     def enemy_ai(self):
         # Увеличиваем ресурсы врага
@@ -819,20 +1986,25 @@ class Game:
         if len(self.enemy_buildings) < 5 + self.turn // 100:
             building_choices = []
             
-            if len([u for u in self.enemy_units if u['type'] == UnitType.WARRIOR]) < 5:
+            # Состав армии считаем по массивам хранилища
+            store = self.unit_store
+            n = store.size
+            counts = np.bincount(store.type[:n][store.alive[:n] & (store.side[:n] == SIDE_ENEMY)],
+                                 minlength=len(UnitType) + 1)
+            if counts[UnitType.WARRIOR.value] < 5:
                 building_choices.append(BuildingType.BARRACKS)
-            if len([u for u in self.enemy_units if u['type'] == UnitType.ARCHER]) < 3:
+            if counts[UnitType.ARCHER.value] < 3:
                 building_choices.append(BuildingType.ARCHERY)
-            if len([u for u in self.enemy_units if u['type'] == UnitType.CAVALRY]) < 2:
+            if counts[UnitType.CAVALRY.value] < 2:
                 building_choices.append(BuildingType.STABLE)
             
             if not building_choices:
                 building_choices = [BuildingType.BARRACKS, BuildingType.ARCHERY, BuildingType.STABLE, BuildingType.FARM]
             
-            building_type = random.choice(building_choices)
+            building_type = self.random.choice(building_choices)
             
-            x = self.enemy_base['x'] + random.randint(-8, 8)
-            y = self.enemy_base['y'] + random.randint(-8, 8)
+            x = self.enemy_base['x'] + self.random.randint(-8, 8)
+            y = self.enemy_base['y'] + self.random.randint(-8, 8)
             
             if 0 <= x < self.grid_width and 0 <= y < self.grid_height:
                 self.create_building('enemy', building_type, x, y)
@@ -847,187 +2019,328 @@ class Game:
                 stats = self.get_unit_stats(unit_type)
                 
                 if self.can_afford('enemy', stats['cost']):
-                    x = building['x'] + random.randint(-2, 2)
-                    y = building['y'] + random.randint(-2, 2)
-                    unit = self.create_unit('enemy', unit_type, x, y)
-                    if unit and not unit.get('building', False):
-                        self.enemy_units.append(unit)
+                    x = building['x'] + self.random.randint(-2, 2)
+                    y = building['y'] + self.random.randint(-2, 2)
+                    self.create_unit('enemy', unit_type, x, y)
         
         # 3. Отправляем юнитов в атаку или на сбор ресурсов
+        attackers = []
+        store = self.unit_store
         for unit in self.enemy_units:
-            if unit['build_progress'] < unit['build_time']:
+            slot = unit.slot
+            if store.build_progress.item(slot) < store.build_time.item(slot):
                 continue
                 
-            if random.random() < 0.2:  # 20% шанс начать сбор ресурсов
-                if unit.get('gather_rate') and not unit['gathering'] and sum(unit['carrying'].values()) < unit.get('carry_capacity', 20):
+            if self.random.random() < 0.2:  # 20% шанс начать сбор ресурсов
+                kind = unit.kind
+                if (kind.gather_rate and not store.gathering.item(slot) and
+                        sum(unit.carrying.values()) < kind.carry_capacity):
                     nearest_resource = None
                     min_dist = float('inf')
+                    x = store.x.item(slot)
+                    y = store.y.item(slot)
                     
                     for resource in self.resources:
-                        dist = self.get_distance(unit['x'], unit['y'], resource['x'], resource['y'])
+                        dist = self.get_distance(x, y, resource['x'], resource['y'])
                         if dist < min_dist:
-                            for res_type in unit['gather_rate']:
+                            for res_type in kind.gather_rate:
                                 if resource['type'].name.lower() == res_type:
                                     nearest_resource = resource
                                     min_dist = dist
                                     break
                     
                     if nearest_resource:
-                        unit['gather_target'] = nearest_resource
+                        unit.gather_target = nearest_resource['handle']
                         unit['gathering'] = True
                         unit['attacking'] = False
-            elif len(self.enemy_units) > 3 and random.random() < 0.7:  # 70% шанс начать атаку
+            elif len(self.enemy_units) > 3 and self.random.random() < 0.7:  # 70% шанс начать атаку
                 unit['target_x'] = self.player_base['x']
                 unit['target_y'] = self.player_base['y']
                 unit['attacking'] = True
-                unit['path'] = self.find_path(unit['x'], unit['y'], unit['target_x'], unit['target_y'], unit)
+                attackers.append(unit)
+        
+        # Вся волна идет по одному полю потока
+        if attackers:
+            self.order_group(attackers, self.player_base['x'], self.player_base['y'])
+    
+    def play_sound(self, sound):
+        if not self.headless:
+            sound.play()
     
     def get_distance(self, x1, y1, x2, y2):
         return math.sqrt((x2 - x1)**2 + (y2 - y1)**2)
     
     def move_units(self):
-        for unit in self.player_units + self.enemy_units:
-            if unit['build_progress'] < unit['build_time']:
-                continue
-                
-            if unit['cooldown'] > 0:
-                unit['cooldown'] -= 1
-                continue
-                
+        store = self.unit_store
+        n = store.size
+        ready = store.alive[:n] & (store.build_progress[:n] >= store.build_time[:n])
+        
+        # Перезарядка тикает у всех сразу; перезаряжающиеся юниты в этот ход стоят
+        cooldown = store.cooldown[:n]
+        cooling = ready & (cooldown > 0)
+        cooldown[cooling] -= 1
+        moving = ready & ~cooling
+        
+        # Координаты и скорость читаем прямо из массивов: за ход юнит сдвигается один раз
+        xs, ys, speeds = store.x, store.y, store.speed
+        side = store.side[:n]
+        for slot in store.slots(moving & (side == SIDE_PLAYER)) + store.slots(moving & (side == SIDE_ENEMY)):
+            unit = store.records[slot]
+            x = xs.item(slot)
+            y = ys.item(slot)
+            
             # Если есть путь - следуем по нему
-            if unit['path']:
-                next_point = unit['path'][0]
-                dx = next_point[0] - unit['x']
-                dy = next_point[1] - unit['y']
-                distance = self.get_distance(unit['x'], unit['y'], next_point[0], next_point[1])
+            if unit.path:
+                next_point = unit.path[0]
+                dx = next_point[0] - x
+                dy = next_point[1] - y
+                distance = self.get_distance(x, y, next_point[0], next_point[1])
                 
                 if distance < 0.3:
-                    unit['path'].pop(0)
+                    unit.path.pop(0)
                 else:
-                    speed = unit['speed'] * self.get_terrain_multiplier(unit['x'], unit['y'])
+                    speed = speeds.item(slot) * self.get_terrain_multiplier(x, y)
                     dx = dx / distance * speed
                     dy = dy / distance * speed
                     
-                    new_x = unit['x'] + dx
-                    new_y = unit['y'] + dy
+                    new_x = x + dx
+                    new_y = y + dy
                     
                     if not self.is_position_blocked(new_x, new_y, unit):
-                        unit['x'] = max(0, min(self.grid_width-1, new_x))
-                        unit['y'] = max(0, min(self.grid_height-1, new_y))
-                    else:
-                        # Если путь заблокирован, пробуем обойти
-                        unit['path'] = self.find_path(unit['x'], unit['y'], next_point[0], next_point[1], unit)
-                        if not unit['path'] and unit['target_x'] is not None:
-                            # Если не получается обойти, ищем новый путь к конечной точке
-                            unit['path'] = self.find_path(unit['x'], unit['y'], unit['target_x'], unit['target_y'], unit)
+                        self.move_unit_to(unit, new_x, new_y)
+                        unit.stuck = 0
+                    elif not self.sidestep(unit, x, y, dx, dy):
+                        # Путь перекрыт надолго - ищем новый путь к конечной точке
+                        unit.stuck += 1
+                        if unit.stuck >= REPATH_DELAY:
+                            unit.stuck = 0
+                            if unit.target_x is not None:
+                                unit.path = self.find_path(x, y, unit.target_x, unit.target_y, unit)
+                            else:
+                                unit.path = self.find_path(x, y, next_point[0], next_point[1], unit)
+            
+            # Групповой приказ - идем по полю потока
+            elif unit.flow_goal is not None and self.follow_flow_field(unit, x, y, speeds.item(slot)):
+                pass
             
             # Если пути нет, но есть целевая точка - идем к ней
-            elif unit['target_x'] is not None and unit['target_y'] is not None:
-                distance = self.get_distance(unit['x'], unit['y'], unit['target_x'], unit['target_y'])
+            elif unit.target_x is not None and unit.target_y is not None:
+                unit.flow_goal = None
+                distance = self.get_distance(x, y, unit.target_x, unit.target_y)
                 
                 if distance > 0.5:
                     # Если далеко - ищем путь
-                    unit['path'] = self.find_path(unit['x'], unit['y'], unit['target_x'], unit['target_y'], unit)
-                    if not unit['path']:
+                    unit.path = self.find_path(x, y, unit.target_x, unit.target_y, unit)
+                    if not unit.path:
                         # Если путь не найден, пробуем подойти ближе напрямую
-                        speed = unit['speed'] * self.get_terrain_multiplier(unit['x'], unit['y'])
-                        dx = (unit['target_x'] - unit['x']) / distance * speed
-                        dy = (unit['target_y'] - unit['y']) / distance * speed
+                        speed = speeds.item(slot) * self.get_terrain_multiplier(x, y)
+                        dx = (unit.target_x - x) / distance * speed
+                        dy = (unit.target_y - y) / distance * speed
                         
-                        new_x = unit['x'] + dx
-                        new_y = unit['y'] + dy
+                        new_x = x + dx
+                        new_y = y + dy
                         
                         if not self.is_position_blocked(new_x, new_y, unit):
-                            unit['x'] = max(0, min(self.grid_width-1, new_x))
-                            unit['y'] = max(0, min(self.grid_height-1, new_y))
+                            self.move_unit_to(unit, new_x, new_y)
                 else:
                     # Достигли цели
-                    unit['target_x'] = None
-                    unit['target_y'] = None
-                    unit['path'] = []
+                    unit.target_x = None
+                    unit.target_y = None
+                    unit.path = []
+    
+    def move_unit_to(self, unit, x, y):
+        x = max(0, min(self.grid_width-1, x))
+        y = max(0, min(self.grid_height-1, y))
+        store = self.unit_store
+        store.x[unit.slot] = x
+        store.y[unit.slot] = y
+        self.unit_index[unit.kind.side].move(unit.handle, x, y)
+        self.move_vision_source(unit, x, y)
+    
+    def sidestep(self, unit, x, y, dx, dy):
+        """Обход соседа: пробуем шагнуть из (x, y) под углом к направлению движения"""
+        for angle in (math.pi/4, -math.pi/4, math.pi/2, -math.pi/2):
+            cos_a = math.cos(angle)
+            sin_a = math.sin(angle)
+            new_x = x + dx * cos_a - dy * sin_a
+            new_y = y + dx * sin_a + dy * cos_a
+            if not self.is_position_blocked(new_x, new_y, unit):
+                self.move_unit_to(unit, new_x, new_y)
+                return True
+        return False
     
     def fight(self):
-        for e_unit in self.enemy_units[:]:
-            if e_unit['build_progress'] < e_unit['build_time']:
-                continue
-                
-            if e_unit['health'] <= 0:
-                self.enemy_units.remove(e_unit)
-                self.add_particles(e_unit['x'], e_unit['y'], 15, RED)
-                DEATH_SOUND.play()
-                continue
-                
-            if e_unit['cooldown'] > 0:
-                continue
-                
-            target = self.find_nearest_player(e_unit['x'], e_unit['y'])
+        if self.batch_combat:
+            self.fight_batch()
+            return
+        
+        store = self.unit_store
+        n = store.size
+        side = store.side[:n]
+        health = store.health[:n]
+        ready = store.alive[:n] & (store.build_progress[:n] >= store.build_time[:n])
+        
+        # Поля атакующих читаем прямо из массивов хранилища
+        xs, ys, ranges, damages, cooldown = store.x, store.y, store.range, store.damage, store.cooldown
+        
+        enemies = ready & (side == SIDE_ENEMY)
+        self.remove_dead_units(store.slots(enemies & (health <= 0)))
+        
+        for slot in store.slots(enemies & (health > 0) & (store.cooldown[:n] <= 0)):
+            e_unit = store.records[slot]
+            target = self.find_nearest_player(xs.item(slot), ys.item(slot), ranges.item(slot))
             if target:
-                distance = self.get_distance(e_unit['x'], e_unit['y'], target['x'], target['y'])
-                if distance <= e_unit['range']:
-                    damage = e_unit['damage']
-                    
-                    if isinstance(target, dict):
-                        if target.get('type') == UnitType.CAVALRY and e_unit.get('type') == UnitType.WARRIOR:
-                            damage *= 1.5
-                        target['health'] -= damage
-                    else:
-                        target['health'] -= damage * 0.5
-                    
-                    e_unit['cooldown'] = 25
-                    self.add_particles(target['x'], target['y'], 5, RED)
-                    ATTACK_SOUND.play()
+                damage = damages.item(slot) * damage_bonus(SIDE_ENEMY, e_unit.kind.type, target)
+                target['health'] -= damage
+                
+                cooldown[slot] = 25
+                self.add_particles(target['x'], target['y'], 5, RED)
+                self.play_sound(ATTACK_SOUND)
         
-        for p_unit in self.player_units[:]:
-            if p_unit['build_progress'] < p_unit['build_time']:
-                continue
+        # Урон от врагов уже нанесен: погибшие в этот ход юниты игрока убираются сразу
+        players = ready & (side == SIDE_PLAYER)
+        self.remove_dead_units(store.slots(players & (health <= 0)))
+        
+        for slot in store.slots(players & (health > 0) & (store.cooldown[:n] <= 0) & store.attacking[:n]):
+            p_unit = store.records[slot]
+            target = self.find_nearest_enemy(xs.item(slot), ys.item(slot), ranges.item(slot))
+            if target:
+                damage = damages.item(slot) * damage_bonus(SIDE_PLAYER, p_unit.kind.type, target)
+                target['health'] -= damage
                 
-            if p_unit['health'] <= 0:
-                self.player_units.remove(p_unit)
-                self.add_particles(p_unit['x'], p_unit['y'], 15, RED)
-                DEATH_SOUND.play()
+                cooldown[slot] = 25
+                self.add_particles(target['x'], target['y'], 5, RED)
+                self.play_sound(ATTACK_SOUND)
+    
+    def fight_batch(self):
+        """Бой за один проход: цели выбираются массивами, урон наносится одновременно.
+
+        Итог хода не зависит от порядка юнитов: каждый атакующий бьет ближайшую
+        цель, выбранную до нанесения урона, а погибшие убираются в конце.
+        """
+        store = self.unit_store
+        n = store.size
+        ready = store.alive[:n] & (store.build_progress[:n] >= store.build_time[:n])
+        self.remove_dead_units(store.slots(ready & (store.health[:n] <= 0)))
+        
+        ready = store.alive[:n] & (store.build_progress[:n] >= store.build_time[:n])
+        side = store.side[:n]
+        # Враги атакуют всегда, юниты игрока - только по приказу
+        attacking = ready & (store.cooldown[:n] <= 0) & ((side == SIDE_ENEMY) | store.attacking[:n])
+        
+        hits = []
+        for attacker_side in (SIDE_ENEMY, SIDE_PLAYER):
+            attackers = np.flatnonzero(attacking & (side == attacker_side))
+            if not len(attackers):
                 continue
-                
-            if p_unit['cooldown'] > 0:
+            target_side = 1 - attacker_side
+            targets = np.flatnonzero(ready & (side == target_side))
+            buildings = [b for b in (self.player_buildings if target_side == SIDE_PLAYER else self.enemy_buildings)
+                         if b['is_base'] or b['build_progress'] >= b['build_time']]
+            
+            # Юниты идут раньше зданий: при равном расстоянии, как и в fight, бьем юнита
+            tx = np.concatenate([store.x[targets], [b['x'] for b in buildings]])
+            ty = np.concatenate([store.y[targets], [b['y'] for b in buildings]])
+            ttype = np.concatenate([store.type[targets], np.full(len(buildings), TARGET_BUILDING, dtype=np.int8)])
+            
+            chosen = self.nearest_in_range(store.x[attackers], store.y[attackers], store.range[attackers], tx, ty)
+            found = chosen >= 0
+            attackers = attackers[found]
+            chosen = chosen[found]
+            if not len(attackers):
                 continue
-                
-            if p_unit['attacking']:
-                target = self.find_nearest_enemy(p_unit['x'], p_unit['y'])
-                if target:
-                    distance = self.get_distance(p_unit['x'], p_unit['y'], target['x'], target['y'])
-                    if distance <= p_unit['range']:
-                        damage = p_unit['damage']
-                        
-                        if isinstance(target, dict):
-                            if target.get('type') == UnitType.CAVALRY and p_unit.get('type') == UnitType.WARRIOR:
-                                damage *= 1.5
-                            elif target.get('type') == UnitType.ARCHER and p_unit.get('type') == UnitType.SCOUT:
-                                damage *= 1.3
-                            
-                            target['health'] -= damage
-                        else:
-                            damage *= p_unit.get('bonus_vs_buildings', 1.0)
-                            target['health'] -= damage
-                        
-                        p_unit['cooldown'] = 25
-                        self.add_particles(target['x'], target['y'], 5, RED)
-                        ATTACK_SOUND.play()
+            
+            damage = store.damage[attackers] * DAMAGE_BONUS_TABLE[attacker_side, store.type[attackers], ttype[chosen]]
+            total = np.zeros(len(tx))
+            np.add.at(total, chosen, damage)
+            store.cooldown[attackers] = 25
+            hits.append((targets, buildings, total, tx[chosen].tolist(), ty[chosen].tolist()))
+        
+        # Урон обеих сторон наносится только после того, как все выбрали цели
+        for targets, buildings, total, hit_x, hit_y in hits:
+            store.health[targets] -= total[:len(targets)]
+            for building, damage in zip(buildings, total[len(targets):].tolist()):
+                if damage:
+                    building['health'] -= damage
+            for x, y in zip(hit_x, hit_y):
+                self.add_particles(x, y, 5, RED)
+                self.play_sound(ATTACK_SOUND)
+        
+        self.remove_dead_units(store.slots(ready & (store.health[:n] <= 0)))
+    
+    def interpolated_positions(self, slots, alpha):
+        """Позиции юнитов между предыдущим и последним ходом (alpha от 0 до 1)"""
+        store = self.unit_store
+        xs = store.prev_x[slots] + (store.x[slots] - store.prev_x[slots]) * alpha
+        ys = store.prev_y[slots] + (store.y[slots] - store.prev_y[slots]) * alpha
+        return xs, ys
+    
+    def nearest_in_range(self, ax, ay, ranges, tx, ty):
+        """Для каждого атакующего - номер ближайшей цели в радиусе его атаки или -1"""
+        chosen = np.full(len(ax), -1, dtype=np.intp)
+        if not len(tx):
+            return chosen
+        
+        if len(ax) * len(tx) <= COMBAT_MATRIX_LIMIT:
+            groups = [(np.arange(len(ax)), np.arange(len(tx)))]
+        else:
+            # Большие армии режем на квадраты карты: каждому квадрату достаются
+            # только цели, до которых могут дотянуться его атакующие
+            cx = (ax // COMBAT_CHUNK_CELLS).astype(np.intp)
+            cy = (ay // COMBAT_CHUNK_CELLS).astype(np.intp)
+            _, chunk_of, counts = np.unique(cx * (self.grid_height + 1) + cy, return_inverse=True, return_counts=True)
+            order = np.argsort(chunk_of, kind='stable')
+            groups = []
+            for members in np.split(order, np.cumsum(counts)[:-1]):
+                reach = ranges[members].max()
+                x0, x1 = ax[members].min() - reach, ax[members].max() + reach
+                y0, y1 = ay[members].min() - reach, ay[members].max() + reach
+                groups.append((members, np.flatnonzero((tx >= x0) & (tx <= x1) & (ty >= y0) & (ty <= y1))))
+        
+        for members, near in groups:
+            if not len(near):
+                continue
+            dist2 = (ax[members, None] - tx[near])**2 + (ay[members, None] - ty[near])**2
+            best = dist2.argmin(axis=1)
+            in_range = dist2[np.arange(len(members)), best] <= ranges[members]**2
+            chosen[members[in_range]] = near[best[in_range]]
+        return chosen
+    
+    def remove_dead_units(self, slots):
+        if not slots:
+            return
+        for slot in slots:
+            unit = self.unit_store.records[slot]
+            self.unit_index[unit['side']].remove(unit)
+            self.remove_vision_source(vision_key('unit', unit))
+            self.add_particles(unit['x'], unit['y'], 15, RED)
+            self.play_sound(DEATH_SOUND)
+            unit.release()
+            (self.player_units if unit['side'] == 'player' else self.enemy_units).remove(unit['handle'])
     
     def heal_units(self):
-        for healer in [u for u in self.player_units if u['type'] == UnitType.HEALER]:
-            if healer['build_progress'] < healer['build_time']:
+        store = self.unit_store
+        for healer in [u for u in self.player_units if u.kind.type == UnitType.HEALER]:
+            slot = healer.slot
+            if store.build_progress.item(slot) < store.build_time.item(slot):
                 continue
                 
-            if healer['cooldown'] > 0:
+            if store.cooldown.item(slot) > 0:
                 continue
                 
             healed = False
-            for unit in self.player_units + self.player_buildings:
-                if unit != healer and unit['health'] < unit['max_health']:
-                    distance = self.get_distance(healer['x'], healer['y'], unit['x'], unit['y'])
-                    if distance <= healer['range']:
-                        heal_amount = healer['heal_amount']
+            hx = store.x.item(slot)
+            hy = store.y.item(slot)
+            heal_range = store.range.item(slot)
+            nearby = self.unit_index['player'].nearby(hx, hy, heal_range)
+            nearby += self.building_index['player'].nearby(hx, hy, heal_range)
+            for unit in nearby:
+                if unit is not healer and unit['health'] < unit['max_health']:
+                    distance = self.get_distance(hx, hy, unit['x'], unit['y'])
+                    if distance <= heal_range:
+                        heal_amount = healer.kind.heal_amount
                         
-                        if distance > healer['range'] / 2:
+                        if distance > heal_range / 2:
                             heal_amount *= 0.7
                         
                         unit['health'] = min(unit['max_health'], unit['health'] + heal_amount)
@@ -1037,53 +2350,61 @@ class Game:
             if healed:
                 healer['cooldown'] = 30
     
-    def find_nearest_enemy(self, x, y):
-        closest = None
-        min_dist = float('inf')
-        
-        for unit in self.enemy_units:
-            if unit['build_progress'] >= unit['build_time']:
-                dist = self.get_distance(x, y, unit['x'], unit['y'])
-                if dist < min_dist:
-                    min_dist = dist
-                    closest = unit
-        
-        for building in self.enemy_buildings:
-            if building['build_progress'] >= building['build_time']:
-                dist = self.get_distance(x, y, building['x'], building['y'])
-                if dist < min_dist:
-                    min_dist = dist
-                    closest = building
-        
-        base_dist = self.get_distance(x, y, self.enemy_base['x'], self.enemy_base['y'])
-        if base_dist < min_dist:
-            return self.enemy_base
-        
-        return closest
+    def find_nearest_enemy(self, x, y, max_range=math.inf):
+        return self.find_nearest_target('enemy', x, y, max_range)
     
-    def find_nearest_player(self, x, y):
-        closest = None
-        min_dist = float('inf')
-        
-        for unit in self.player_units:
-            if unit['build_progress'] >= unit['build_time']:
-                dist = self.get_distance(x, y, unit['x'], unit['y'])
-                if dist < min_dist:
-                    min_dist = dist
-                    closest = unit
-        
-        for building in self.player_buildings:
-            if building['build_progress'] >= building['build_time']:
-                dist = self.get_distance(x, y, building['x'], building['y'])
-                if dist < min_dist:
-                    min_dist = dist
-                    closest = building
-        
-        base_dist = self.get_distance(x, y, self.player_base['x'], self.player_base['y'])
-        if base_dist < min_dist:
-            return self.player_base
-        
-        return closest
+    def find_nearest_player(self, x, y, max_range=math.inf):
+        return self.find_nearest_target('player', x, y, max_range)
+    
+    def find_nearest_target(self, side, x, y, max_range=math.inf):
+        """Ближайший готовый юнит или здание стороны side (база - даже недостроенная)"""
+        # Пока юнитов немного, один проход по массивам хранилища дешевле обхода колец ячеек
+        if self.unit_store.size <= NEAREST_SCAN_LIMIT:
+            unit, unit_d2 = self.nearest_unit(side, x, y, max_range)
+        else:
+            unit, unit_d2 = self.unit_index[side].nearest(x, y, max_range, is_ready)
+        building, building_d2 = self.building_index[side].nearest(x, y, max_range, is_targetable_building)
+        # При равном расстоянии, как и раньше, предпочитаем юнита
+        return unit if unit_d2 <= building_d2 else building
+    
+    def nearest_unit(self, side, x, y, max_range=math.inf):
+        """Ближайший готовый юнит стороны side и квадрат расстояния до него (по массивам хранилища)"""
+        store = self.unit_store
+        n = store.size
+        if not n:
+            return None, math.inf
+        candidates = store.alive[:n] & (store.side[:n] == SIDES.index(side)) & (store.build_progress[:n] >= store.build_time[:n])
+        dist2 = np.where(candidates, (store.x[:n] - x)**2 + (store.y[:n] - y)**2, np.inf)
+        slot = int(dist2.argmin())
+        d2 = float(dist2[slot])
+        if d2 == math.inf or d2 > max_range * max_range:
+            return None, math.inf
+        return store.records[slot], d2
+    
+    def units_in_view(self, x0, y0, x1, y1):
+        """Слоты готовых юнитов в прямоугольнике, которые видно сквозь туман войны.
+
+        Кандидатов дают ячейки пространственного индекса, задевающие прямоугольник,
+        так что маски строятся только по их слотам, а не по всему хранилищу.
+        """
+        store = self.unit_store
+        slots = np.array([unit.slot for side in SIDES
+                          for bucket in self.unit_index[side].buckets_in_rect(x0, y0, x1, y1)
+                          for unit in bucket.values()], dtype=np.intp)
+        xs = store.x[slots]
+        ys = store.y[slots]
+        slots = slots[(store.build_progress[slots] >= store.build_time[slots]) &
+                      (xs >= x0) & (xs < x1) & (ys >= y0) & (ys < y1)]
+        # Сортируем, чтобы юниты рисовались в порядке хранилища, а не ячеек индекса
+        slots.sort()
+        
+        if self.fog_of_war and len(slots):
+            # Врагов показываем и на исследованных клетках, своих - только в зоне видимости
+            cx = store.x[slots].astype(np.intp)
+            cy = store.y[slots].astype(np.intp)
+            seen = self.vision_map[cx, cy] | ((store.side[slots] == SIDE_ENEMY) & self.explored[cx, cy])
+            slots = slots[seen]
+        return slots
     
     def find_nearest_resource(self, x, y, resource_type=None):
         closest = None
@@ -1098,15 +2419,26 @@ class Game:
         
         return closest
     
-    def select_units(self, start_pos, end_pos):
-        self.selected_units = []
+    @property
+    def selected_units(self):
+        """Выделенные юниты; хранятся хэндлами, поэтому погибшие выпадают сами"""
+        units = [self.player_units.get(handle) for handle in self.selection]
+        return [unit for unit in units if unit is not None]
+    
+    @selected_units.setter
+    def selected_units(self, units):
+        self.selection = [unit['handle'] for unit in units]
+    
+    def select_units(self, start_pos, end_pos, camera=None):
+        selected = []
         self.selected_building = None
         
-        # Учитываем смещение камеры и интерфейса
-        x1 = (start_pos[0] + self.camera_x // CELL_SIZE)
-        y1 = (start_pos[1] + (self.camera_y + UI_HEIGHT) // CELL_SIZE)
-        x2 = (end_pos[0] + self.camera_x // CELL_SIZE)
-        y2 = (end_pos[1] + (self.camera_y + UI_HEIGHT) // CELL_SIZE)
+        # Учитываем смещение камеры (на момент отдачи приказа) и интерфейса
+        camera_x, camera_y = camera if camera is not None else (self.camera_x, self.camera_y)
+        x1 = (start_pos[0] + camera_x // CELL_SIZE)
+        y1 = (start_pos[1] + (camera_y + UI_HEIGHT) // CELL_SIZE)
+        x2 = (end_pos[0] + camera_x // CELL_SIZE)
+        y2 = (end_pos[1] + (camera_y + UI_HEIGHT) // CELL_SIZE)
         
         left = min(x1, x2)
         right = max(x1, x2)
@@ -1117,9 +2449,10 @@ class Game:
             if not unit.get('building', False):
                 if (left <= unit['x'] <= right and 
                     top <= unit['y'] <= bottom):
-                    self.selected_units.append(unit)
+                    selected.append(unit)
+        self.selected_units = selected
         
-        if not self.selected_units:
+        if not selected:
             for building in self.player_buildings:
                 if building['build_progress'] >= building['build_time']:
                     building_left = building['x'] - building['size']/2
@@ -1133,7 +2466,7 @@ class Game:
                         break
         
         if self.selected_units or self.selected_building:
-            SELECT_SOUND.play()
+            self.play_sound(SELECT_SOUND)
     
     def command_units(self, target_pos):
         if not self.selected_units and not self.selected_building:
@@ -1165,24 +2498,25 @@ class Game:
                 break
         
         if target_resource:
-            for unit in valid_units:
-                if unit.get('gather_rate'):
-                    unit['gather_target'] = target_resource
-                    unit['gathering'] = True
-                    unit['attacking'] = False
-                    unit['target_x'] = target_resource['x']
-                    unit['target_y'] = target_resource['y']
-                    unit['path'] = self.find_path(unit['x'], unit['y'], 
-                                                target_resource['x'], 
-                                                target_resource['y'], unit)
+            gatherers = [u for u in valid_units if u.get('gather_rate')]
+            for unit in gatherers:
+                unit['gather_target'] = target_resource['handle']
+                unit['gathering'] = True
+                unit['attacking'] = False
+                unit['target_x'] = target_resource['x']
+                unit['target_y'] = target_resource['y']
+            self.order_group(gatherers, target_resource['x'], target_resource['y'])
             return
         
         # 2. Проверяем, не враг ли это
         target_enemy = None
-        for enemy in self.enemy_units + self.enemy_buildings:
-            if self.get_distance(enemy['x'], enemy['y'], x, y) < 2.0:
-                target_enemy = enemy
-                break
+        min_dist = 2.0
+        for index in (self.unit_index['enemy'], self.building_index['enemy']):
+            for enemy in index.nearby(x, y, min_dist):
+                dist = self.get_distance(enemy['x'], enemy['y'], x, y)
+                if dist < min_dist:
+                    target_enemy = enemy
+                    min_dist = dist
         
         if not target_enemy and self.get_distance(self.enemy_base['x'], self.enemy_base['y'], x, y) < 3.0:
             target_enemy = self.enemy_base
@@ -1194,9 +2528,7 @@ class Game:
                 unit['attacking'] = True
                 unit['gathering'] = False
                 unit['gather_target'] = None
-                unit['path'] = self.find_path(unit['x'], unit['y'], 
-                                            target_enemy['x'], 
-                                            target_enemy['y'], unit)
+            self.order_group(valid_units, target_enemy['x'], target_enemy['y'])
             return
         
         # 3. Если это точка на карте - двигаемся туда
@@ -1213,9 +2545,8 @@ class Game:
             unit['attacking'] = False
             unit['gathering'] = False
             unit['gather_target'] = None
-            unit['path'] = self.find_path(unit['x'], unit['y'], 
-                                        unit['target_x'], 
-                                        unit['target_y'], unit)
+        
+        self.order_group(valid_units, x, y)
 
     
     def build(self, building_type, x, y):
@@ -1223,20 +2554,16 @@ class Game:
         if not stats or not self.can_afford('player', stats['cost']):
             return False
         
-        for building in self.player_buildings + self.enemy_buildings:
-            if self.get_distance(x, y, building['x'], building['y']) < max(stats['size'], building['size']) + 2:
-                return False
-        
-        if (x - stats['size']/2 < 0 or x + stats['size']/2 >= self.grid_width or
-            y - stats['size']/2 < 0 or y + stats['size']/2 >= self.grid_height):
+        if not self.can_place_building(stats['size'], x, y):
             return False
         
         self.create_building('player', building_type, x, y)
-        BUILD_SOUND.play()
+        self.play_sound(BUILD_SOUND)
         return True
 
 def noise(x, y):
-    n = math.sin(x * 10 + y * 5) + math.sin(x * 5 + y * 10) * 0.5
+    # Работает и с числами, и с numpy-массивами координат
+    n = np.sin(x * 10 + y * 5) + np.sin(x * 5 + y * 10) * 0.5
     return n / 1.5
 
 def draw_rounded_rect(surface, color, rect, radius=5):
@@ -1254,7 +2581,373 @@ def draw_rounded_rect(surface, color, rect, radius=5):
     pygame.draw.rect(surface, color, (x + radius, y, w - 2*radius, h))
     pygame.draw.rect(surface, color, (x, y + radius, w, h - 2*radius))
 
-def main():
+class TerrainLayer:
+    """Местность с сеткой, заранее отрисованная в Surface.
+
+    Карта режется на тайлы TERRAIN_TILE_CELLS x TERRAIN_TILE_CELLS клеток, которые
+    рисуются один раз при первом показе, так что даже большие карты не требуют
+    одной гигантской поверхности. Каждый кадр - только несколько blit.
+    """
+    def __init__(self):
+        self.terrain_class = None
+        self.cell_colors = None
+        self.tiles = OrderedDict()
+    
+    def sync(self, game):
+        # Перерисовываем только если сменилась сама местность (например, после рестарта)
+        if self.terrain_class is game.terrain_class:
+            return
+        self.terrain_class = game.terrain_class
+        self.tiles.clear()
+        
+        width, height = game.terrain_class.shape
+        checker = np.add.outer(np.arange(width), np.arange(height)) % 2
+        self.cell_colors = np.array(TERRAIN_COLORS, dtype=np.uint8)[game.terrain_class, checker]
+    
+    def get_tile(self, tx, ty):
+        tile = self.tiles.get((tx, ty))
+        if tile is not None:
+            self.tiles.move_to_end((tx, ty))
+            return tile
+        
+        x0 = tx * TERRAIN_TILE_CELLS
+        y0 = ty * TERRAIN_TILE_CELLS
+        colors = self.cell_colors[x0:x0 + TERRAIN_TILE_CELLS, y0:y0 + TERRAIN_TILE_CELLS]
+        pixels = np.repeat(np.repeat(colors, CELL_SIZE, axis=0), CELL_SIZE, axis=1)
+        tile = pygame.surfarray.make_surface(pixels)
+        
+        # Сетка через каждые две клетки
+        tile_width, tile_height = tile.get_size()
+        for x in range(x0 + x0 % 2, x0 + colors.shape[0], 2):
+            sx = (x - x0) * CELL_SIZE
+            pygame.draw.line(tile, GRID_LINE_COLOR, (sx, 0), (sx, tile_height), 1)
+        for y in range(y0 + y0 % 2, y0 + colors.shape[1], 2):
+            sy = (y - y0) * CELL_SIZE
+            pygame.draw.line(tile, GRID_LINE_COLOR, (0, sy), (tile_width, sy), 1)
+        
+        self.tiles[(tx, ty)] = tile
+        if len(self.tiles) > TERRAIN_TILE_CACHE:
+            self.tiles.popitem(last=False)
+        return tile
+    
+    def draw(self, target, game):
+        self.sync(game)
+        view_width, view_height = target.get_size()
+        map_width = game.grid_width * CELL_SIZE
+        map_height = game.grid_height * CELL_SIZE
+        if game.camera_x < 0 or game.camera_y < 0 or \
+           game.camera_x + view_width > map_width or game.camera_y + view_height > map_height:
+            target.fill(BLACK)
+        
+        tile_pixels = TERRAIN_TILE_CELLS * CELL_SIZE
+        tx0 = max(0, int(game.camera_x // tile_pixels))
+        ty0 = max(0, int(game.camera_y // tile_pixels))
+        tx1 = min((game.grid_width - 1) // TERRAIN_TILE_CELLS, int((game.camera_x + view_width) // tile_pixels))
+        ty1 = min((game.grid_height - 1) // TERRAIN_TILE_CELLS, int((game.camera_y + view_height) // tile_pixels))
+        target.blits([(self.get_tile(tx, ty), (tx * tile_pixels - game.camera_x, ty * tile_pixels - game.camera_y))
+                      for tx in range(tx0, tx1 + 1) for ty in range(ty0, ty1 + 1)], False)
+
+class FogLayer:
+    """Туман войны как одна поверхность, которая вычитается из картинки (BLEND_RGB_SUB).
+
+    Строится из explored и vision_map через surfarray в разрешении клеток для
+    видимого окна и растягивается на CELL_SIZE. Пересобирается только когда
+    меняется видимость или окно камеры.
+    """
+    def __init__(self):
+        self.surface = None
+        self.key = None
+        self.vision_map = None
+    
+    def draw(self, target, game, x0, y0, x1, y1):
+        key = (game.vision_version, x0, y0, x1, y1)
+        if self.surface is None or key != self.key or self.vision_map is not game.vision_map:
+            self.key = key
+            self.vision_map = game.vision_map
+            if x0 >= x1 or y0 >= y1:
+                self.surface = None
+                return
+            
+            visible = game.vision_map[x0:x1, y0:y1]
+            explored = game.explored[x0:x1, y0:y1]
+            shade = np.where(visible, 0, np.where(explored, FOG_DIM, 255)).astype(np.uint8)
+            cells = pygame.surfarray.make_surface(np.repeat(shade[:, :, None], 3, axis=2))
+            self.surface = pygame.transform.scale(cells, ((x1 - x0) * CELL_SIZE, (y1 - y0) * CELL_SIZE))
+        
+        if self.surface is not None:
+            target.blit(self.surface, (x0 * CELL_SIZE - game.camera_x, y0 * CELL_SIZE - game.camera_y),
+                        special_flags=pygame.BLEND_RGB_SUB)
+
+class GlyphCache:
+    """LRU-кэш отрисованного текста по ключу (шрифт, строка, цвет)"""
+    def __init__(self, capacity=GLYPH_CACHE_SIZE):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+    
+    def render(self, font, text, color):
+        key = (font, text, color)
+        surface = self.entries.get(key)
+        if surface is not None:
+            self.entries.move_to_end(key)
+            return surface
+        
+        surface = font.render(text, True, color)
+        self.entries[key] = surface
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+        return surface
+
+class SpriteCache:
+    """LRU-кэш спрайтов юнитов и зданий.
+
+    Спрайт зависит только от типа, стороны, прозрачности и выделения, поэтому
+    каждый вариант рисуется один раз. У готовых зданий полоски здоровья рисуются
+    поверх отдельно, у полупрозрачных строящихся они входят в спрайт (ключ
+    дополняется их длиной в пикселях).
+    """
+    def __init__(self, glyphs, font, capacity=SPRITE_CACHE_SIZE):
+        self.glyphs = glyphs
+        self.font = font
+        self.capacity = capacity
+        self.entries = OrderedDict()
+    
+    def get(self, key, build):
+        sprite = self.entries.get(key)
+        if sprite is not None:
+            self.entries.move_to_end(key)
+            return sprite
+        
+        sprite = build()
+        self.entries[key] = sprite
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+        return sprite
+    
+    def unit(self, unit, selected):
+        key = (unit['type'], unit['side'], 255, selected)
+        return self.get(key, lambda: self.build_unit(unit, selected))
+    
+    def building(self, building, selected, bars=None):
+        alpha = 255 if bars is None else 128
+        key = (building['type'], building['side'], alpha, selected, bool(building.get('is_base')), bars)
+        return self.get(key, lambda: self.build_building(building, alpha, selected, bars))
+    
+    def placement(self, size, can_build):
+        key = ('placement', size, can_build)
+        return self.get(key, lambda: self.build_placement(size, can_build))
+    
+    def particle(self, color, size):
+        """Кружок частицы радиуса size"""
+        def build():
+            sprite = pygame.Surface((size * 2 + 1, size * 2 + 1), pygame.SRCALPHA)
+            pygame.draw.circle(sprite, color, (size, size), size)
+            return sprite
+        return self.get(('particle', color, size), build)
+    
+    def health_bar(self, width, height, filled, back=RED, front=GREEN):
+        """Полоска здоровья: фон back и заполненная на filled пикселей часть front"""
+        def build():
+            sprite = pygame.Surface((width, height))
+            sprite.fill(back)
+            if filled > 0:
+                sprite.fill(front, (0, 0, filled, height))
+            return sprite
+        return self.get(('health', width, height, filled, back, front), build)
+    
+    def build_unit(self, unit, selected):
+        # Спрайт на клетку больше тела, чтобы в него помещалась рамка выделения
+        size = CELL_SIZE - 2
+        sprite = pygame.Surface((CELL_SIZE, CELL_SIZE), pygame.SRCALPHA)
+        color = unit['color'] if unit['side'] == 'player' else YELLOW
+        pygame.draw.rect(sprite, color, (1, 1, size, size))
+        pygame.draw.rect(sprite, WHITE if unit['side'] == 'player' else BLACK, (1, 1, size, size), 1)
+        
+        text = self.glyphs.render(self.font, UNIT_SYMBOLS.get(unit['type'], ""),
+                                  WHITE if unit['side'] == 'player' else BLACK)
+        sprite.blit(text, text.get_rect(center=(CELL_SIZE // 2, CELL_SIZE // 2)))
+        
+        if selected:
+            pygame.draw.rect(sprite, BLUE, (0, 0, CELL_SIZE, CELL_SIZE), 2)
+        return sprite
+    
+    def build_building(self, building, alpha, selected, bars):
+        size = building['size'] * CELL_SIZE
+        if building['side'] == 'player':
+            color = (0, 200, 200) if building.get('is_base') else building['color']
+        else:
+            color = (200, 0, 0) if building.get('is_base') else (200, 100, 100)
+        
+        sprite = pygame.Surface((size, size), pygame.SRCALPHA)
+        pygame.draw.rect(sprite, (*color, alpha), (0, 0, size, size))
+        pygame.draw.rect(sprite, (200, 200, 200, alpha), (0, 0, size, size), 2)
+        if bars is not None:
+            progress_width, health_width = bars
+            pygame.draw.rect(sprite, (255, 255, 255, alpha), (0, 0, progress_width, 5))
+            pygame.draw.rect(sprite, (200, 0, 0, alpha), (0, size-5, size, 5))
+            pygame.draw.rect(sprite, (0, 200, 0, alpha), (0, size-5, health_width, 5))
+        if selected:
+            pygame.draw.rect(sprite, BLUE, (0, 0, size, size), 3)
+        return sprite
+    
+    def build_placement(self, size, can_build):
+        color = GREEN if can_build else RED
+        alpha = 100 if can_build else 70
+        sprite = pygame.Surface((size, size), pygame.SRCALPHA)
+        pygame.draw.rect(sprite, (*color, alpha), (0, 0, size, size))
+        pygame.draw.rect(sprite, (*WHITE, alpha), (0, 0, size, size), 2)
+        return sprite
+
+class MinimapLayer:
+    """Подложка миникарты (местность и туман), собранная из массивов numpy.
+
+    Клетка -> пиксель, затем одно масштабирование до MINIMAP_SIZE. Пересобирается
+    только при изменении видимости; юниты и здания рисуются поверх каждый кадр.
+    """
+    # [видна сейчас][суша]
+    PALETTE = np.array([[(0, 0, 80), (0, 80, 0)],
+                        [(0, 0, 150), (0, 150, 0)]], dtype=np.uint8)
+    
+    def __init__(self):
+        self.surface = None
+        self.version = None
+        self.vision_map = None
+    
+    def get_surface(self, game):
+        if self.surface is None or self.version != game.vision_version or self.vision_map is not game.vision_map:
+            self.version = game.vision_version
+            self.vision_map = game.vision_map
+            
+            land = (game.terrain_class >= TERRAIN_FOREST).astype(np.intp)
+            colors = self.PALETTE[game.vision_map.astype(np.intp), land]
+            colors[~game.explored] = 0
+            self.surface = pygame.transform.scale(pygame.surfarray.make_surface(colors),
+                                                  (MINIMAP_SIZE, MINIMAP_SIZE))
+        return self.surface
+
+class DirtyRects:
+    """Обновление экрана только в изменившихся областях (pygame.display.update(rects)).
+
+    Кадр по-прежнему целиком собирается в буфере экрана, но каждый нарисованный
+    элемент отмечается ключом (что и где нарисовано). На дисплей отправляются
+    только области элементов, которые появились или исчезли с прошлого кадра.
+    Смена сцены (камера, туман, оверлеи) требует полного обновления.
+    """
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.previous = {}
+        self.current = {}
+        self.extra = []
+        self.scene = None
+        self.full = True
+    
+    def begin(self, scene):
+        if scene != self.scene:
+            self.scene = scene
+            self.full = True
+    
+    def mark(self, key, rect):
+        self.current[key] = rect
+    
+    def add(self, rect):
+        self.extra.append(rect)
+    
+    def present(self):
+        if self.full or not self.enabled:
+            pygame.display.flip()
+        else:
+            rects = [rect for key, rect in self.current.items() if key not in self.previous]
+            rects.extend(rect for key, rect in self.previous.items() if key not in self.current)
+            rects.extend(self.extra)
+            if rects:
+                pygame.display.update(rects)
+        
+        self.previous = self.current
+        self.current = {}
+        self.extra = []
+        self.full = not self.enabled
+
+REPLAY_VERSION = 1
+
+def save_replay(game, path, seed, batch_combat):
+    """Записывает журнал приказов и итоговую контрольную сумму партии"""
+    replay = {
+        'version': REPLAY_VERSION,
+        'width': game.grid_width,
+        'height': game.grid_height,
+        'seed': seed,
+        'rng_seed': game.rng_seed,
+        'batch_combat': batch_combat,
+        'ticks': game.turn,
+        'digest': game.state_digest(),
+        'commands': game.command_log,
+    }
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(replay, f, ensure_ascii=False)
+    print(f"Запись партии ({len(game.command_log)} приказов, {game.turn} ходов) сохранена в {path}")
+
+def run_replay(path):
+    """Повторяет записанную партию без окна с максимальной скоростью и сверяет результат"""
+    with open(path, encoding='utf-8') as f:
+        replay = json.load(f)
+    if replay.get('version') != REPLAY_VERSION:
+        raise ValueError(f"{path}: неподдерживаемая версия записи {replay.get('version')!r}")
+    game = Game(headless=True, width=replay['width'], height=replay['height'], seed=replay['seed'],
+                batch_combat=replay['batch_combat'], rng_seed=replay['rng_seed'])
+    commands = replay['commands']
+    index = 0
+    
+    start = time.perf_counter()
+    while game.turn < replay['ticks'] and not game.game_over:
+        while index < len(commands) and commands[index][0] <= game.turn:
+            _, name, args = commands[index]
+            game.queue_command(name, *args)
+            index += 1
+        game.update()
+    elapsed = time.perf_counter() - start
+    
+    digest = game.state_digest()
+    print(f"Воспроизведено ходов: {game.turn} за {elapsed:.2f} с "
+          f"({game.turn / max(elapsed, 1e-9):.0f} ходов/с), приказов {index}")
+    if digest == replay['digest']:
+        print(f"Состояние совпадает с записью: {digest}")
+    else:
+        print(f"Расхождение с записью: {digest} вместо {replay['digest']}")
+    return digest == replay['digest']
+
+def run_headless(ticks, width=MAP_WIDTH, height=MAP_HEIGHT, seed=None, batch_combat=False, record=None):
+    """Прогон симуляции без окна и звука с максимальной скоростью"""
+    print(f"Характеристики загружены из {STATS_FILE} за {STATS_LOAD_TIME * 1000:.1f} мс")
+    start = time.perf_counter()
+    game = Game(headless=True, width=width, height=height, seed=seed, batch_combat=batch_combat)
+    print(f"Карта {width}x{height} создана за {time.perf_counter() - start:.2f} с")
+    
+    start = time.perf_counter()
+    for _ in range(ticks):
+        game.update()
+        if game.game_over:
+            break
+    elapsed = time.perf_counter() - start
+    
+    print(f"Ходов: {game.turn} за {elapsed:.2f} с ({game.turn / max(elapsed, 1e-9):.0f} ходов/с)")
+    print(f"Игрок: {len(game.player_units)} юнитов, {len(game.player_buildings)} зданий")
+    print(f"Враг: {len(game.enemy_units)} юнитов, {len(game.enemy_buildings)} зданий")
+    cache = game.path_cache.stats()
+    print(f"Кэш путей: {cache['size']}/{cache['capacity']}, попаданий {cache['hit_rate']:.0%} "
+          f"({cache['hits']}/{cache['hits'] + cache['misses']}), вытеснено {cache['evictions']}, "
+          f"сброшено {cache['invalidations']}")
+    print(f"Зерно случайности {game.rng_seed}, контрольная сумма {game.state_digest()}")
+    if game.game_over:
+        print(game.game_over)
+    if record:
+        save_replay(game, record, seed, batch_combat)
+    return game
+
+def main(width=MAP_WIDTH, height=MAP_HEIGHT, seed=None, dirty_rects=False, batch_combat=False, record=None,
+         max_fps=FPS):
+    print(f"Характеристики загружены из {STATS_FILE} за {STATS_LOAD_TIME * 1000:.1f} мс")
+    pygame.init()
+    init_audio()
+    
     screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT))
     pygame.display.set_caption("Epic Strategy Game")
     clock = pygame.time.Clock()
@@ -1262,29 +2955,46 @@ def main():
     small_font = pygame.font.SysFont('Arial', 14)
     big_font = pygame.font.SysFont('Arial', 48)
     
-    game = Game()
+    game = Game(width=width, height=height, seed=seed, batch_combat=batch_combat)
+    terrain_layer = TerrainLayer()
+    fog_layer = FogLayer()
+    minimap_layer = MinimapLayer()
+    glyphs = GlyphCache()
+    sprites = SpriteCache(glyphs, small_font)
+    game_surface = pygame.Surface((SCREEN_WIDTH, SCREEN_HEIGHT - UI_HEIGHT))
+    dirty = DirtyRects(dirty_rects)
+    panel_rect = pygame.Rect(0, 0, SCREEN_WIDTH, UI_HEIGHT)
+    field_rect = pygame.Rect(0, UI_HEIGHT, SCREEN_WIDTH, SCREEN_HEIGHT - UI_HEIGHT)
+    last_stats = None
     running = True
     selecting = False
     building_mode = None
     show_help = False
     
+    # Симуляция идет фиксированными ходами, отрисовка - с частотой экрана
+    tick_time = 1 / TICK_RATE
+    sim_speed = 1
+    accumulator = 0.0
+    alpha = 1.0
+    last_time = time.perf_counter()
+    
     buttons = [
-        {"rect": pygame.Rect(10, SCREEN_HEIGHT-110, 120, 30), "text": "Воин (25g,10w)", "type": UnitType.WARRIOR, "building": BuildingType.BARRACKS},
-        {"rect": pygame.Rect(140, SCREEN_HEIGHT-110, 120, 30), "text": "Лучник (30g,15w)", "type": UnitType.ARCHER, "building": BuildingType.ARCHERY},
-        {"rect": pygame.Rect(270, SCREEN_HEIGHT-110, 120, 30), "text": "Кавалерия (45g,20w)", "type": UnitType.CAVALRY, "building": BuildingType.STABLE},
-        {"rect": pygame.Rect(400, SCREEN_HEIGHT-110, 120, 30), "text": "Лекарь (35g,15w)", "type": UnitType.HEALER, "building": BuildingType.TEMPLE},
-        {"rect": pygame.Rect(530, SCREEN_HEIGHT-110, 120, 30), "text": "Осадное (60g,30w,20s)", "type": UnitType.SIEGE, "building": BuildingType.SIEGE_WORKSHOP},
-        {"rect": pygame.Rect(660, SCREEN_HEIGHT-110, 120, 30), "text": "Разведчик (20g,5w)", "type": UnitType.SCOUT},
-        {"rect": pygame.Rect(790, SCREEN_HEIGHT-110, 120, 30), "text": "Рабочий (20g,10f)", "type": UnitType.WORKER},
-        
-        {"rect": pygame.Rect(10, SCREEN_HEIGHT-70, 120, 30), "text": "Казармы (100g,50w)", "building_type": BuildingType.BARRACKS},
-        {"rect": pygame.Rect(140, SCREEN_HEIGHT-70, 120, 30), "text": "Тир (120g,80w)", "building_type": BuildingType.ARCHERY},
-        {"rect": pygame.Rect(270, SCREEN_HEIGHT-70, 120, 30), "text": "Конюшня (150g,100w)", "building_type": BuildingType.STABLE},
-        {"rect": pygame.Rect(400, SCREEN_HEIGHT-70, 120, 30), "text": "Храм (130g,60w)", "building_type": BuildingType.TEMPLE},
-        {"rect": pygame.Rect(530, SCREEN_HEIGHT-70, 120, 30), "text": "Мастерская (160g,100w,50s)", "building_type": BuildingType.SIEGE_WORKSHOP},
-        {"rect": pygame.Rect(660, SCREEN_HEIGHT-70, 120, 30), "text": "Башня (80g,50s)", "building_type": BuildingType.TOWER},
-        {"rect": pygame.Rect(790, SCREEN_HEIGHT-70, 120, 30), "text": "Стена (50g,30s)", "building_type": BuildingType.WALL},
-        {"rect": pygame.Rect(920, SCREEN_HEIGHT-70, 120, 30), "text": "Ферма (80g,40w)", "building_type": BuildingType.FARM},
+        {"rect": pygame.Rect(10, SCREEN_HEIGHT-110, 120, 30), "text": cost_label("Воин", UNIT_STATS[UnitType.WARRIOR.value]), "type": UnitType.WARRIOR, "building": BuildingType.BARRACKS},
+        {"rect": pygame.Rect(140, SCREEN_HEIGHT-110, 120, 30), "text": cost_label("Лучник", UNIT_STATS[UnitType.ARCHER.value]), "type": UnitType.ARCHER, "building": BuildingType.ARCHERY},
+        {"rect": pygame.Rect(270, SCREEN_HEIGHT-110, 120, 30), "text": cost_label("Кавалерия", UNIT_STATS[UnitType.CAVALRY.value]), "type": UnitType.CAVALRY, "building": BuildingType.STABLE},
+        {"rect": pygame.Rect(400, SCREEN_HEIGHT-110, 120, 30), "text": cost_label("Лекарь", UNIT_STATS[UnitType.HEALER.value]), "type": UnitType.HEALER, "building": BuildingType.TEMPLE},
+        {"rect": pygame.Rect(530, SCREEN_HEIGHT-110, 120, 30), "text": cost_label("Осадное", UNIT_STATS[UnitType.SIEGE.value]), "type": UnitType.SIEGE, "building": BuildingType.SIEGE_WORKSHOP},
+        {"rect": pygame.Rect(660, SCREEN_HEIGHT-110, 120, 30), "text": cost_label("Разведчик", UNIT_STATS[UnitType.SCOUT.value]), "type": UnitType.SCOUT},
+        {"rect": pygame.Rect(790, SCREEN_HEIGHT-110, 120, 30), "text": cost_label("Рабочий", UNIT_STATS[UnitType.WORKER.value]), "type": UnitType.WORKER},
+        
+        {"rect": pygame.Rect(10, SCREEN_HEIGHT-70, 120, 30), "text": cost_label("Казармы", BUILDING_STATS[BuildingType.BARRACKS.value]), "building_type": BuildingType.BARRACKS},
+        {"rect": pygame.Rect(140, SCREEN_HEIGHT-70, 120, 30), "text": cost_label("Тир", BUILDING_STATS[BuildingType.ARCHERY.value]), "building_type": BuildingType.ARCHERY},
+        {"rect": pygame.Rect(270, SCREEN_HEIGHT-70, 120, 30), "text": cost_label("Конюшня", BUILDING_STATS[BuildingType.STABLE.value]), "building_type": BuildingType.STABLE},
+        {"rect": pygame.Rect(400, SCREEN_HEIGHT-70, 120, 30), "text": cost_label("Храм", BUILDING_STATS[BuildingType.TEMPLE.value]), "building_type": BuildingType.TEMPLE},
+        {"rect": pygame.Rect(530, SCREEN_HEIGHT-70, 120, 30), "text": cost_label("Мастерская", BUILDING_STATS[BuildingType.SIEGE_WORKSHOP.value]), "building_type": BuildingType.SIEGE_WORKSHOP},
+        {"rect": pygame.Rect(660, SCREEN_HEIGHT-70, 120, 30), "text": cost_label("Башня", BUILDING_STATS[BuildingType.TOWER.value]), "building_type": BuildingType.TOWER},
+        {"rect": pygame.Rect(790, SCREEN_HEIGHT-70, 120, 30), "text": cost_label("Стена", BUILDING_STATS[BuildingType.WALL.value]), "building_type": BuildingType.WALL},
+        {"rect": pygame.Rect(920, SCREEN_HEIGHT-70, 120, 30), "text": cost_label("Ферма", BUILDING_STATS[BuildingType.FARM.value]), "building_type": BuildingType.FARM},
         
         {"rect": pygame.Rect(SCREEN_WIDTH-130, SCREEN_HEIGHT-110, 120, 30), "text": "Отменить выбор", "action": "deselect"},
         {"rect": pygame.Rect(SCREEN_WIDTH-130, SCREEN_HEIGHT-70, 120, 30), "text": "Справка (H)", "action": "help"},
@@ -1298,6 +3008,7 @@ def main():
         "A - выделить всех юнитов, ESC - выход",
         "R - рестарт после окончания игры",
         "H - показать/скрыть справку",
+        "1/2/3/4 - скорость игры 1x/2x/4x/макс",
         "Стрелки - перемещение камеры",
         "",
         "Ресурсы:",
@@ -1334,27 +3045,24 @@ def main():
                         if button["rect"].collidepoint(event.pos):
                             button_clicked = True
                             if "type" in button:
-                                game.create_unit('player', button["type"])
+                                game.queue_command('train', button["type"].name)
                                 building_mode = None
                             elif "building_type" in button:
                                 building_mode = button["building_type"]
                             elif "action" in button:
                                 if button["action"] == "deselect":
-                                    game.selected_units = []
-                                    game.selected_building = None
+                                    game.queue_command('deselect')
                                     building_mode = None
                                 elif button["action"] == "help":
                                     show_help = not show_help
                                 elif button["action"] == "toggle_fog":
-                                    game.fog_of_war = not game.fog_of_war
-                                    button["text"] = f"Туман войны: {'Выкл' if not game.fog_of_war else 'Вкл'}"
+                                    game.queue_command('toggle_fog')
                                 elif button["action"] == "toggle_minimap":
                                     game.show_minimap = not game.show_minimap
-                                    button["text"] = f"Миникарта: {'Выкл' if not game.show_minimap else 'Вкл'}"
                     
                     if not button_clicked and mouse_pos[1] > UI_HEIGHT:
                         if building_mode is not None:
-                            game.build(building_mode, *grid_pos)
+                            game.queue_command('build', building_mode.name, *grid_pos)
                             building_mode = None
                         else:
                             selecting = True
@@ -1370,10 +3078,11 @@ def main():
                     game.selection_end = (mouse_pos[0] // CELL_SIZE, 
                                         (mouse_pos[1] - UI_HEIGHT) // CELL_SIZE)
                     if game.selection_start and game.selection_end:
-                        game.select_units(game.selection_start, game.selection_end)
+                        game.queue_command('select', game.selection_start, game.selection_end,
+                                           (game.camera_x, game.camera_y))
                 
                 elif event.button == 3 and mouse_pos[1] > UI_HEIGHT and building_mode is None:
-                    game.command_units(grid_pos)
+                    game.queue_command('order', grid_pos)
             
             elif event.type == pygame.MOUSEMOTION and selecting:
                 # Обновляем конечную позицию выделения
@@ -1384,18 +3093,19 @@ def main():
                 if event.key == pygame.K_ESCAPE:
                     running = False
                 elif event.key == pygame.K_a:
-                    game.selected_units = [u for u in game.player_units if u['build_progress'] >= u['build_time']]
-                    game.selected_building = None
-                    SELECT_SOUND.play()
+                    game.queue_command('select_all')
                 elif event.key == pygame.K_r and game.game_over:
-                    game = Game()
+                    game = Game(width=width, height=height, seed=seed, batch_combat=batch_combat)
                     building_mode = None
                 elif event.key == pygame.K_h:
                     show_help = not show_help
                 elif event.key == pygame.K_f:
-                    game.fog_of_war = not game.fog_of_war
+                    game.queue_command('toggle_fog')
                 elif event.key == pygame.K_m:
                     game.show_minimap = not game.show_minimap
+                elif event.key in SIM_SPEEDS:
+                    sim_speed = SIM_SPEEDS[event.key]
+                    accumulator = 0.0
                 # Управление камерой
                 elif event.key == pygame.K_LEFT:
                     game.camera_x = max(0, game.camera_x - CELL_SIZE * 5)
@@ -1406,10 +3116,29 @@ def main():
                 elif event.key == pygame.K_DOWN:
                     game.camera_y = min(game.grid_height * CELL_SIZE - (SCREEN_HEIGHT - UI_HEIGHT), game.camera_y + CELL_SIZE * 5)
         
-        game.update()
-        
-        screen.fill(BLACK)
-        game_surface = pygame.Surface((SCREEN_WIDTH, SCREEN_HEIGHT - UI_HEIGHT))
+        # Накопленное с прошлого кадра время переводим в ходы; если кадр был слишком
+        # долгим, не пытаемся его догнать целиком, иначе отставание только растет
+        now = time.perf_counter()
+        frame_time = min(now - last_time, MAX_FRAME_TIME)
+        last_time = now
+        if sim_speed is None:
+            deadline = now + MAX_SPEED_BUDGET
+            game.update()
+            while time.perf_counter() < deadline and not game.game_over:
+                game.update()
+            alpha = 1.0
+        else:
+            accumulator += frame_time * sim_speed
+            ticks = 0
+            while accumulator >= tick_time and ticks < MAX_TICKS_PER_FRAME * sim_speed:
+                game.update()
+                accumulator -= tick_time
+                ticks += 1
+            accumulator = min(accumulator, tick_time)
+            alpha = accumulator / tick_time
+        
+        # Панель и игровое поле вместе покрывают весь экран, поэтому он не очищается
+        dirty.begin((game, game.camera_x, game.camera_y, game.fog_of_war, game.show_minimap, show_help, game.game_over))
         
         # Отрисовка карты с учетом камеры
         start_x = max(0, int(game.camera_x // CELL_SIZE))
@@ -1417,36 +3146,20 @@ def main():
         start_y = max(0, int(game.camera_y // CELL_SIZE))
         end_y = min(game.grid_height, start_y + (SCREEN_HEIGHT - UI_HEIGHT) // CELL_SIZE + 2)
         
-        for x in range(start_x, end_x):
-            for y in range(start_y, end_y):
-                screen_x = x * CELL_SIZE - game.camera_x
-                screen_y = y * CELL_SIZE - game.camera_y
-                
-                if not game.fog_of_war or game.explored[x, y]:
-                    terrain = game.terrain[x, y]
-                    
-                    if terrain < 0.3:
-                        color = (50, 50, 150)
-                    elif terrain < 0.4:
-                        color = (70, 90, 70)
-                    elif terrain > 0.8:
-                        color = (100, 100, 100)
-                    else:
-                        color = (30, 80, 30) if (x + y) % 2 == 0 else (40, 90, 40)
-                    
-                    if game.fog_of_war and not game.vision_map[x, y]:
-                        color = tuple(max(0, c - 50) for c in color)
-                    
-                    pygame.draw.rect(game_surface, color, (screen_x, screen_y, CELL_SIZE, CELL_SIZE))
-        
-        # Отрисовка сетки
-        for x in range(start_x, end_x, 2):
-            screen_x = x * CELL_SIZE - game.camera_x
-            pygame.draw.line(game_surface, (100, 100, 100, 50), (screen_x, 0), (screen_x, SCREEN_HEIGHT - UI_HEIGHT), 1)
-        
-        for y in range(start_y, end_y, 2):
-            screen_y = y * CELL_SIZE - game.camera_y
-            pygame.draw.line(game_surface, (100, 100, 100, 50), (0, screen_y), (SCREEN_WIDTH, screen_y), 1)
+        terrain_layer.draw(game_surface, game)
+        
+        # Туман войны: неисследованное скрываем, невидимое затемняем
+        if game.fog_of_war:
+            fog_layer.draw(game_surface, game, start_x, start_y, end_x, end_y)
+            # Туман перерисовывается не целиком, а там, где штамповались источники зрения
+            for x0, y0, x1, y1 in game.vision_changes:
+                rect = pygame.Rect(x0 * CELL_SIZE - game.camera_x, y0 * CELL_SIZE - game.camera_y + UI_HEIGHT,
+                                   (x1 - x0) * CELL_SIZE, (y1 - y0) * CELL_SIZE).clip(field_rect)
+                if rect:
+                    dirty.add(rect)
+        # Штампы после update_vision попадут в туман только со следующим пересчетом - их держим до него
+        if not game.vision_dirty:
+            game.vision_changes.clear()
         
         # Отрисовка ресурсов
         for resource in game.resources:
@@ -1458,140 +3171,98 @@ def main():
                 # Размер зависит от оставшегося количества
                 size = max(3, min(10, int(resource['amount'] / 100)))
                 
+                rect = pygame.Rect(screen_x, screen_y, 0, 0)
                 if resource['type'] == ResourceType.GOLD:
-                    pygame.draw.circle(game_surface, GOLD, (int(screen_x), int(screen_y)), size)
+                    rect = pygame.draw.circle(game_surface, GOLD, (int(screen_x), int(screen_y)), size)
                 elif resource['type'] == ResourceType.STONE:
-                    pygame.draw.circle(game_surface, STONE, (int(screen_x), int(screen_y)), size)
+                    rect = pygame.draw.circle(game_surface, STONE, (int(screen_x), int(screen_y)), size)
                 elif resource['type'] == ResourceType.WOOD:
-                    pygame.draw.rect(game_surface, WOOD, (screen_x-size//2, screen_y-size//2, size, size))
+                    rect = pygame.draw.rect(game_surface, WOOD, (screen_x-size//2, screen_y-size//2, size, size))
                 
                 # Отображение количества
+                amount_text = None
                 if size > 5:
-                    text = small_font.render(str(int(resource['amount'])), True, BLACK)
+                    amount_text = str(int(resource['amount']))
+                    text = glyphs.render(small_font, amount_text, BLACK)
                     text_rect = text.get_rect(center=(screen_x, screen_y))
-                    game_surface.blit(text, text_rect)
-        
-        # Отрисовка зданий
-        for building in game.enemy_buildings + game.player_buildings:
-            if (start_x <= building['x'] < end_x and start_y <= building['y'] < end_y and
-                (not game.fog_of_war or game.vision_map[int(building['x']), int(building['y'])])):
+                    rect = rect.union(game_surface.blit(text, text_rect))
+                dirty.mark(('resource', id(resource), size, amount_text, rect.topleft), rect.move(0, UI_HEIGHT))
+        
+        # Здания и юниты: берем из пространственных индексов только попавшие в камеру
+        # и отдаем все спрайты одним вызовом blits
+        batch = []
+        for side in ('enemy', 'player'):
+            for building in game.building_index[side].in_rect(start_x, start_y, end_x, end_y):
+                if game.fog_of_war and not game.vision_map[int(building['x']), int(building['y'])]:
+                    continue
+                
                 size = building['size'] * CELL_SIZE
                 screen_x = building['x'] * CELL_SIZE - game.camera_x - size//2
                 screen_y = building['y'] * CELL_SIZE - game.camera_y - size//2
-                
-                if building['side'] == 'player':
-                    color = building['color']
-                    if building.get('is_base'):
-                        color = (0, 200, 200)
-                else:
-                    color = (200, 100, 100)
-                    if building.get('is_base'):
-                        color = (200, 0, 0)
-                
-                alpha = 255 if building['build_progress'] >= building['build_time'] else 128
-                
-                building_surface = pygame.Surface((size, size), pygame.SRCALPHA)
-                pygame.draw.rect(building_surface, (*color, alpha), (0, 0, size, size))
-                pygame.draw.rect(building_surface, (200, 200, 200, alpha), (0, 0, size, size), 2)
-                
-                if building['build_progress'] < building['build_time']:
-                    progress = building['build_progress'] / building['build_time']
-                    pygame.draw.rect(building_surface, (255, 255, 255, alpha), (0, 0, size * progress, 5))
-                
-                health_ratio = building['health'] / building['max_health']
-                health_width = size * health_ratio
-                pygame.draw.rect(building_surface, (200, 0, 0, alpha), (0, size-5, size, 5))
-                pygame.draw.rect(building_surface, (0, 200, 0, alpha), (0, size-5, health_width, 5))
-                
-                game_surface.blit(building_surface, (screen_x, screen_y))
+                selected = building is game.selected_building
+                health_width = int(size * building['health'] / building['max_health'])
                 
                 if building['build_progress'] >= building['build_time']:
-                    type_symbol = ""
-                    if building['type'] == BuildingType.BARRACKS: type_symbol = "B"
-                    elif building['type'] == BuildingType.ARCHERY: type_symbol = "A"
-                    elif building['type'] == BuildingType.STABLE: type_symbol = "S"
-                    elif building['type'] == BuildingType.TEMPLE: type_symbol = "H"
-                    elif building['type'] == BuildingType.SIEGE_WORKSHOP: type_symbol = "W"
-                    elif building['type'] == BuildingType.TOWER: type_symbol = "T"
-                    elif building['type'] == BuildingType.WALL: type_symbol = "|"
-                    elif building['type'] == BuildingType.TOWN_HALL: type_symbol = "TH"
-                    elif building['type'] == BuildingType.MINE: type_symbol = "M"
-                    elif building['type'] == BuildingType.LUMBER_MILL: type_symbol = "L"
-                    elif building['type'] == BuildingType.FARM: type_symbol = "F"
+                    batch.append((sprites.building(building, selected), (screen_x, screen_y)))
+                    batch.append((sprites.health_bar(size, 5, health_width, (200, 0, 0), (0, 200, 0)), (screen_x, screen_y + size - 5)))
                     
                     text_color = WHITE if building['side'] == 'player' else BLACK
-                    text = small_font.render(type_symbol, True, text_color)
+                    text = glyphs.render(small_font, BUILDING_SYMBOLS.get(building['type'], ""), text_color)
                     text_rect = text.get_rect(center=(building['x']*CELL_SIZE - game.camera_x, 
                                                      building['y']*CELL_SIZE - game.camera_y))
-                    game_surface.blit(text, text_rect)
-        
-        # Отрисовка юнитов
-        for unit in game.enemy_units + game.player_units:
-            if (unit['build_progress'] >= unit['build_time'] and
-                start_x <= unit['x'] < end_x and start_y <= unit['y'] < end_y):
+                    batch.append((text, text_rect))
+                else:
+                    progress_width = int(size * building['build_progress'] / building['build_time'])
+                    sprite = sprites.building(building, selected, (progress_width, health_width))
+                    batch.append((sprite, (screen_x, screen_y)))
+        
+        selected_ids = {id(unit) for unit in game.selected_units}
+        store = game.unit_store
+        slots = game.units_in_view(start_x, start_y, end_x, end_y)
+        # Экранные координаты (сглаженные между ходами) и полоски здоровья считаем сразу для всех видимых юнитов
+        unit_xs, unit_ys = game.interpolated_positions(slots, alpha)
+        screen_xs = (unit_xs * CELL_SIZE - game.camera_x - CELL_SIZE//2).tolist()
+        screen_ys = (unit_ys * CELL_SIZE - game.camera_y - CELL_SIZE//2).tolist()
+        health_widths = ((CELL_SIZE - 2) * store.health[slots] / store.max_health[slots]).astype(int).tolist()
+        
+        for slot, screen_x, screen_y, health_width in zip(slots.tolist(), screen_xs, screen_ys, health_widths):
+            unit = store.records[slot]
+            batch.append((sprites.unit(unit, id(unit) in selected_ids), (screen_x, screen_y)))
+            
+            # Полоска здоровья над телом юнита (оно на пиксель меньше спрайта)
+            batch.append((sprites.health_bar(CELL_SIZE - 2, 3, health_width), (screen_x + 1, screen_y - 4)))
+            
+            # Отображение переносимых ресурсов
+            if any(unit['carrying'].values()):
+                res_text = ""
+                for res, amount in unit['carrying'].items():
+                    if amount > 0:
+                        res_text += f"{res[0]}:{amount} "
                 
-                visible = False
-                if not game.fog_of_war:
-                    visible = True
-                elif game.vision_map[int(unit['x']), int(unit['y'])]:
-                    visible = True
-                elif unit['side'] == 'enemy' and game.explored[int(unit['x']), int(unit['y'])]:
-                    visible = True
-                    
-                if visible:
-                    size = CELL_SIZE - 2
-                    screen_x = unit['x'] * CELL_SIZE - game.camera_x - size//2
-                    screen_y = unit['y'] * CELL_SIZE - game.camera_y - size//2
-                    
-                    color = unit['color'] if unit['side'] == 'player' else YELLOW
-                    
-                    pygame.draw.rect(game_surface, color, (screen_x, screen_y, size, size))
-                    pygame.draw.rect(game_surface, WHITE if unit['side'] == 'player' else BLACK, 
-                                   (screen_x, screen_y, size, size), 1)
-                    
-                    health_ratio = unit['health'] / unit['max_health']
-                    health_width = size * health_ratio
-                    pygame.draw.rect(game_surface, RED, (screen_x, screen_y-5, size, 3))
-                    pygame.draw.rect(game_surface, GREEN, (screen_x, screen_y-5, health_width, 3))
-                    
-                    type_symbol = ""
-                    if unit['type'] == UnitType.WARRIOR: type_symbol = "W"
-                    elif unit['type'] == UnitType.ARCHER: type_symbol = "A"
-                    elif unit['type'] == UnitType.CAVALRY: type_symbol = "C"
-                    elif unit['type'] == UnitType.HEALER: type_symbol = "H"
-                    elif unit['type'] == UnitType.SIEGE: type_symbol = "S"
-                    elif unit['type'] == UnitType.SCOUT: type_symbol = "R"
-                    elif unit['type'] == UnitType.WORKER: type_symbol = "Wk"
-                    elif unit['type'] == UnitType.MINER: type_symbol = "M"
-                    elif unit['type'] == UnitType.LUMBERJACK: type_symbol = "L"
-                    
-                    text_color = WHITE if unit['side'] == 'player' else BLACK
-                    text = small_font.render(type_symbol, True, text_color)
-                    text_rect = text.get_rect(center=(unit['x']*CELL_SIZE - game.camera_x, 
-                                                    unit['y']*CELL_SIZE - game.camera_y))
-                    game_surface.blit(text, text_rect)
-                    
-                    # Отображение переносимых ресурсов
-                    if any(unit['carrying'].values()):
-                        res_text = ""
-                        for res, amount in unit['carrying'].items():
-                            if amount > 0:
-                                res_text += f"{res[0]}:{amount} "
-                        
-                        if res_text:
-                            res_surface = small_font.render(res_text, True, WHITE)
-                            game_surface.blit(res_surface, (screen_x, screen_y - 15))
-        
-        # Отрисовка частиц
-        for particle in game.particles:
-            if (start_x <= particle['x'] < end_x and start_y <= particle['y'] < end_y and
-                (not game.fog_of_war or game.vision_map[
-                    int(max(0, min(game.grid_width-1, particle['x']))), 
-                    int(max(0, min(game.grid_height-1, particle['y'])))
-                ])):
-                screen_x = particle['x'] * CELL_SIZE - game.camera_x
-                screen_y = particle['y'] * CELL_SIZE - game.camera_y
-                pygame.draw.circle(game_surface, particle['color'], (int(screen_x), int(screen_y)), particle['size'])
+                if res_text:
+                    batch.append((glyphs.render(small_font, res_text, WHITE), (screen_x + 1, screen_y - 14)))
+        
+        for (sprite, _), rect in zip(batch, game_surface.blits(batch)):
+            dirty.mark((sprite, tuple(rect)), rect.move(0, UI_HEIGHT))
+        
+        # Отрисовка частиц: видимые отбираем массивами, кружки берем из кэша и рисуем одним blits
+        pool = game.particles
+        live = pool.live()
+        px = pool.x[live]
+        py = pool.y[live]
+        shown = (px >= start_x) & (px < end_x) & (py >= start_y) & (py < end_y)
+        if game.fog_of_war:
+            shown[shown] = game.vision_map[px[shown].astype(np.intp), py[shown].astype(np.intp)]
+        live = live[shown]
+        
+        sizes = pool.size[live].tolist()
+        screen_xs = (pool.x[live] * CELL_SIZE - game.camera_x).astype(int) - pool.size[live]
+        screen_ys = (pool.y[live] * CELL_SIZE - game.camera_y).astype(int) - pool.size[live]
+        batch = [(sprites.particle(tuple(color), size), (screen_x, screen_y))
+                 for color, size, screen_x, screen_y in zip(pool.color[live].tolist(), sizes,
+                                                            screen_xs.tolist(), screen_ys.tolist())]
+        for (sprite, _), rect in zip(batch, game_surface.blits(batch)):
+            dirty.mark((sprite, tuple(rect)), rect.move(0, UI_HEIGHT))
         
         # Отрисовка выделения
         if selecting and game.selection_start and game.selection_end:
@@ -1604,24 +3275,9 @@ def main():
             
             selection_surface = pygame.Surface((right - left, bottom - top), pygame.SRCALPHA)
             selection_surface.fill(LIGHT_BLUE)
-            game_surface.blit(selection_surface, (left, top))
+            rect = game_surface.blit(selection_surface, (left, top))
             pygame.draw.rect(game_surface, BLUE, (left, top, right - left, bottom - top), 2)
-        
-        # Отрисовка выделенных юнитов
-        for unit in game.selected_units:
-            if unit['build_progress'] >= unit['build_time']:
-                size = CELL_SIZE
-                screen_x = unit['x'] * CELL_SIZE - game.camera_x - size//2
-                screen_y = unit['y'] * CELL_SIZE - game.camera_y - size//2
-                pygame.draw.rect(game_surface, BLUE, 
-                               (screen_x, screen_y, size, size), 2)
-        
-        # Отрисовка выделенного здания
-        if game.selected_building:
-            size = game.selected_building['size'] * CELL_SIZE
-            screen_x = game.selected_building['x'] * CELL_SIZE - game.camera_x - size//2
-            screen_y = game.selected_building['y'] * CELL_SIZE - game.camera_y - size//2
-            pygame.draw.rect(game_surface, BLUE, (screen_x, screen_y, size, size), 3)
+            dirty.mark(('selection', tuple(rect)), rect.move(0, UI_HEIGHT))
         
         # Отрисовка режима строительства
         if building_mode is not None and mouse_pos[1] > UI_HEIGHT:
@@ -1631,31 +3287,15 @@ def main():
                 screen_x = grid_pos[0] * CELL_SIZE - game.camera_x - size//2
                 screen_y = grid_pos[1] * CELL_SIZE - game.camera_y - size//2
                 
-                can_build = True
-                for building in game.player_buildings + game.enemy_buildings:
-                    if game.get_distance(grid_pos[0], grid_pos[1], building['x'], building['y']) < max(stats['size'], building['size']) + 2:
-                        can_build = False
-                        break
-                
-                if (grid_pos[0] - stats['size']/2 < 0 or grid_pos[0] + stats['size']/2 >= game.grid_width or
-                    grid_pos[1] - stats['size']/2 < 0 or grid_pos[1] + stats['size']/2 >= game.grid_height):
-                    can_build = False
-                
-                color = GREEN if can_build else RED
-                alpha = 100 if can_build else 70
-                
-                building_surface = pygame.Surface((size, size), pygame.SRCALPHA)
-                pygame.draw.rect(building_surface, (*color, alpha), (0, 0, size, size))
-                pygame.draw.rect(building_surface, (*WHITE, alpha), (0, 0, size, size), 2)
-                game_surface.blit(building_surface, (screen_x, screen_y))
+                can_build = game.can_place_building(stats['size'], grid_pos[0], grid_pos[1])
+                rect = game_surface.blit(sprites.placement(size, can_build), (screen_x, screen_y))
+                dirty.mark(('placement', can_build, tuple(rect)), rect.move(0, UI_HEIGHT))
         
         screen.blit(game_surface, (0, UI_HEIGHT))
         
         # Отрисовка интерфейса
-        pygame.draw.rect(screen, DARK_GREEN, (0, 0, SCREEN_WIDTH, UI_HEIGHT))
-        
         stats = [
-            f"Ход: {game.turn}",
+            f"Ход: {game.turn} | Скорость: {'макс' if sim_speed is None else f'{sim_speed}x'}",
             f"Игрок: {len(game.player_units)} юнитов | Ресурсы: G:{int(game.player_resources['gold'])}, S:{int(game.player_resources['stone'])}, W:{int(game.player_resources['wood'])}, F:{int(game.player_resources['food'])}",
             f"База: {int(game.player_base['health'])}/{game.player_base['max_health']} HP",
             f"Враг: {len(game.enemy_units)} юнитов | Ресурсы: G:{int(game.enemy_resources['gold'])}, S:{int(game.enemy_resources['stone'])}, W:{int(game.enemy_resources['wood'])}, F:{int(game.enemy_resources['food'])}",
@@ -1663,12 +3303,26 @@ def main():
             f"Выделено: {len(game.selected_units)} юнитов" + (f" | Здание: {game.selected_building['type'].name if game.selected_building else ''}" if game.selected_building else "")
         ]
         
-        for i, text in enumerate(stats):
-            text_surface = font.render(text, True, WHITE)
-            screen.blit(text_surface, (10, 10 + i*20))
+        # Панель перерисовывается только при изменении строк (оверлей конца игры лежит поверх нее),
+        # а на экран уходят полосы изменившихся строк
+        if stats != last_stats or dirty.full or game.game_over:
+            pygame.draw.rect(screen, DARK_GREEN, panel_rect)
+            for i, text in enumerate(stats):
+                text_surface = glyphs.render(font, text, WHITE)
+                screen.blit(text_surface, (10, 10 + i*20))
+                if last_stats is None or game.game_over or text != last_stats[i]:
+                    dirty.add(pygame.Rect(0, 10 + i*20, SCREEN_WIDTH, font.get_linesize()).clip(panel_rect))
+            last_stats = stats
         
         # Отрисовка кнопок
-        for button in buttons:
+        for i, button in enumerate(buttons):
+            # Надписи переключателей берутся из текущего состояния игры: приказ о тумане
+            # выполняется только на следующем ходу (и не выполняется после конца игры)
+            if button.get("action") == "toggle_fog":
+                button["text"] = f"Туман войны: {'Вкл' if game.fog_of_war else 'Выкл'}"
+            elif button.get("action") == "toggle_minimap":
+                button["text"] = f"Миникарта: {'Вкл' if game.show_minimap else 'Выкл'}"
+            
             if button.get("building_type") == building_mode:
                 color = (0, 150, 0)
             elif button.get("type") and not game.can_afford('player', game.get_unit_stats(button["type"])["cost"]):
@@ -1682,38 +3336,29 @@ def main():
             
             draw_rounded_rect(screen, color, button["rect"], 5)
             
-            text_surface = small_font.render(button["text"], True, WHITE)
+            text_surface = glyphs.render(small_font, button["text"], WHITE)
             text_rect = text_surface.get_rect(center=button["rect"].center)
             screen.blit(text_surface, text_rect)
+            dirty.mark(('button', i, color, button["text"]), button["rect"])
         
         # Отрисовка миникарты
         if game.show_minimap:
             minimap_rect = pygame.Rect(SCREEN_WIDTH - MINIMAP_SIZE - 10, UI_HEIGHT + 10, MINIMAP_SIZE, MINIMAP_SIZE)
-            pygame.draw.rect(screen, BLACK, minimap_rect)
+            screen.blit(minimap_layer.get_surface(game), minimap_rect)
             pygame.draw.rect(screen, WHITE, minimap_rect, 2)
             
             scale_x = MINIMAP_SIZE / game.grid_width
             scale_y = MINIMAP_SIZE / game.grid_height
             
-            for x in range(game.grid_width):
-                for y in range(game.grid_height):
-                    if game.explored[x, y]:
-                        color = (0, 80, 0) if game.terrain[x, y] > 0.4 else (0, 0, 80)
-                        if game.vision_map[x, y]:
-                            color = (0, 150, 0) if game.terrain[x, y] > 0.4 else (0, 0, 150)
-                        
-                        pygame.draw.rect(screen, color, 
-                                       (SCREEN_WIDTH - MINIMAP_SIZE - 10 + x * scale_x,
-                                        UI_HEIGHT + 10 + y * scale_y,
-                                        max(1, scale_x), max(1, scale_y)))
-            
-            for unit in game.player_units + game.enemy_units:
-                if unit['build_progress'] >= unit['build_time'] and game.explored[int(unit['x']), int(unit['y'])]:
-                    color = BLUE if unit['side'] == 'player' else YELLOW
-                    pygame.draw.circle(screen, color,
-                                      (int(SCREEN_WIDTH - MINIMAP_SIZE - 10 + unit['x'] * scale_x),
-                                      int(UI_HEIGHT + 10 + unit['y'] * scale_y)),
-                                      max(1, int(scale_x * 1.5)))
+            store = game.unit_store
+            n = store.size
+            shown = store.alive[:n] & (store.build_progress[:n] >= store.build_time[:n])
+            shown[shown] = game.explored[store.x[:n][shown].astype(np.intp), store.y[:n][shown].astype(np.intp)]
+            dots_x = (SCREEN_WIDTH - MINIMAP_SIZE - 10 + store.x[:n][shown] * scale_x).astype(int).tolist()
+            dots_y = (UI_HEIGHT + 10 + store.y[:n][shown] * scale_y).astype(int).tolist()
+            for dot_x, dot_y, side in zip(dots_x, dots_y, store.side[:n][shown].tolist()):
+                color = BLUE if side == SIDE_PLAYER else YELLOW
+                pygame.draw.circle(screen, color, (dot_x, dot_y), max(1, int(scale_x * 1.5)))
             
             for building in game.player_buildings + game.enemy_buildings:
                 if building['build_progress'] >= building['build_time'] and game.explored[int(building['x']), int(building['y'])]:
@@ -1743,6 +3388,7 @@ def main():
                 ((SCREEN_HEIGHT - UI_HEIGHT) / game.grid_height) * scale_y
             )
             pygame.draw.rect(screen, WHITE, view_rect, 1)
+            dirty.add(minimap_rect)
         
         # Отрисовка справки
         if show_help:
@@ -1750,11 +3396,11 @@ def main():
             help_surface.fill((0, 0, 0, 200))
             pygame.draw.rect(help_surface, (0, 0, 100, 200), (0, 0, 600, 500), 2)
             
-            title = big_font.render("Справка", True, WHITE)
+            title = glyphs.render(big_font, "Справка", WHITE)
             help_surface.blit(title, (300 - title.get_width()//2, 20))
             
             for i, line in enumerate(help_text):
-                text = font.render(line, True, WHITE)
+                text = glyphs.render(font, line, WHITE)
                 help_surface.blit(text, (20, 80 + i*25))
             
             screen.blit(help_surface, (SCREEN_WIDTH//2 - 300, SCREEN_HEIGHT//2 - 250))
@@ -1765,19 +3411,56 @@ def main():
             overlay.fill((0, 0, 0, 180))
             screen.blit(overlay, (0, 0))
             
-            text = big_font.render(game.game_over, True, WHITE)
+            text = glyphs.render(big_font, game.game_over, WHITE)
             text_rect = text.get_rect(center=(SCREEN_WIDTH//2, SCREEN_HEIGHT//2 - 50))
             screen.blit(text, text_rect)
             
-            restart_text = font.render("Нажмите R для рестарта", True, WHITE)
+            restart_text = glyphs.render(font, "Нажмите R для рестарта", WHITE)
             restart_rect = restart_text.get_rect(center=(SCREEN_WIDTH//2, SCREEN_HEIGHT//2 + 20))
             screen.blit(restart_text, restart_rect)
         
-        pygame.display.flip()
-        clock.tick(FPS)
+        dirty.present()
+        clock.tick(max_fps)
     
+    # После рестарта по R записывается только текущая партия
+    if record:
+        save_replay(game, record, seed, batch_combat)
     pygame.quit()
     sys.exit()
 
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="WARFIELDS - ASCII RTS")
+    parser.add_argument('--headless', action='store_true',
+                        help="запуск симуляции без окна и звука")
+    parser.add_argument('--ticks', type=int, default=10000,
+                        help="количество ходов в headless-режиме")
+    parser.add_argument('--map-width', type=int, default=MAP_WIDTH,
+                        help="ширина карты в клетках")
+    parser.add_argument('--map-height', type=int, default=MAP_HEIGHT,
+                        help="высота карты в клетках")
+    parser.add_argument('--seed', type=int, default=None,
+                        help="зерно генерации карты (по умолчанию - классическая карта)")
+    parser.add_argument('--dirty-rects', action='store_true',
+                        help="обновлять на экране только изменившиеся области")
+    parser.add_argument('--batch-combat', action='store_true',
+                        help="считать бой массивами: все атаки хода наносятся одновременно")
+    parser.add_argument('--record', metavar='FILE', default=None,
+                        help="записать приказы игрока и итог партии в файл при выходе")
+    parser.add_argument('--replay', metavar='FILE', default=None,
+                        help="повторить записанную партию без окна и сверить результат")
+    parser.add_argument('--max-fps', type=int, default=FPS,
+                        help=f"ограничение кадров в секунду, 0 - без ограничения (по умолчанию {FPS})")
+    args = parser.parse_args(argv)
+    if args.max_fps < 0:
+        parser.error("--max-fps не может быть отрицательным")
+    return args
+
 if __name__ == "__main__":
-    main()
+    args = parse_args()
+    if args.replay:
+        sys.exit(0 if run_replay(args.replay) else 1)
+    elif args.headless:
+        run_headless(args.ticks, args.map_width, args.map_height, args.seed, args.batch_combat, args.record)
+    else:
+        main(args.map_width, args.map_height, args.seed, args.dirty_rects, args.batch_combat, args.record,
+             args.max_fps)
@@ -0,0 +1,501 @@
+"""Проверки игры без окна и звука"""
+import json
+import math
+
+import numpy as np
+import pytest
+
+import main as m
+
+
+# Приказы по номеру хода: обучение, выделение, приказы, стройка, туман
+SCRIPT = {
+    50: [('train', 'WORKER')],
+    300: [('train', 'WARRIOR'), ('train', 'WORKER')],
+    600: [('select_all',)],
+    601: [('order', (40, 20))],
+    700: [('build', 'TOWER', 12, 12)],
+    900: [('select', (0, 0), (30, 30), (0, 0))],
+    901: [('order', (60, 30))],
+    1200: [('toggle_fog',), ('deselect',)],
+}
+
+
+def play_script(seed, ticks=1500, batch_combat=False):
+    game = m.Game(headless=True, seed=seed, batch_combat=batch_combat)
+    for _ in range(ticks):
+        for command in SCRIPT.get(game.turn, []):
+            game.queue_command(*command)
+        game.update()
+        if game.game_over:
+            break
+    return game
+
+
+@pytest.mark.parametrize('batch_combat', [False, True])
+def test_record_replay_digest_matches(tmp_path, batch_combat):
+    game = play_script(seed=3, batch_combat=batch_combat)
+    assert len(game.command_log) == sum(len(commands) for commands in SCRIPT.values())
+    path = tmp_path / 'game.json'
+    m.save_replay(game, path, 3, batch_combat)
+    assert m.run_replay(path)
+
+
+def test_replay_detects_divergence(tmp_path):
+    game = play_script(seed=3, ticks=800)
+    path = tmp_path / 'game.json'
+    m.save_replay(game, path, 3, False)
+    replay = json.loads(path.read_text(encoding='utf-8'))
+    replay['commands'] = [c for c in replay['commands'] if c[1] != 'order']
+    path.write_text(json.dumps(replay), encoding='utf-8')
+    assert not m.run_replay(path)
+
+
+def test_same_seed_gives_same_state():
+    assert play_script(seed=11, ticks=600).state_digest() == play_script(seed=11, ticks=600).state_digest()
+
+
+def test_frame_cap_defaults_above_tick_rate():
+    assert m.parse_args([]).max_fps > m.TICK_RATE
+    assert m.parse_args(['--max-fps', '0']).max_fps == 0
+    with pytest.raises(SystemExit):
+        m.parse_args(['--max-fps', '-5'])
+
+
+def test_registry_swap_remove_and_stale_handles():
+    registry = m.EntityRegistry()
+    a, b, c = {'n': 'a'}, {'n': 'b'}, {'n': 'c'}
+    ha, hb, hc = (registry.append(e) for e in (a, b, c))
+    assert a['handle'] == ha
+
+    assert registry.remove(ha)
+    # На место удаленной встает последняя сущность
+    assert list(registry) == [c, b]
+    assert registry.get(ha) is None and ha not in registry
+    assert not registry.remove(ha)
+    assert registry.get(hb) is b and registry.get(hc) is c
+
+    # Слот переиспользуется, но старый хэндл его не находит
+    d = {'n': 'd'}
+    hd = registry.append(d)
+    assert hd & m.EntityRegistry.SLOT_MASK == ha & m.EntityRegistry.SLOT_MASK
+    assert hd != ha
+    assert registry.get(ha) is None and registry.get(hd) is d
+
+    with pytest.raises(ValueError):
+        registry.append(d)
+
+
+def start_battle(per_side=40, batch_combat=False):
+    """Две армии у своих баз, отправленные друг на друга; юниты достраиваются первым ходом"""
+    game = m.Game(headless=True, width=80, height=60, seed=5, batch_combat=batch_combat)
+    rng = np.random.default_rng(0)
+    for side, base, enemy_base in (('player', game.player_base, game.enemy_base),
+                                   ('enemy', game.enemy_base, game.player_base)):
+        (game.player_resources if side == 'player' else game.enemy_resources).update(
+            gold=10**6, wood=10**6, stone=10**6, food=10**6)
+        for i in range(per_side):
+            unit_type = (m.UnitType.WARRIOR, m.UnitType.ARCHER, m.UnitType.CAVALRY)[i % 3]
+            unit = game.create_unit(side, unit_type,
+                                    min(game.grid_width - 1, max(0, base['x'] + rng.uniform(-6, 6))),
+                                    min(game.grid_height - 1, max(0, base['y'] + rng.uniform(-6, 6))))
+            unit['build_progress'] = unit['build_time'] - 1
+            unit['attacking'] = True
+        units = game.player_units if side == 'player' else game.enemy_units
+        game.order_group(list(units), enemy_base['x'], enemy_base['y'])
+    return game
+
+
+def test_registry_store_and_index_stay_in_sync_after_deaths():
+    game = start_battle()
+    created = game.unit_store.size
+    for _ in range(400):
+        game.update()
+    store = game.unit_store
+    assert len(game.player_units) + len(game.enemy_units) < created
+
+    for side, registry in (('player', game.player_units), ('enemy', game.enemy_units)):
+        handles = set(registry.handles)
+        assert len(handles) == len(registry)
+        assert set(game.unit_index[side].entity_cells) == handles
+        alive = store.slots(store.alive[:store.size] & (store.side[:store.size] == m.SIDES.index(side)))
+        assert {store.records[slot]['handle'] for slot in alive} == handles
+        for unit in registry:
+            assert registry.get(unit['handle']) is unit
+
+
+def scattered_points(count=300, seed=4):
+    rng = np.random.default_rng(seed)
+    return [{'handle': i, 'x': float(x), 'y': float(y), 'ready': bool(r)}
+            for i, (x, y, r) in enumerate(zip(rng.uniform(-5, 60, count), rng.uniform(0, 40, count),
+                                              rng.random(count) < 0.7))]
+
+
+def test_spatial_hash_queries_match_brute_force():
+    index = m.SpatialHash()
+    points = scattered_points()
+    for point in points:
+        index.insert(point)
+    # Часть точек переезжает в другие ячейки, часть удаляется
+    for point in points[::3]:
+        point['x'], point['y'] = point['y'], point['x'] / 2
+        index.move(point['handle'], point['x'], point['y'])
+    for point in points[1::5]:
+        index.remove(point)
+    alive = [p for i, p in enumerate(points) if i % 5 != 1]
+    assert len(index) == len(alive)
+
+    for x0, y0, x1, y1 in [(0, 0, 10, 10), (-5, 3.5, 17.2, 8), (30, 10, 31, 40), (-100, -100, 100, 100)]:
+        expected = {p['handle'] for p in alive if x0 <= p['x'] < x1 and y0 <= p['y'] < y1}
+        assert {p['handle'] for p in index.in_rect(x0, y0, x1, y1)} == expected
+
+    for x, y, radius in [(12, 12, 3), (0, 0, 7.5), (50, 20, 1)]:
+        found = {p['handle'] for p in index.nearby(x, y, radius)}
+        assert {p['handle'] for p in alive if math.dist((x, y), (p['x'], p['y'])) <= radius} <= found
+
+
+def test_spatial_hash_nearest_matches_brute_force():
+    index = m.SpatialHash()
+    points = scattered_points()
+    for point in points:
+        index.insert(point)
+    rng = np.random.default_rng(9)
+    for x, y, max_range in zip(rng.uniform(-20, 80, 200), rng.uniform(-20, 60, 200),
+                               rng.choice([1.5, 6.0, math.inf], 200)):
+        d2 = [(p['x'] - x)**2 + (p['y'] - y)**2 for p in points if p['ready']]
+        expected = min([d for d in d2 if d <= max_range * max_range], default=math.inf)
+        found, found_d2 = index.nearest(x, y, max_range, lambda p: p['ready'])
+        assert found_d2 == expected
+        assert (found is None) == (expected == math.inf)
+        if found is not None:
+            assert found['ready']
+
+
+def test_nearest_unit_scan_agrees_with_spatial_hash():
+    game = start_battle()
+    for _ in range(150):
+        game.update()
+    rng = np.random.default_rng(2)
+    for side in m.SIDES:
+        for x, y, max_range in zip(rng.uniform(0, 80, 50), rng.uniform(0, 60, 50), rng.choice([5.0, math.inf], 50)):
+            unit, d2 = game.nearest_unit(side, x, y, max_range)
+            indexed, indexed_d2 = game.unit_index[side].nearest(x, y, max_range, m.is_ready)
+            assert d2 == pytest.approx(indexed_d2)
+            assert (unit is None) == (indexed is None)
+
+
+def fight_at_barracks(batch_combat):
+    """Осадные орудия и лучники игрока бьют готовые казармы врага, воины - кавалерию.
+
+    Бой короткий и без потерь, поэтому оба движка обязаны прийти к одному состоянию.
+    """
+    game = m.Game(headless=True, width=60, height=40, seed=2, batch_combat=batch_combat)
+    for resources in (game.player_resources, game.enemy_resources):
+        resources.update(gold=10**6, wood=10**6, stone=10**6, food=10**6)
+    barracks = game.create_building('enemy', m.BuildingType.BARRACKS, 40, 20)
+    barracks['build_progress'] = barracks['build_time']
+    army = [('player', m.UnitType.SIEGE, 34, 20), ('player', m.UnitType.SIEGE, 34, 19),
+            ('player', m.UnitType.SIEGE, 34, 21), ('player', m.UnitType.ARCHER, 37, 23),
+            ('player', m.UnitType.ARCHER, 36, 23), ('player', m.UnitType.WARRIOR, 44, 27.2),
+            ('player', m.UnitType.WARRIOR, 44.8, 28), ('enemy', m.UnitType.CAVALRY, 44, 28)]
+    for side, unit_type, x, y in army:
+        unit = game.create_unit(side, unit_type, x, y)
+        unit['build_progress'] = unit['build_time']
+        unit['attacking'] = True
+    for _ in range(40):
+        game.fight()
+        game.move_units()
+    return game, barracks
+
+
+def test_combat_engines_agree_including_building_bonus():
+    sequential, barracks = fight_at_barracks(batch_combat=False)
+    batch, batch_barracks = fight_at_barracks(batch_combat=True)
+    assert len(sequential.player_units) == 7 and len(sequential.enemy_units) == 1
+    assert sequential.state_digest() == batch.state_digest()
+
+    # Два залпа: осадные орудия бьют здания с bonus_vs_buildings, лучники - без бонуса
+    siege = m.UNIT_STATS[m.UnitType.SIEGE.value]
+    archer = m.UNIT_STATS[m.UnitType.ARCHER.value]
+    expected = 2 * (3 * siege['damage'] * siege['bonus_vs_buildings'] + 2 * archer['damage'])
+    for building in (barracks, batch_barracks):
+        assert building['max_health'] - building['health'] == expected
+
+
+@pytest.mark.parametrize('fog_of_war', [False, True])
+def test_units_in_view_matches_full_store_scan(fog_of_war):
+    game = start_battle()
+    game.fog_of_war = fog_of_war
+    for _ in range(200):
+        game.update()
+    store = game.unit_store
+    n = store.size
+    for x0, y0, x1, y1 in [(0, 0, 80, 60), (5, 20, 35, 45), (40.5, 10, 70.5, 50), (70, 0, 75, 5)]:
+        mask = (store.alive[:n] & (store.build_progress[:n] >= store.build_time[:n]) &
+                (store.x[:n] >= x0) & (store.x[:n] < x1) & (store.y[:n] >= y0) & (store.y[:n] < y1))
+        if fog_of_war:
+            cx = store.x[:n].astype(np.intp)
+            cy = store.y[:n].astype(np.intp)
+            mask &= game.vision_map[cx, cy] | ((store.side[:n] == m.SIDE_ENEMY) & game.explored[cx, cy])
+        assert game.units_in_view(x0, y0, x1, y1).tolist() == np.flatnonzero(mask).tolist()
+
+
+def test_incremental_vision_matches_full_recompute():
+    game = start_battle()
+    for _ in range(400):
+        game.update()
+    assert len(game.player_units) < 40
+
+    expected = {'base': (int(game.player_base['x']), int(game.player_base['y']), m.BASE_VISION_RANGE)}
+    for unit in game.player_units:
+        if unit['build_progress'] >= unit['build_time']:
+            expected[m.vision_key('unit', unit)] = (int(unit['x']), int(unit['y']), unit['vision_range'])
+    # База, достроившись, видит еще и как обычное здание
+    for building in game.player_buildings:
+        if building['build_progress'] >= building['build_time']:
+            expected[m.vision_key('building', building)] = (int(building['x']), int(building['y']),
+                                                            m.BUILDING_VISION_RANGE)
+    assert game.vision_sources == expected
+
+    count = np.zeros_like(game.observer_count)
+    for cx, cy, radius in expected.values():
+        for x in range(max(0, cx - radius), min(game.grid_width, cx + radius + 1)):
+            for y in range(max(0, cy - radius), min(game.grid_height, cy + radius + 1)):
+                count[x, y] += (x - cx)**2 + (y - cy)**2 <= radius * radius
+    assert np.array_equal(game.observer_count, count)
+    assert np.array_equal(game.vision_map, count > 0)
+
+
+def paint_terrain(game, x0, y0, x1, y1, terrain):
+    game.terrain_class[x0:x1, y0:y1] = terrain
+    game.terrain_speed = m.TERRAIN_SPEED[game.terrain_class]
+    game.terrain_speed_rows = game.terrain_speed.tolist()
+    game.path_costs = None
+
+
+def blank_map(width=40, height=30):
+    """Ровная равнина без зданий на сетке: рельеф и постройки тесты расставляют сами"""
+    game = m.Game(headless=True, width=width, height=height, seed=1)
+    game.building_grid[...] = m.CELL_FREE
+    paint_terrain(game, 0, 0, width, height, m.TERRAIN_PLAIN)
+    game.path_cache = m.PathCache()
+    game.flow_fields.clear()
+    return game
+
+
+def path_cost(game, cells):
+    costs = game.get_path_costs()
+    for (ax, ay), (bx, by) in zip(cells, cells[1:]):
+        assert max(abs(ax - bx), abs(ay - by)) == 1
+    return sum(math.dist(a, b) * (costs[game.path_index(*a)] + costs[game.path_index(*b)]) / 2
+               for a, b in zip(cells, cells[1:]))
+
+
+def test_astar_goes_around_building_footprint():
+    game = blank_map()
+    game.building_grid[20, 5:25] = m.CELL_BUILDING
+    cells, complete = game.astar((10, 15), (30, 15))
+    assert complete and cells[0] == (10, 15) and cells[-1] == (30, 15)
+    assert all(game.building_grid[x, y] != m.CELL_BUILDING for x, y in cells)
+    assert any(y < 5 or y >= 25 for x, y in cells if x == 20)
+    path_cost(game, cells)
+
+
+@pytest.mark.parametrize('terrain', [m.TERRAIN_WATER, m.TERRAIN_SWAMP])
+def test_astar_prefers_cheaper_terrain(terrain):
+    game = blank_map()
+    paint_terrain(game, 16, 12, 24, 19, terrain)
+    straight = [(x, 15) for x in range(10, 31)]
+    cells, complete = game.astar((10, 15), (30, 15))
+    assert complete and cells[-1] == (30, 15)
+    assert all(game.terrain_class[x, y] == m.TERRAIN_PLAIN for x, y in cells)
+    assert path_cost(game, cells) < path_cost(game, straight)
+
+
+def test_astar_crosses_water_when_there_is_no_way_around():
+    game = blank_map()
+    paint_terrain(game, 20, 0, 22, 30, m.TERRAIN_WATER)
+    cells, complete = game.astar((10, 15), (30, 15))
+    assert complete and cells[-1] == (30, 15)
+    assert sum(game.terrain_class[x, y] == m.TERRAIN_WATER for x, y in cells) == 2
+
+
+def test_astar_returns_partial_path_to_unreachable_goal():
+    game = blank_map()
+    game.building_grid[27:34, 12:19] = m.CELL_BUILDING
+    game.building_grid[28:33, 13:18] = m.CELL_FREE
+    cells, complete = game.astar((10, 15), (30, 15))
+    assert not complete
+    assert cells[0] == (10, 15)
+    # Путь обрывается у стены ближе всего к цели
+    assert cells[-1] == (26, 15)
+    path_cost(game, cells)
+
+
+def test_flow_field_leads_every_cell_to_goal():
+    game = blank_map()
+    game.building_grid[20, 5:25] = m.CELL_BUILDING
+    paint_terrain(game, 5, 0, 9, 30, m.TERRAIN_SWAMP)
+    field = game.get_flow_field((30, 15))
+    assert game.get_flow_field((30, 15)) is field
+    # На открытом месте поле смотрит прямо на цель
+    assert field.direction_at(25, 15) == (1, 0)
+    assert field.direction_at(30, 20) == (0, -1)
+    assert field.direction_at(30, 15) == (0, 0)
+    # Интеграл поля - та же цена пути, что у A*
+    cells, _ = game.astar((10, 15), (30, 15))
+    assert field.distance[10][15] == pytest.approx(path_cost(game, cells))
+
+    for start in [(0, 0), (10, 15), (19, 15), (39, 29), (21, 4)]:
+        cell = start
+        for _ in range(200):
+            dx, dy = field.direction_at(*cell)
+            if not dx and not dy:
+                break
+            nxt = (cell[0] + dx, cell[1] + dy)
+            assert game.building_grid[nxt] != m.CELL_BUILDING
+            assert field.distance[nxt[0]][nxt[1]] < field.distance[cell[0]][cell[1]]
+            cell = nxt
+        assert cell == (30, 15)
+
+
+def test_path_cache_drops_only_paths_near_new_building():
+    game = blank_map()
+    game.player_resources.update(gold=10**6, wood=10**6, stone=10**6, food=10**6)
+    cache = game.path_cache
+    north = game.find_path(5.5, 5.5, 35.5, 5.5, None)
+    south = game.find_path(5.5, 25.5, 35.5, 25.5, None)
+    assert len(cache.entries) == 2 and cache.misses == 2
+
+    # Закладка здания проходимость не меняет, кэш остается
+    tower = game.create_building('player', m.BuildingType.TOWER, 20, 25)
+    assert len(cache.entries) == 2
+    tower['build_progress'] = tower['build_time'] - 1
+    game.update_construction()
+    assert cache.invalidations == 1
+
+    assert game.find_path(5.5, 5.5, 35.5, 5.5, None) == north and cache.hits == 1
+    detour = game.find_path(5.5, 25.5, 35.5, 25.5, None)
+    assert detour != south and cache.misses == 3
+    assert all(game.building_grid[int(x), int(y)] != m.CELL_BUILDING for x, y in detour)
+
+
+def test_path_cache_drops_partial_paths_on_any_building_change():
+    game = blank_map()
+    game.player_resources.update(gold=10**6, wood=10**6, stone=10**6, food=10**6)
+    game.building_grid[27:34, 12:19] = m.CELL_BUILDING
+    game.building_grid[28:33, 13:18] = m.CELL_FREE
+    game.path_costs = None
+    game.find_path(10.5, 15.5, 30.5, 15.5, None)
+    assert len(game.path_cache.entries) == 1
+
+    tower = game.create_building('player', m.BuildingType.TOWER, 5, 3)
+    tower['build_progress'] = tower['build_time'] - 1
+    game.update_construction()
+    assert not game.path_cache.entries
+
+
+def test_building_cells_are_reserved_blocked_and_released():
+    game = blank_map()
+    game.player_resources.update(gold=10**6, wood=10**6, stone=10**6, food=10**6)
+    size = m.BUILDING_STATS[m.BuildingType.TOWER.value]['size']
+    tower = game.create_building('player', m.BuildingType.TOWER, 20, 15)
+    x0, y0, x1, y1 = game.building_footprint(20, 15, size)
+    costs = game.get_path_costs()
+    assert (game.building_grid[x0:x1, y0:y1] == m.CELL_RESERVED).all()
+    assert np.count_nonzero(game.building_grid) == size * size
+    # Пока здание строится, сквозь него можно ходить
+    assert costs[game.path_index(x0, y0)] is not None
+
+    # Соседнее здание нельзя ставить ближе зазора BUILDING_SPACING
+    resources = dict(game.player_resources)
+    assert not game.create_building('player', m.BuildingType.TOWER, 20 + size + m.BUILDING_SPACING - 1, 15)
+    assert game.player_resources == resources
+    assert game.can_place_building(size, 20 + size + m.BUILDING_SPACING, 15)
+
+    tower['build_progress'] = tower['build_time'] - 1
+    game.update_construction()
+    assert (game.building_grid[x0:x1, y0:y1] == m.CELL_BUILDING).all()
+    assert all(costs[game.path_index(x, y)] is None for x in range(x0, x1) for y in range(y0, y1))
+
+    game.destroy_building(tower)
+    assert not game.building_grid.any()
+    assert all(costs[game.path_index(x, y)] == 1.0 for x in range(x0, x1) for y in range(y0, y1))
+    assert game.can_place_building(size, 20, 15)
+
+
+def test_particle_pool_wraps_and_expires():
+    pool = m.ParticlePool(capacity=8, seed=0)
+    pool.add(1.0, 1.0, 5, (255, 0, 0))
+    pool.add(9.0, 9.0, 5, (0, 0, 255, 128))
+    # Вторая партия пишется по кругу поверх двух самых старых частиц
+    assert len(pool) == 8 and pool.head == 2
+    assert pool.color[:2].tolist() == [[0, 0, 255]] * 2 and pool.color[2].tolist() == [255, 0, 0]
+
+    pool.add(0.0, 0.0, 20, (0, 255, 0))
+    assert len(pool) == 8 and pool.head == 2
+    assert (pool.color[:, 1] == 255).all()
+
+    start = pool.x.copy(), pool.y.copy()
+    for _ in range(9):
+        pool.update()
+    assert len(pool) == 8
+    assert np.allclose(np.hypot(pool.x - start[0], pool.y - start[1]), 9 * np.hypot(pool.dx, pool.dy))
+    for _ in range(21):
+        pool.update()
+    assert len(pool) == 0 and pool.active == 0 and not len(pool.live())
+
+
+def test_vision_changes_record_clipped_stamps_and_stay_bounded():
+    game = blank_map()
+    game.vision_changes.clear()
+    game.add_vision_source('probe', 1.5, 28.5, 4)
+    game.remove_vision_source('probe')
+    assert game.vision_changes == [(0, 24, 6, 30)] * 2
+
+    # Без отрисовки изменения никто не забирает, но список не растет бесконечно
+    for i in range(3 * m.VISION_CHANGES_LIMIT):
+        game.add_vision_source(('probe', i), i % 40, 15, 3)
+    assert len(game.vision_changes) <= m.VISION_CHANGES_LIMIT
+    assert (0, 0, game.grid_width, game.grid_height) in game.vision_changes
+
+
+def write_stats(tmp_path, section, name, field, value):
+    with open(m.STATS_FILE, encoding='utf-8') as f:
+        data = json.load(f)
+    if value is None:
+        del data[section][name][field]
+    else:
+        data[section][name][field] = value
+    path = tmp_path / 'stats.json'
+    path.write_text(json.dumps(data), encoding='utf-8')
+    return path
+
+
+def test_load_stats_accepts_shipped_file():
+    units, buildings, _ = m.load_stats()
+    assert units[m.UnitType.WARRIOR.value]['health'] > 0
+    assert buildings[m.BuildingType.BARRACKS.value]['produces'] == m.UnitType.WARRIOR
+
+
+@pytest.mark.parametrize('section, name, field, value', [
+    ('buildings', 'TOWER', 'size', 2.5),
+    ('buildings', 'TOWER', 'size', 0),
+    ('units', 'WARRIOR', 'health', 0),
+    ('buildings', 'WALL', 'build_time', 0),
+    ('units', 'ARCHER', 'damage', -1),
+    ('units', 'ARCHER', 'damage', True),
+    ('units', 'SCOUT', 'cost', {'silver': 5}),
+    ('units', 'SCOUT', 'color', [0, 0, 300]),
+    ('units', 'SCOUT', 'speed', None),
+    ('units', 'SCOUT', 'flying', 1),
+    ('buildings', 'BARRACKS', 'produces', 'DRAGON'),
+])
+def test_load_stats_rejects_malformed_file(tmp_path, section, name, field, value):
+    with pytest.raises(ValueError):
+        m.load_stats(write_stats(tmp_path, section, name, field, value))
+
+
+def test_load_stats_allows_zero_damage(tmp_path):
+    units, _, _ = m.load_stats(write_stats(tmp_path, 'units', 'HEALER', 'damage', 0))
+    assert units[m.UnitType.HEALER.value]['damage'] == 0